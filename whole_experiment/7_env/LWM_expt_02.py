@@ -21,12 +21,16 @@ from torch.distributions import Categorical, Gumbel
 import torch.nn.functional as F
 from torchvision import datasets, transforms
 from torch.utils.tensorboard import SummaryWriter
-from copy import deepcopy
 from tqdm import tqdm
 import random
 import math
+import warnings
+from typing import Optional
 import numpy as np
 import matplotlib.pyplot as plt
+from profiling import Profiler
+from replay import ReplayBuffer
+from message_schedule import make_schedule
 #%matplotlib inline
 # 可視化のためにTensorBoardを用いるので, Colab上でTensorBoardを表示するための宣言を行う
 #%load_ext tensorboard
@@ -42,6 +46,10 @@ print(device)
 """
 
 class State():
+    '''
+    迷路の中の位置. Environmentが返すStateは環境の間で共有しているので、書き換える場合はclone()したものを使う
+    '''
+    __slots__ = ('row', 'column')
 
     def __init__(self, row=-1, column=-1):
         self.row = row
@@ -59,61 +67,155 @@ class State():
     def __eq__(self, other):
         return self.row == other.row and self.column == other.column
 
+# 迷路のレイアウト
+# grid is 2d-array. Its values are treated as an attribute.
+# Kinds of attribute is following.
+#  0: ordinary cell
+#  -1: damage cell (game end)
+#  1: reward cell (game end)
+#  9: block cell (can't locate agent)
+# reward cellは'goals'のうちいずれか1つにepisodeごとにランダムに配置される
+LAYOUTS = {
+    # Environment A
+    'A': {
+        'grid': [
+            [9, 9, 9, 9, 9, 9, 9, 9, 9],
+            [9, 0, 0, 0, 0, 0, 0, 0, 9],
+            [9, 0, 9, 9, 9, 9, 9, 9, 9],
+            [9, 0, 9, 9, 9, 9, 9, 9, 9],
+            [9, 0, 0, 0, 0, 0, 0, 0, 9],
+            [9, 0, 9, 9, 9, 9, 9, 9, 9],
+            [9, 0, 9, 9, 9, 9, 9, 9, 9],
+            [9, 0, 0, 0, 0, 0, 0, 0, 9],
+            [9, 9, 9, 9, 9, 9, 9, 9, 9],
+        ],
+        'start': (4, 7),
+        'goals': [(1, 7), (7, 7)],
+    },
+    # Environment B
+    'B': {
+        'grid': [
+            [9, 9, 9, 9, 9, 9, 9, 9, 9],
+            [9, 0, 0, 0, 0, 0, 0, 0, 9],
+            [9, 0, 9, 0, 9, 9, 9, 9, 9],
+            [9, 0, 9, 0, 9, 0, 0, 0, 9],
+            [9, 0, 9, 0, 9, 0, 0, 0, 9],
+            [9, 0, 9, 0, 9, 0, 0, 0, 9],
+            [9, 0, 9, 0, 9, 0, 0, 0, 9],
+            [9, 0, 9, 0, 9, 0, 0, 0, 9],
+            [9, 9, 9, 9, 9, 9, 9, 9, 9],
+        ],
+        'start': (1, 7),
+        'goals': [(1, 3), (4, 3), (7, 3)],
+    },
+}
+
+_grid_tables = {} # grid_typeごとのgridテーブルのキャッシュ
+
+def grid_table(grid_type):
+    '''
+    reward cellを配置し終えたgridを、reward cellの候補位置すべてについて並べた配列を返す
+        grid_type : 'A' または 'B'
+    返り値は (reward cellの候補数, row, column) のint8配列で、書き込みはできない
+    '''
+    if grid_type not in LAYOUTS:
+        raise Exception("'grid_type' must be 'A' or 'B'!")
+    if grid_type not in _grid_tables:
+        layout = LAYOUTS[grid_type]
+        table = np.empty((len(layout['goals']), *np.shape(layout['grid'])), dtype=np.int8)
+        for goal_index, (row, column) in enumerate(layout['goals']):
+            table[goal_index] = layout['grid']
+            table[goal_index, row, column] = 1
+        table.flags.writeable = False # 全episodeで共有するので書き換えられないようにする
+        _grid_tables[grid_type] = table
+    return _grid_tables[grid_type]
+
+_cell_tables = {} # grid_typeごとのマスのテーブルのキャッシュ
+_transition_tables = {} # (grid_type, move_prob)ごとの遷移先のテーブルのキャッシュ
+
+def cell_table(grid_type):
+    '''
+    マスごとの共有のStateと、移動先のテーブルを返す（マスの番号は row * 列数 + column）
+    返り値は (マスの番号ごとのState（block cellはNone）, マスの番号ごとの行動(UP, LEFT, DOWN, RIGHT)ごとの移動先のState)
+    '''
+    if grid_type not in _cell_tables:
+        grid = LAYOUTS[grid_type]['grid']
+        rows, columns = len(grid), len(grid[0])
+        cells = [State(row, column) if grid[row][column] != 9 else None
+                 for row in range(rows) for column in range(columns)]
+        neighbors = [None] * len(cells)
+        for index, state in enumerate(cells):
+            if state is None:
+                continue
+            moved = []
+            for d_row, d_column in ((-1, 0), (0, -1), (1, 0), (0, 1)):
+                row, column = state.row + d_row, state.column + d_column
+                # 迷路の外やblock cellには移動せず、その場に留まる
+                inside = 0 <= row < rows and 0 <= column < columns
+                moved.append(cells[row * columns + column] if inside and cells[row * columns + column] is not None else state)
+            neighbors[index] = tuple(moved)
+        _cell_tables[grid_type] = (cells, neighbors)
+    return _cell_tables[grid_type]
+
+def transition_candidates(grid_type, move_prob):
+    '''
+    マスの番号ごと・行動ごとの遷移先と確率の組 ((State, 確率), ...) のテーブルを返す
+    順番と確率の足し方はEnvironment.transit_funcのdictと同じ
+    '''
+    key = (grid_type, move_prob)
+    if key not in _transition_tables:
+        cells, neighbors = cell_table(grid_type)
+        table = [None] * len(cells)
+        for index, moved in enumerate(neighbors):
+            if moved is None:
+                continue
+            candidates = []
+            for action in range(4):
+                opposite_direction = (action + 2) % 4
+                transition_probs = {}
+                for a in range(4):
+                    prob = 0
+                    if a == action:
+                        prob = move_prob
+                    elif a != opposite_direction:
+                        prob = (1 - move_prob) / 2
+                    next_state = moved[a]
+                    if next_state not in transition_probs:
+                        transition_probs[next_state] = prob
+                    else:
+                        transition_probs[next_state] += prob
+                candidates.append(tuple(transition_probs.items()))
+            table[index] = tuple(candidates)
+        _transition_tables[key] = table
+    return _transition_tables[key]
+
 class Environment():
 
-    def __init__(self, grid_type='A', move_prob=1.0):
+    def __init__(self, grid_type='A', move_prob=1.0, seed=None):
+        '''
+        grid_type : 迷路のレイアウト('A' または 'B')
+        move_prob : 選択した方向に移動する確率
+        seed : reward cellの位置と状態遷移を決める乱数のseed(int, np.random.SeedSequence, np.random.Generatorのいずれか)
+        '''
 
         # Make a grid environment.
         self.grid_type = grid_type
-
-        # grid is 2d-array. Its values are treated as an attribute.
-        # Kinds of attribute is following.
-        #  0: ordinary cell
-        #  -1: damage cell (game end)
-        #  1: reward cell (game end)
-        #  9: block cell (can't locate agent)
-
-        if self.grid_type=='A':
-            # Environment A
-
-            init_grid = [
-                [9, 9, 9, 9, 9, 9, 9, 9, 9],
-                [9, 0, 0, 0, 0, 0, 0, 0, 9],
-                [9, 0, 9, 9, 9, 9, 9, 9, 9],
-                [9, 0, 9, 9, 9, 9, 9, 9, 9],
-                [9, 0, 0, 0, 0, 0, 0, 0, 9],
-                [9, 0, 9, 9, 9, 9, 9, 9, 9],
-                [9, 0, 9, 9, 9, 9, 9, 9, 9],
-                [9, 0, 0, 0, 0, 0, 0, 0, 9],
-                [9, 9, 9, 9, 9, 9, 9, 9, 9],
-            ]
-
-            # start pos = [4][7]
-            start_row, start_col = 4, 7
-
-        elif self.grid_type=='B':
-            # Environment B
-
-            init_grid = [
-                [9, 9, 9, 9, 9, 9, 9, 9, 9],
-                [9, 0, 0, 0, 0, 0, 0, 0, 9],
-                [9, 0, 9, 0, 9, 9, 9, 9, 9],
-                [9, 0, 9, 0, 9, 0, 0, 0, 9],
-                [9, 0, 9, 0, 9, 0, 0, 0, 9],
-                [9, 0, 9, 0, 9, 0, 0, 0, 9],
-                [9, 0, 9, 0, 9, 0, 0, 0, 9],
-                [9, 0, 9, 0, 9, 0, 0, 0, 9],
-                [9, 9, 9, 9, 9, 9, 9, 9, 9],
-            ]
-
-            # start pos = [1][7]
-            start_row, start_col = 1, 7
-
-        else:
-            raise Exception("'grid_type' must be 'A' or 'B'!")
-
-        self.init_grid = init_grid # reward cellの位置が指定されていない（reward cellの位置はepospdeごとに変えたいので、self.reset()内で指定）
-        self.init_state = State(row=start_row, column=start_col)
+        self.grid_table = grid_table(grid_type)
+
+        layout = LAYOUTS[grid_type]
+        self.init_grid = layout['grid'] # reward cellの位置が指定されていない（reward cellの位置はepisodeごとに変えたいので、self.reset()内で指定）
+        # 状態は全てのマスのStateを作っておいたものを使い回し、移動先は表から引く（stepでStateを作らない）
+        self._columns = len(self.init_grid[0])
+        self._cells, self._neighbors = cell_table(grid_type)
+        self._candidates = None # move_probごとに作る遷移先の表（transit()で最初に使うときに作る）
+        self._candidates_prob = None
+        # reward cellの位置ごとの、マスの番号順に並べたマスの種類
+        self._attribute_table = [goal_grid.ravel().tolist() for goal_grid in self.grid_table]
+        self.init_state = self._cells[layout['start'][0] * self._columns + layout['start'][1]]
+
+        # 環境ごとに独立した乱数列を持つ（並列に環境を動かしてもresetが再現できるように）
+        self.rng = np.random.default_rng(seed)
+        self._goal_queue = [] # まとめてサンプリングしたreward cellの位置
 
         self.reset()
 
@@ -127,35 +229,33 @@ class Environment():
         self.move_prob = move_prob
 
     def reset(self):
+        '''
+        episodeの開始時の状態に戻し、gridテーブルのうち今回のepisodeで使うもののindexを返す
+        '''
         # Locate the agent at init_state.
-        self.state = self.init_state.clone()
+        self.state = self.init_state
 
-        # Reset grid
-        self.grid = deepcopy(self.init_grid)
         # Decide position of reward cell randomly
-        reward_pos = random.randint(0, 5)
-
-        if self.grid_type=='A':
-            # reward cell must be somewhere on one of the corridors
-            reward_x = reward_pos % 3
-            reward_y = reward_pos % 2
-            if reward_y == 0:
-                #self.grid[1][reward_x*3+1] = 1
-                self.grid[1][7] = 1
-            else:
-                #self.grid[-2][reward_x*3+1] = 1
-                self.grid[-2][7] = 1
-
-        elif self.grid_type=='B':
-            # reward cell must be somewhere on one of the corridors
-            reward_x = reward_pos % 2
-            reward_y = reward_pos % 3
-            if reward_x == 0:
-                self.grid[reward_y*3+1][3] = 1
-            else:
-                self.grid[reward_y*3+1][3] = 1
+        # 1回ごとに乱数を引くと遅いので、まとめて引いておいたものを順に使う
+        if not self._goal_queue:
+            self._goal_queue = self.rng.integers(len(self.grid_table), size=1024).tolist()[::-1]
+        self.goal_index = self._goal_queue.pop()
+
+        # gridはテーブルのviewなのでコピーは発生しない
+        self._grid = self.grid_table[self.goal_index]
+        self._attributes = self._attribute_table[self.goal_index]
+
+        return self.goal_index
 
-        return self.grid, self.state
+    @property
+    def grid(self):
+        return self._grid
+
+    @grid.setter
+    def grid(self, grid):
+        # reset()以外でgridを置き換えた場合（oracleなど）は、マスの種類の表も作り直す
+        self._grid = grid
+        self._attributes = np.asarray(grid).ravel().tolist()
 
     @property
     def row_length(self):
@@ -171,13 +271,15 @@ class Environment():
 
     @property
     def states(self):
-        states = []
-        for row in range(self.row_length):
-            for column in range(self.column_length):
-                # Block cells are not included to the state.
-                if self.grid[row][column] != 9:
-                    states.append(State(row, column))
-        return states
+        # Block cells are not included to the state.
+        return [state for state in self._cells if state is not None]
+
+    def _transition_candidates(self, state):
+        # stateからの行動ごとの遷移先と確率の組. move_probが変わったら表を引き直す
+        if self._candidates_prob != self.move_prob:
+            self._candidates = transition_candidates(self.grid_type, self.move_prob)
+            self._candidates_prob = self.move_prob
+        return self._candidates[state.row * self._columns + state.column]
 
     def transit_func(self, state, action):
         transition_probs = {}
@@ -185,63 +287,27 @@ class Environment():
             # Already on the terminal cell.
             return transition_probs
 
-        opposite_direction = (action + 2) % 4
-
-        for a in self.actions:
-            prob = 0
-            if a == action:
-                prob = self.move_prob
-            elif a != opposite_direction:
-                prob = (1 - self.move_prob) / 2
-
-            next_state = self._move(state, a)
-            if next_state not in transition_probs:
-                transition_probs[next_state] = prob
-            else:
-                transition_probs[next_state] += prob
+        for next_state, prob in self._transition_candidates(state)[action]:
+            transition_probs[next_state] = prob
 
         return transition_probs
 
     def can_action_at(self, state):
-        if self.grid[state.row][state.column] == 0:
-            return True
-        else:
-            return False
+        return self._attributes[state.row * self._columns + state.column] == 0
 
     def _move(self, state, action):
         if not self.can_action_at(state):
             raise Exception("Can't move from here!")
 
-        next_state = state.clone()
-
-        # Execute an action (move).
-        if action == 0: # UP
-            next_state.row -= 1
-        elif action == 2: # DOWN
-            next_state.row += 1
-        elif action == 1: # LEFT
-            next_state.column -= 1
-        elif action == 3: #RIGHT
-            next_state.column += 1
-
-        # Check whether a state is out of the grid.
-        if not (0 <= next_state.row < self.row_length):
-            next_state = state
-        if not (0 <= next_state.column < self.column_length):
-            next_state = state
-
-        # Check whether the agent bumped a block cell.
-        if self.grid[next_state.row][next_state.column] == 9:
-            next_state = state
-
-        return next_state
+        # 迷路の外やblock cellに移動しようとした場合はその場に留まる
+        return self._neighbors[state.row * self._columns + state.column][action]
 
     def reward_func(self, state):
         reward = self.default_reward
         done = False
 
         # Check an attribute of next state.
-        attribute = self.grid[state.row][state.column]
+        attribute = self._attributes[state.row * self._columns + state.column]
         if attribute == 1:
             # Get reward! and the game ends.
             reward = 1
@@ -261,19 +327,31 @@ class Environment():
         return next_state, reward, done
 
     def transit(self, state, action):
-        transition_probs = self.transit_func(state, action)
-        if len(transition_probs) == 0:
+        if not self.can_action_at(state):
             return None, None, True
 
-        next_states = []
-        probs = []
-        for s in transition_probs:
-            next_states.append(s)
-            probs.append(transition_probs[s])
-        next_state = np.random.choice(next_states, p=probs)
+        # 環境ごとの乱数(self.rng)で遷移先を選ぶ. 一様乱数を1つだけ引き、累積確率を超えたところの状態にする
+        # transit_funcのdictは作らず、同じ順番の表から直接選ぶ
+        u = self.rng.random()
+        for next_state, prob in self._transition_candidates(state)[action]:
+            u -= prob
+            if u < 0:
+                break
         reward, done = self.reward_func(next_state)
         return next_state, reward, done
 
+    def observation_key(self, partial=True):
+        '''
+        観測を決める値の組を返す. キーが同じなら観測も同じ
+            partial : 聞き手の部分観測では、reward cellが視野(周囲1マス)に入っていない場合はその位置を区別しない
+        '''
+        row, column = self.state.row, self.state.column
+        if partial:
+            goal_row, goal_column = LAYOUTS[self.grid_type]['goals'][self.goal_index]
+            if abs(goal_row - row) > 1 or abs(goal_column - column) > 1:
+                return (self.grid_type, row, column, -1)
+        return (self.grid_type, row, column, self.goal_index)
+
     def observation(self, partial=True):
         '''
         観測を出力する関数
@@ -308,6 +386,15 @@ class Environment():
 
         return (grid_img/ 255.0).float()
 
+def make_envs(num_envs, grid_type='A', move_prob=1.0, seed=None):
+    '''
+    独立した乱数列を持つ環境をnum_envs個作る
+    同じseed(int または np.random.SeedSequence)を与えれば、各環境のresetと状態遷移の結果は再現される
+    '''
+    sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    seed_seqs = sequence.spawn(num_envs)
+    return [Environment(grid_type=grid_type, move_prob=move_prob, seed=seed_seq) for seed_seq in seed_seqs]
+
 """## 3 モデルの実装
 
 ### 3-1 聞き手（Listener）
@@ -325,10 +412,61 @@ class Environment():
 def torch_log(x):
     return torch.log(torch.clamp(x, min=1e-10))
 
+# LWMAgentで乱数を使う部品
+RNG_COMPONENTS = ('init', 'message', 'action', 'vae_noise', 'lbn_noise', 'replay', 'ppo')
+
+def component_seeds(seed, components=RNG_COMPONENTS):
+    '''
+    seed(int または np.random.SeedSequence)から、部品ごとに独立した乱数列のseed(int)を作る
+    '''
+    sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    children = sequence.spawn(len(components))
+    return {name: int(child.generate_state(1, dtype=np.uint64)[0] >> 1) for name, child in zip(components, children)}
+
+# 再パラメータ化トリックのノイズ
+class NoiseSource():
+    '''
+    再パラメータ化トリックで使う標準正規分布のノイズを、meanと同じdevice・dtypeで直接作る
+        seed : 指定すると専用のtorch.Generatorを使い、乱数列が固定される（テスト用）
+        pool_size : 0より大きい場合、pool_size個分のノイズをまとめて作っておき、順に切り出して使う
+    切り出したノイズは逆伝播のために保存されることがあるので、poolは上書きせずに作り直す
+    '''
+    def __init__(self, seed=None, pool_size=0):
+        self.seed = seed
+        self.pool_size = pool_size
+        self.generator = None
+        self._pool = None
+        self._pool_index = 0
+
+    def _get_generator(self, device):
+        if self.seed is None:
+            return None
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+        return self.generator
+
+    def sample_like(self, mean):
+        generator = self._get_generator(mean.device)
+        numel = mean.numel()
+        if self.pool_size <= 0 or numel > self.pool_size:
+            return torch.randn(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+
+        pool = self._pool
+        if (pool is None or self._pool_index + numel > self.pool_size
+                or pool.device != mean.device or pool.dtype != mean.dtype):
+            pool = torch.randn(self.pool_size, generator=generator, device=mean.device, dtype=mean.dtype)
+            self._pool = pool
+            self._pool_index = 0
+        epsilon = pool[self._pool_index:self._pool_index + numel].view(mean.shape)
+        self._pool_index += numel
+        return epsilon
+
 # VAEモデルの実装
 class VAE_Seq(nn.Module):
     def __init__(self, z_dim):
         super(VAE_Seq, self).__init__()
+        self.noise = None # NoiseSource. Noneの場合はtorch.randn_likeを使う
         # Encoder, xを入力にガウス分布のパラメータmu, sigmaを出力
         self.conv_enc1 = nn.Conv2d(3, 8, 3)
         self.conv_enc2 = nn.Conv2d(8, 16, 3)
@@ -346,11 +484,11 @@ class VAE_Seq(nn.Module):
         x = x.view(-1, 16*5*5)
         mean = self.dense_encmean(x)
         std = F.softplus(self.dense_encvar(x))
-        return mean, std
+        return mean.float(), std.float() # autocast中でも出力はfloat32で返す
     
     def _sample_z(self, mean, std):
-        # 再パラメータ化トリック
-        epsilon = torch.randn(mean.shape).to(device)
+        # 再パラメータ化トリック（ノイズはmeanと同じdevice上に直接作る）
+        epsilon = torch.randn_like(mean) if self.noise is None else self.noise.sample_like(mean)
         return mean + std * epsilon
  
     def _decoder(self, z):
@@ -359,7 +497,7 @@ class VAE_Seq(nn.Module):
         x = F.relu(self.conv_dec1(x))
         # 出力が0~1になるようにsigmoid
         x = torch.sigmoid(self.conv_dec2(x))
-        return x
+        return x.float()
 
     def forward(self, x):
         mean, std = self._encoder(x)
@@ -383,26 +521,123 @@ class VAE_Seq(nn.Module):
         
         return KL, -reconstruction
 
+# VAE_Seq._encoderの出力のキャッシュ
+class LatentCache():
+    '''
+    部分観測ごとにVAE_Seq._encoderの出力(mean, std)を覚えておき、同じ観測では畳み込みを計算しない（推論用）
+    キーはEnvironment.observation_key()
+    watch()したoptimizerのstepやload_state_dictでVAE_Seqのパラメータが変わるとversionが上がり、覚えた値は捨てる
+    それ以外の方法でパラメータを書き換えた場合はinvalidate_latent_caches()を呼ぶ
+    '''
+    def __init__(self, vae):
+        self.vae = vae
+        self.version = 0
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        vae.register_load_state_dict_post_hook(lambda module, keys: self.invalidate())
+        # invalidate_latent_caches()でモジュールから見つけられるようにする
+        if not hasattr(vae, '_latent_caches'):
+            vae._latent_caches = []
+        vae._latent_caches.append(self)
+
+    def watch(self, optimizer):
+        '''
+        optimizerのstepのたびにキャッシュを無効にする
+        '''
+        optimizer.register_step_post_hook(lambda optimizer, args, kwargs: self.invalidate())
+
+    def invalidate(self):
+        self.version += 1
+        self._entries = {}
+
+    def encode(self, key, observe):
+        '''
+        key : 観測のキー
+        observe : キャッシュにない場合に部分観測(1, 3, 9, 9)を作る関数
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            with torch.no_grad():
+                entry = self.vae._encoder(observe())
+            self._entries[key] = entry
+        else:
+            self.hits += 1
+        return entry
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+def invalidate_latent_caches(modules):
+    '''
+    modules(名前 -> nn.Module のdict)に付いているLatentCacheを全て無効にする
+    load_state_dictやoptimizerを通さずに重みをcopy_した後（SharedWeights.pull, broadcast_networks）に呼ぶ
+    '''
+    for module in modules.values():
+        for submodule in module.modules():
+            for cache in getattr(submodule, '_latent_caches', ()):
+                cache.invalidate()
+
+# 低ランク分解した全結合層
+class LowRankLinear(nn.Module):
+    def __init__(self, in_features, out_features, rank):
+        '''
+        重み(out_features, in_features)を (out_features, rank) と (rank, in_features) の積で表す
+        パラメータ数・計算量は in*out から rank*(in+out) になる
+        '''
+        super(LowRankLinear, self).__init__()
+        self.dense_u = nn.Linear(in_features, rank, bias=False)
+        self.dense_v = nn.Linear(rank, out_features)
+
+    def forward(self, x):
+        return self.dense_v(self.dense_u(x))
+
 # Latent Belief Networkモデルの実装
 class LBN(nn.Module):
-    def __init__(self, T, z_dim, m_dim, beta_dim):
+    def __init__(self, T, z_dim, m_dim, beta_dim, m_tokens=None, hidden_dim=1000, rnn_hidden_dim=None, rank=None, rnn_type='lstm'):
         '''
         T : 最大ステップ数
+        m_tokens : messageのトークンの種類数. 指定するとmessageをトークン列(batch, m_dim // m_tokens)で受け取れる
+        hidden_dim : Encoderの中間層のユニット数
+        rnn_hidden_dim : Decoderの再帰層のユニット数（Noneの場合はhidden_dimと同じ）
+        rank : 指定するとEncoderの中間層同士の全結合層(dense_enc2)をこのランクに低ランク分解する
+        rnn_type : Decoderの再帰層 ('lstm' または 'gru')
         '''
         super(LBN, self).__init__()
         self.T = T
         self.z_dim = z_dim
-        self.sigma = torch.tensor([0.1])
+        self.register_buffer('sigma', torch.tensor([0.1]), persistent=False) # モデルと同じdeviceに置く
+        self.noise = None # NoiseSource. Noneの場合はtorch.randn_likeを使う
+        rnn_hidden_dim = hidden_dim if rnn_hidden_dim is None else rnn_hidden_dim
+        self.hidden_dim = hidden_dim
+        self.rnn_hidden_dim = rnn_hidden_dim
+
         # Encoder, (z, m)を入力にガウス分布のパラメータmu, sigmaを出力
-        self.dense_enc1 = nn.Linear(z_dim + m_dim, 1000)
-        self.dense_enc2 = nn.Linear(1000, 1000)
-        self.dense_encmean = nn.Linear(1000, beta_dim)
-        self.dense_encvar = nn.Linear(1000, beta_dim)
+        self.dense_enc1 = nn.Linear(z_dim + m_dim, hidden_dim)
+        if rank is None:
+            self.dense_enc2 = nn.Linear(hidden_dim, hidden_dim)
+        else:
+            self.dense_enc2 = LowRankLinear(hidden_dim, hidden_dim, rank)
+        self.dense_encmean = nn.Linear(hidden_dim, beta_dim)
+        self.dense_encvar = nn.Linear(hidden_dim, beta_dim)
 
         # Decoder, betaを入力に次の時刻のzを出力
-        self.rnn = nn.LSTM(input_size = beta_dim,
-                            hidden_size = 1000)
-        self.dense_dec = nn.Linear(1000, z_dim)
+        if rnn_type == 'lstm':
+            self.rnn = nn.LSTM(input_size = beta_dim,
+                                hidden_size = rnn_hidden_dim)
+        elif rnn_type == 'gru':
+            self.rnn = nn.GRU(input_size = beta_dim,
+                               hidden_size = rnn_hidden_dim)
+        else:
+            raise Exception("'rnn_type' must be 'lstm' or 'gru'!")
+        self.dense_dec = nn.Linear(rnn_hidden_dim, z_dim)
 
         # loss計算のための記憶
         self.z_memory = []
@@ -413,27 +648,47 @@ class LBN(nn.Module):
         self.m_dim = m_dim
         self.z_dim = z_dim
         self.beta_dim = beta_dim
-    
+
+        # トークン列を1-hotのmessageにおける位置に変換するためのoffset（state_dictには含めない）
+        self.m_tokens = m_tokens
+        if m_tokens is not None:
+            self.register_buffer('token_offsets', torch.arange(m_dim // m_tokens) * m_tokens, persistent=False)
+
+    def _embed(self, z, tokens):
+        '''
+        dense_enc1(cat([z, one_hot(tokens)]))を1-hotを作らずに計算する
+        1-hotとの積はdense_enc1の重みの列を選んで足すことと同じなので、embeddingとして引く
+        '''
+        weight_z = self.dense_enc1.weight[:, :self.z_dim]
+        weight_m = self.dense_enc1.weight[:, self.z_dim:]
+        return F.linear(z, weight_z, self.dense_enc1.bias) + F.embedding(tokens + self.token_offsets, weight_m.t()).sum(dim=1)
+
     def _encoder(self, z, m):
-        x = torch.cat([z, m], dim=1)
-        x = F.relu(self.dense_enc1(x))
+        '''
+        m : message. 1-hotを束ねたもの(batch, m_dim)か、トークン列(batch, m_dim // m_tokens)のLongTensor
+        '''
+        if m.dtype == torch.long:
+            x = F.relu(self._embed(z, m))
+        else:
+            x = torch.cat([z, m], dim=1)
+            x = F.relu(self.dense_enc1(x))
         x = F.relu(self.dense_enc2(x))
         mean = self.dense_encmean(x)
         std = F.softplus(self.dense_encvar(x))
-        return mean, std
+        return mean.float(), std.float() # autocast中でも出力はfloat32で返す
     
     def _sample_beta(self, mean, std):
-        # 再パラメータ化トリック
-        epsilon = torch.randn(mean.shape).to(device)
+        # 再パラメータ化トリック（ノイズはmeanと同じdevice上に直接作る）
+        epsilon = torch.randn_like(mean) if self.noise is None else self.noise.sample_like(mean)
         return mean + std * epsilon
  
     def _decoder(self, beta):
         hidden_init = None
-        output, (hidden, cell) = self.rnn(beta, hidden_init) # hidden_initは隠れ層Hと記憶層Cの初期値、Noneの場合は零行列となる
-        output = F.relu(output.view(-1, 1000)) # (系列長) * 2000 に変換
+        output, _ = self.rnn(beta, hidden_init) # hidden_initは隠れ層H（LSTMの場合は記憶層Cも）の初期値、Noneの場合は零行列となる
+        output = F.relu(output.view(-1, self.rnn_hidden_dim)) # (系列長) * rnn_hidden_dim に変換
         z_pred = self.dense_dec(output)
 
-        return z_pred
+        return z_pred.float()
 
     def forward(self, z, m, beta, t):
         if m == None:
@@ -459,40 +714,74 @@ class LBN(nn.Module):
 
     def loss(self):
         '''
+        記憶している1 episodeのlossをpacked_lossで計算する. betaは行動選択のときにサンプリングしたものを使う
         z_memory : 時刻tにおけるzの記憶(t_done, z_dim) (t_done : エピソード終了時のt)
-        m_memory : messageの記憶(messageを受けとった回数, m_dim)
+        m_memory : messageの記憶(messageを受けとった回数, m_dim) もしくはトークン列の記憶(messageを受けとった回数, m_dim // m_tokens)
         beta_memory : 時刻tにおけるbetaの記憶(t_done, m_dim)
         t_memory : messageが送られた時刻tの記憶(messageを受けとった回数)
         '''
-        z_memory = torch.squeeze(torch.stack(self.z_memory))
-        m_memory = torch.squeeze(torch.stack(self.m_memory)).view(-1, self.m_dim) # viewはm_memoryに格納されたmが1つのみである場合への対策
-        beta_memory = torch.squeeze(torch.stack(self.beta_memory))
-        t_recieved = torch.tensor(self.t_memory)
+        z_memory = torch.cat(self.z_memory) # zは(1, z_dim)
+        m_memory = torch.cat(self.m_memory) # mは(1, m_dim)または(1, m_dim // m_tokens)
+        t_recieved = torch.tensor(self.t_memory, device=z_memory.device)
+        beta = torch.cat([self.beta_memory[t] for t in self.t_memory])
+        message_mask = torch.zeros(len(z_memory), dtype=torch.bool, device=z_memory.device)
+        message_mask[t_recieved] = True
+        offsets = torch.tensor([0, len(z_memory)], device=z_memory.device)
+        return self.packed_loss(z_memory, m_memory, message_mask, offsets, beta=beta)
+
+    def packed_loss(self, z, m, message_mask, offsets, reduction='mean', beta=None):
+        '''
+        複数のepisodeのlossを、最大ステップ数に揃えずにまとめて計算する. 1 episodeの場合はloss()と同じ値になる
+        KLは全messageの平均、再構成誤差はepisodeごとの値の平均
+            z : 全episodeの各時刻のzをつなげたもの (ステップ数の合計, z_dim)
+            m : 受けとったmessage (messageを受けとった回数, m_dim) もしくはトークン列. episode順・時刻順に並べる
+            message_mask : messageを受けとった時刻 (ステップ数の合計). 各episodeのt=0はTrueであること
+            offsets : 各episodeの開始位置 (episode数+1)
+            reduction : 'none'の場合は再構成誤差をepisodeごとに返す (episode数)
+            beta : 行動選択のときにサンプリングしたbeta (messageを受けとった回数, beta_dim). Noneの場合はサンプリングし直す
+        '''
+        offsets = offsets.to(z.device)
+        lengths = offsets[1:] - offsets[:-1]
+        starts = offsets[:-1]
+        if not message_mask[starts].all():
+            raise Exception("first message must be recieved at t=0")
 
-        # KL lossの計算. mean, stdは (messageを受けとった回数, beta_dim)
-        z = z_memory[t_recieved]
-        m = m_memory
-        mean, std = self._encoder(z, m)
+        mean, std = self._encoder(z[message_mask], m)
         KL = -0.5 * torch.mean(torch.sum(1 + torch_log(std**2) - mean**2 - std**2, dim=1))
-
-        # reconstruction loss(再構成誤差)の計算. 
-        reconstruction = 0
-        beta = None # t=0でメッセージが送られることを前提とした実装になっている
-        beta_idx = 0 # beta_memory内の何番目のbetaを呼び出すか
-        for t, _ in enumerate(z_memory): 
-            if t in self.t_memory: # messageをもらったときのみbetaを更新する
-                beta = beta_memory[beta_idx]
-                beta_idx += 1
-            z_target = z_memory[t:] # (系列長(t~T)) * z_dim
-            beta = torch.broadcast_to(beta, (z_target.shape[0], 1, self.beta_dim))
-            z_pred = self._decoder(beta)
-            z_target = z_target.view(-1, self.z_dim).detach() # (系列長) * z_dim に変換
-            reconstruction += F.mse_loss(z_pred, z_target, reduction='sum') /2
-            beta = beta[0]
-        else: steps = t
-        reconstruction /= steps
-
-        return KL, reconstruction 
+        if beta is None:
+            beta = self._sample_beta(mean, std) # (messageを受けとった回数, beta_dim)
+
+        # 入力が一定ならDecoderの出力は系列の先頭からのステップ数kだけで決まるので、betaごとに1回だけ最大ステップ数分を計算する
+        max_steps = int(lengths.max())
+        z_pred = self._decoder(torch.broadcast_to(beta, (max_steps, *beta.shape)))
+        z_pred = z_pred.view(max_steps, -1, self.z_dim) # (k, messageを受けとった回数, z_dim)
+        # 各時刻で使うbetaの番号（各episodeはt=0で新しいbetaから始まる）
+        beta_index = torch.cumsum(message_mask.long(), 0) - 1
+
+        # 時刻tのbetaからt+k (< length)のzを予測する. 時刻tからは length-t 個の組がある
+        episode_index = torch.repeat_interleave(torch.arange(len(lengths), device=z.device), lengths)
+        count = offsets[1:][episode_index] - torch.arange(len(z), device=z.device)
+        source = torch.repeat_interleave(torch.arange(len(z), device=z.device), count)
+        k = torch.arange(len(source), device=z.device) - torch.repeat_interleave(torch.cumsum(count, 0) - count, count)
+        error = ((z_pred[k, beta_index[source]] - z[source + k].detach()) ** 2).sum(dim=1) / 2
+        reconstruction = torch.zeros(len(lengths), device=z.device, dtype=error.dtype).index_add_(0, episode_index[source], error)
+        reconstruction = reconstruction / (lengths - 1).clamp(min=1)
+        if reduction == 'none':
+            return KL, reconstruction
+
+        return KL, reconstruction.mean()
+
+    def sequence_loss(self, z, m, message_mask, lengths, reduction='mean'):
+        '''
+        packed_lossを最大ステップ数に揃えた入力で呼ぶ
+            z : 各時刻のz (episode数, 最大ステップ数, z_dim). 足りない部分は何でもよい
+            message_mask : messageを受けとった時刻 (episode数, 最大ステップ数)
+            lengths : 各episodeのステップ数 (episode数)
+        '''
+        lengths = lengths.to(z.device)
+        valid = torch.arange(message_mask.shape[1], device=z.device)[None] < lengths[:, None]
+        offsets = torch.cat([lengths.new_zeros(1), torch.cumsum(lengths, 0)])
+        return self.packed_loss(z[valid], m, message_mask[valid], offsets, reduction=reduction)
 
     def reset_memory(self):
         self.z_memory = []
@@ -516,11 +805,156 @@ class Controller(nn.Module):
     def forward(self, z, beta):
         x = torch.cat([z, beta], dim=1)
         h = F.elu(self.fc1(x))
-        action_prob = F.softmax(self.fc2a(h), dim=-1)
-        state_value = self.fc2c(h)
+        action_prob = F.softmax(self.fc2a(h), dim=-1, dtype=torch.float)
+        state_value = self.fc2c(h).float()
         # 行動選択確率, 状態価値
         return action_prob, state_value
 
+# Controllerの学習に使うadvantageの推定
+def _discount_matrix(steps, factor, n=None, device=None):
+    # (t, k)成分が factor**(k - t) (t <= k < t + n)、それ以外は0の行列
+    index = torch.arange(steps, device=device)
+    offset = index[None, :] - index[:, None]
+    valid = offset >= 0 if n is None else (offset >= 0) & (offset < n)
+    return torch.where(valid, factor ** offset.clamp(min=0).float(), torch.zeros((), device=device))
+
+def estimate_advantages(rewards, values, mask, gamma, estimator='mc', lmd=0.95, n_step=5):
+    '''
+    episodeのbatchについてadvantageと収益（Criticの目標値）をまとめて計算する
+        rewards, values : (episode数, 最大ステップ数). valuesはControllerの状態価値（勾配は流さない）
+        mask : 有効なステップはTrue (episode数, 最大ステップ数)
+        estimator : 'mc' (Monte-Carlo収益), 'gae' (Generalized Advantage Estimation), 'nstep' (n_stepステップ先の状態価値で打ち切る)
+        lmd : GAEのλ. 1でMonte-Carlo、0で1ステップのTD誤差と同じ
+    episodeの最後のステップの次の状態価値は0とする（reward cellに到達した場合も、最大ステップ数で打ち切られた場合も）
+    返り値は (advantage, 収益) でいずれも (episode数, 最大ステップ数)
+    '''
+    mask = mask.to(rewards.dtype)
+    rewards = rewards * mask
+    values = values.detach() * mask
+    steps = rewards.shape[1]
+    if estimator == 'mc':
+        returns = rewards @ _discount_matrix(steps, gamma, device=rewards.device).t()
+        return returns - values, returns
+    if estimator == 'gae':
+        next_values = F.pad(values[:, 1:], (0, 1))
+        deltas = rewards + gamma * next_values - values
+        advantages = deltas @ _discount_matrix(steps, gamma * lmd, device=rewards.device).t()
+        return advantages * mask, (advantages + values) * mask
+    if estimator == 'nstep':
+        bootstrap = F.pad(values[:, n_step:], (0, n_step))[:, :steps]
+        returns = rewards @ _discount_matrix(steps, gamma, n=n_step, device=rewards.device).t() + gamma ** n_step * bootstrap
+        return (returns - values) * mask, returns * mask
+    raise Exception("'estimator' must be 'mc', 'gae' or 'nstep'!")
+
+"""#### 3-1-4 聞き手の1ステップ
+V → M → C を1つのモジュールにまとめる。バッチサイズ1では小さな演算の呼び出しのオーバーヘッドが支配的なので、TorchScript / torch.compileでまとめてコンパイルできるようにする。
+"""
+
+class ListenerStep(nn.Module):
+    '''
+    聞き手の1ステップ VAE_Seq._encoder → _sample_z → LBN._encoder → _sample_beta → Controller をまとめたもの（推論用）
+    LBNの記憶(z_memory等)には書き込まないので、学習時にはLWMAgent.get_actionを使う
+    トレースできるように、ノイズはNoiseSourceを使わず常にtorch.randn_likeで作る
+    返り値はいずれも (z, beta, 行動選択確率, 状態価値)
+    '''
+    def __init__(self, vae, lbn, controller):
+        super(ListenerStep, self).__init__()
+        self.vae = vae
+        self.lbn = lbn
+        self.controller = controller
+
+    def with_message(self, x, m):
+        '''
+        x : 聞き手の部分観測(batch, 3, 9, 9)
+        m : message(batch, m_dim) またはトークン列(batch, m_dim // m_tokens)
+        '''
+        mean, std = self.vae._encoder(x)
+        return self.from_latent(mean, std, m, None)
+
+    def without_message(self, x, beta_last):
+        '''
+        messageが送られていない場合、betaは更新されずbeta_lastのまま
+        '''
+        mean, std = self.vae._encoder(x)
+        return self.from_latent(mean, std, None, beta_last)
+
+    def from_latent(self, mean, std, m, beta_last):
+        '''
+        VAE_Seq._encoderの出力(mean, std)から残りを実行する（LatentCacheを使う場合は直接呼ぶ）
+        '''
+        z = mean + std * torch.randn_like(mean)
+        if m is None:
+            beta = beta_last
+        else:
+            mean, std = self.lbn._encoder(z, m)
+            beta = mean + std * torch.randn_like(mean)
+        action_prob, state_value = self.controller(z, beta)
+        return z, beta, action_prob, state_value
+
+    def forward(self, x, m, beta_last):
+        if m is None:
+            return self.without_message(x, beta_last)
+        return self.with_message(x, m)
+
+    def example_inputs(self, token_message=False):
+        '''
+        トレース用の入力の例
+        '''
+        param = self.controller.fc1.weight
+        x = torch.zeros((1, 3, 9, 9), device=param.device)
+        if token_message:
+            m = torch.zeros((1, self.lbn.m_dim // self.lbn.m_tokens), dtype=torch.long, device=param.device)
+        else:
+            m = torch.zeros((1, self.lbn.m_dim), device=param.device)
+        beta = torch.zeros((1, self.lbn.beta_dim), device=param.device)
+        return {'with_message': (x, m), 'without_message': (x, beta)}
+
+class CompiledListenerStep:
+    '''
+    ListenerStepをコンパイルして呼び出す
+        mode : 'script' (TorchScriptにトレース), 'compile' (torch.compile), 'eager' (コンパイルしない)
+        token_message : messageをトークン列で渡すかどうか（トレースする入力の型を決める）
+    messageあり・なしの2つの経路をそれぞれ1つのグラフにまとめる
+    コンパイルや実行に失敗した場合は警告を出してeagerで実行する
+    パラメータは元のモジュールと共有されるので、学習で更新された重みがそのまま使われる
+    '''
+    def __init__(self, step, mode='eager', token_message=False):
+        if mode not in ('script', 'compile', 'eager'):
+            raise Exception("'mode' must be 'script', 'compile' or 'eager'!")
+        self.step = step
+        self.mode = mode
+        self.with_message = step.with_message
+        self.without_message = step.without_message
+        try:
+            if mode == 'script':
+                # 乱数を含むのでトレース結果の検証(check_trace)は行わない
+                traced = torch.jit.trace_module(step, step.example_inputs(token_message), check_trace=False)
+                self.with_message = traced.with_message
+                self.without_message = traced.without_message
+            elif mode == 'compile':
+                self.with_message = torch.compile(step.with_message, dynamic=True)
+                self.without_message = torch.compile(step.without_message, dynamic=True)
+        except Exception as e:
+            self._fallback(e)
+
+    def _fallback(self, e):
+        warnings.warn("listener step could not be compiled with mode '%s', falling back to eager: %s" % (self.mode, e))
+        self.mode = 'eager'
+        self.with_message = self.step.with_message
+        self.without_message = self.step.without_message
+
+    def __call__(self, x, m=None, beta_last=None):
+        try:
+            if m is None:
+                return self.without_message(x, beta_last)
+            return self.with_message(x, m)
+        except Exception as e:
+            if self.mode == 'eager':
+                raise
+            # torch.compileは初回の呼び出し時にコンパイルされるので、ここで失敗することもある
+            self._fallback(e)
+            return self(x, m, beta_last)
+
 """### 3-2 話し手（Speaker）
 全体観測$O_{t}$から、全体観測の離散表現であるメッセージ$m_{t}$を出力する。アーキテクチャにはCNN、全結合層を用いる。 また、損失関数には提案手法であるConcept-Clustering (CC)を用いる。  
 なお、論文中における記述から、下記を変更した。
@@ -531,6 +965,24 @@ class Controller(nn.Module):
 def entropy(probs):
     return -torch.sum(probs * torch.log(torch.clamp(probs, min=1e-10)))
 
+class StraightThroughArgmax(torch.autograd.Function):
+    '''
+    Straight-Through Estimator
+    順伝播ではトークン位置ごとにargmaxをとった1-hot(float)を、逆伝播では勾配をそのまま通す
+    F.one_hot(label) - p.detach() + p と同じ値・勾配を、中間テンソルを作らずに計算する
+    '''
+    @staticmethod
+    def forward(ctx, p):
+        label = torch.argmax(p, dim=-1, keepdim=True)
+        message = torch.zeros_like(p).scatter_(-1, label, 1.0)
+        label = label.squeeze(-1)
+        ctx.mark_non_differentiable(label)
+        return message, label
+
+    @staticmethod
+    def backward(ctx, grad_message, grad_label):
+        return grad_message
+
 class Speaker(nn.Module):
     def __init__(self, m_tokens, m_length, buffer_size=150):
         super(Speaker, self).__init__()
@@ -543,7 +995,7 @@ class Speaker(nn.Module):
         self.fc_dec2 = nn.Linear(500, 500)
         self.fc_dec3 = nn.Linear(500, 3*9*9)
 
-        self.speaker_memory =  torch.empty((buffer_size, 3, 9, 9), dtype=torch.float, device=device) # x_glbを記憶しておくバッファ
+        self.speaker_memory = torch.zeros((buffer_size, 3, 9, 9), dtype=torch.float, device=device) # x_glbを記憶しておくバッファ（埋まるまでは0）
         self._memory_index = 0
         self.buffer_size = buffer_size
 
@@ -556,7 +1008,7 @@ class Speaker(nn.Module):
         h = h.view(-1, 16*5*5)
         h = F.relu(self.fc_enc1(h))
         h = self.fc_enc2(h)
-        p = h.view(-1, self.m_length, self.m_tokens)
+        p = h.float().view(-1, self.m_length, self.m_tokens)
         return p
 
     def _decoder(self, m):
@@ -567,21 +1019,30 @@ class Speaker(nn.Module):
         h = h.view(-1, 3, 9, 9)
         # 出力が0~1になるようにsigmoid
         x = torch.sigmoid(h)
-        return x
+        return x.float()
 
     def forward(self, x):
+        '''
+        返り値は (message(batch, m_length, m_tokens), トークン列(batch, m_length))
+        '''
         p = self._encoder(x)
-        label = torch.argmax(p, dim=-1)
-        message = F.one_hot(label, num_classes=self.m_tokens) - p.detach() + p
-        self.speaker_memory[self._memory_index] = torch.squeeze(x).clone() # x_glbを保存
-        self._memory_index = (self._memory_index + 1) % self.buffer_size # リングバッファにする
-        return message
+        message, label = StraightThroughArgmax.apply(p)
+        x = x.reshape(-1, 3, 9, 9)
+        if len(x) == 1:
+            self.speaker_memory[self._memory_index] = x[0] # x_glbを保存（代入でコピーされる）
+        else:
+            # 複数の環境でまとめて話す場合（RolloutEngine）
+            # buffer_sizeより多い場合は、1つずつ書いたときに残る最後のbuffer_size個だけを書く（indexが重複しないように）
+            skip = max(len(x) - self.buffer_size, 0)
+            index = (self._memory_index + skip + torch.arange(len(x) - skip, device=x.device)) % self.buffer_size
+            self.speaker_memory[index] = x[skip:]
+        self._memory_index = (self._memory_index + len(x)) % self.buffer_size # リングバッファにする
+        return message, label
 
     def loss(self):
         x = self.speaker_memory
         p = self._encoder(x)
-        label = torch.argmax(p, dim=-1)
-        m = F.one_hot(label, num_classes=self.m_tokens) - p.detach() + p
+        m, _ = StraightThroughArgmax.apply(p)
         y = self._decoder(m)
         return -entropy(torch.mean(p, dim=0)), torch.mean((x-y)**2)
 
@@ -594,24 +1055,105 @@ class LWMAgent:
                  num_state=81, z_dim=8, m_tokens=2, m_length=10, beta_dim=10, 
                  num_action=4, gamma=0.99, message_prob=0.5, 
                  vae_lr=2e-4, lbn_lr=2e-6, ctrl_lr=4e-4, speaker_lr=5e-5, eps=1e-4, 
-                 lmd_ent=0.05, lmd_v=0.1):
+                 lmd_ent=0.05, lmd_v=0.1, token_message=False, listener_mode='eager',
+                 seed=None, noise_seed=None, noise_pool_size=0, amp_dtypes=None,
+                 lbn_hidden_dim=1000, lbn_rank=None, lbn_rnn_type='lstm', profiler=None,
+                 replay_capacity=0, replay_prioritized=False, world_model_batch_size=16, world_model_updates=1,
+                 latent_cache=False, advantage_estimator='mc', gae_lambda=0.95, n_step=5,
+                 controller_mode='a2c', ppo_episodes=8, ppo_epochs=4, ppo_minibatch_size=64, ppo_clip=0.2,
+                 message_schedule=None, importance_clip=1.0):
+        '''
+        token_message : TrueのときはmessageをトークンのままLBNに渡す（1-hotを作らずembeddingとして引く）
+                        m_dimが小さいとCPUでは1-hotとの行列積の方が速いので、デフォルトはFalse
+        listener_mode : テスト時の聞き手の1ステップの実行方法 ('eager', 'script', 'compile')
+        seed : 指定すると重みの初期値、messageを送るか、行動、VAE_Seq・LBNのノイズ、ReplayBuffer・PPOのサンプリングの乱数を
+               部品ごとに専用のGeneratorで作る（グローバルな乱数は使わないので、同じseedなら結果が再現される）
+               int または np.random.SeedSequence. Noneの場合は今まで通りグローバルな乱数を使う
+        noise_seed : VAE_Seq, LBNの再パラメータ化トリックのノイズのseed（テストで乱数を固定したい場合. seedより優先する）
+        noise_pool_size : 0より大きい場合、ノイズをこの個数分まとめて作っておく
+        amp_dtypes : モジュールごとの低精度演算の型. 例 {'lbn': 'bfloat16'}
+                     キーは'vae', 'lbn', 'controller', 'speaker'. 重みとlossの計算はfloat32のまま
+        lbn_hidden_dim, lbn_rank, lbn_rnn_type : LBNの中間層のユニット数, dense_enc2の低ランク分解のランク, Decoderの再帰層
+        profiler : 処理時間の内訳を記録するProfiler（Noneの場合は記録しない）
+        replay_capacity : 0より大きい場合、この個数までのepisodeをReplayBufferに保存し、VAE_SeqとLBNはそこからサンプリングしたepisodeで学習する
+                          （Controllerは今まで通り直近のepisodeで学習する）
+        replay_prioritized : TrueのときはLBNの再構成誤差を優先度としてサンプリング・削除する
+        world_model_batch_size : VAE_SeqとLBNの1回の更新に使うepisode数
+        world_model_updates : 1 episodeあたりのVAE_SeqとLBNの更新回数
+        latent_cache : TrueのときはテストでVAE_Seq._encoderの出力を部分観測ごとにキャッシュする（lwm_optimizerのstepで無効になる）
+        advantage_estimator : Controllerのadvantageの推定方法 ('mc', 'gae', 'nstep'). gae_lambda, n_stepはそのパラメータ
+        controller_mode : 'a2c'のときは毎episode、そのepisodeでControllerを1回更新する
+                          'ppo'のときはppo_episodes個のepisodeを溜めて、clipした目的関数(PPO)でppo_epochs回、minibatchごとに更新する
+                          （Controllerの入力(z, beta)は行動選択時のものを使うので、ControllerのlossはVAE_Seq, LBNには流れない）
+        message_schedule : t>0でmessageを送るタイミング. {'type': 'probability'/'interval'/'uncertainty'/'gate', その他の引数}
+                           またはMessageSchedule（message_schedule.py）. Noneの場合は今まで通り確率message_probで送る
+        importance_clip : update_packedのa2cで、前の重みで選んだ行動の方策勾配に掛ける重要度重み(今の確率/選んだときの確率)の上限
+        '''
         super().__init__()
         self.env = env
         self.gamma = gamma  # 割引率
         self.beta_last = None # 最後にメッセージが送られた時のbetaを保存
 
-        self.vae = VAE_Seq(z_dim=z_dim).to(device)
-        self.lbn = LBN(T, z_dim=z_dim, m_dim=m_tokens*m_length, beta_dim=beta_dim).to(device)
-        self.controller = Controller(z_dim=z_dim, beta_dim=beta_dim, num_action=num_action).to(device)
-        self.speaker = Speaker(m_tokens=m_tokens, m_length=m_length).to(device)
+        seeds = component_seeds(seed) if seed is not None else None
+        # 重みの初期値. seedがある場合はグローバルな乱数の状態を変えずに専用のseedで初期化する
+        with torch.random.fork_rng(devices=[], enabled=seeds is not None):
+            if seeds is not None:
+                torch.manual_seed(seeds['init'])
+            self.vae = VAE_Seq(z_dim=z_dim).to(device)
+            self.lbn = LBN(T, z_dim=z_dim, m_dim=m_tokens*m_length, beta_dim=beta_dim, m_tokens=m_tokens,
+                           hidden_dim=lbn_hidden_dim, rank=lbn_rank, rnn_type=lbn_rnn_type).to(device)
+            self.controller = Controller(z_dim=z_dim, beta_dim=beta_dim, num_action=num_action).to(device)
+            self.speaker = Speaker(m_tokens=m_tokens, m_length=m_length).to(device)
+            # 学習するスケジュールの重みもseedで初期化する
+            self.message_schedule = make_schedule(message_schedule, message_prob)
+            self.message_schedule.bind(self)
+        if noise_seed is None and seeds is not None:
+            self.vae.noise = NoiseSource(seed=seeds['vae_noise'], pool_size=noise_pool_size)
+            self.lbn.noise = NoiseSource(seed=seeds['lbn_noise'], pool_size=noise_pool_size)
+        elif noise_seed is not None or noise_pool_size > 0:
+            self.vae.noise = NoiseSource(seed=noise_seed, pool_size=noise_pool_size)
+            self.lbn.noise = NoiseSource(seed=None if noise_seed is None else noise_seed + 1, pool_size=noise_pool_size)
+        # messageを送るかの乱数（np.random.Generator. seedがない場合はnp.randomモジュール）と、行動・サンプリングのtorch.Generator
+        make_generator = lambda name, generator_device: (
+            None if seeds is None else torch.Generator(device=generator_device).manual_seed(seeds[name]))
+        self.rng = np.random if seeds is None else np.random.default_rng(seeds['message'])
+        self.action_generator = make_generator('action', device)
+        self.ppo_generator = make_generator('ppo', device)
+        self.listener = CompiledListenerStep(ListenerStep(self.vae, self.lbn, self.controller), mode=listener_mode, token_message=token_message)
 
         self.vae_memory = [] # xの記憶(VAEの学習のため)
         self.ctrl_memory = []  # （報酬，選択した行動の確率，行動確率, 状態価値, 終了したか）のtupleをlistで保存(Controllerの学習のため)
 
         self.lmd_ent = lmd_ent # Controllerのlossにおける、エントロピーによる損失の係数
         self.lmd_v = lmd_v # Controllerのlossにおける、価値関数のMSEの係数
-
-        self.message_prob = message_prob # messageが送られる確率
+        if advantage_estimator not in ('mc', 'gae', 'nstep'):
+            raise Exception("'advantage_estimator' must be 'mc', 'gae' or 'nstep'!")
+        self.advantage_estimator = advantage_estimator
+        self.gae_lambda = gae_lambda
+        self.n_step = n_step
+        if controller_mode not in ('a2c', 'ppo'):
+            raise Exception("'controller_mode' must be 'a2c' or 'ppo'!")
+        self.controller_mode = controller_mode
+        self.ppo_episodes = ppo_episodes
+        self.ppo_epochs = ppo_epochs
+        self.ppo_minibatch_size = ppo_minibatch_size
+        self.ppo_clip = ppo_clip
+        self.importance_clip = importance_clip
+        self.action_memory = [] # 選択した行動の記憶(PPOのため)
+        self.rollouts = [] # PPOの更新を待っているepisode
+        self._ctrl_losses = None # PPOの最後の更新でのControllerのloss
+
+        self.message_prob = message_prob # messageが送られる確率（message_scheduleを指定しない場合）
+        self.token_message = token_message
+        self.message_tokens = None # このステップで送られたmessageのトークン列（送られていない場合はNone）
+        self.message_last = None # 最後に送られたmessage（LBNに渡す形）
+        self.profiler = Profiler() if profiler is None else profiler
+        self.gradient_hook = None # optimizerの更新の前に呼ばれる関数 f(optimizer). 分散学習で勾配を平均するのに使う
+        self.replay = None
+        if replay_capacity > 0:
+            self.replay = ReplayBuffer(replay_capacity, prioritized=replay_prioritized, generator=make_generator('replay', 'cpu'))
+        self.world_model_batch_size = world_model_batch_size
+        self.world_model_updates = world_model_updates
 
         # オプティマイザの宣言
         self.lwm_optimizer = torch.optim.Adam([
@@ -620,71 +1162,312 @@ class LWMAgent:
                                               {'params': self.controller.parameters(), 'lr': ctrl_lr},
                                               ], lr=vae_lr, eps=eps)
         self.speaker_optimizer = torch.optim.Adam(self.speaker.parameters(), lr=speaker_lr, eps=eps)
+        self.latent_cache = None
+        if latent_cache:
+            self.latent_cache = LatentCache(self.vae)
+            self.latent_cache.watch(self.lwm_optimizer)
+
+        # 混合精度. float16は勾配がアンダーフローしやすいのでlossをスケーリングする（bfloat16は不要）
+        self.amp_dtypes = {name: getattr(torch, dtype) if isinstance(dtype, str) else dtype
+                           for name, dtype in (amp_dtypes or {}).items()}
+        for name in self.amp_dtypes:
+            if name not in ('vae', 'lbn', 'controller', 'speaker'):
+                raise Exception("unknown module '%s' in 'amp_dtypes'" % name)
+        uses_fp16 = lambda names: any(self.amp_dtypes.get(name) == torch.float16 for name in names)
+        self.lwm_scaler = torch.amp.GradScaler(device.type, enabled=uses_fp16(('vae', 'lbn', 'controller')))
+        self.speaker_scaler = torch.amp.GradScaler(device.type, enabled=uses_fp16(('speaker',)))
 
         # スケジューラーの宣言
         #self.speaker_scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(self.speaker_optimizer, 200000, eta_min=1e-6, last_epoch=-1, verbose = False)
 
     # パラメタを更新
-    def update(self):
-        # VAEのloss
-        vae_memory = torch.squeeze(torch.stack(self.vae_memory))
-        vae_kl, vae_reconst = self.vae.loss(vae_memory)
-        vae_loss = vae_kl + vae_reconst
-
-        # LBNのloss
-        lbn_kl, lbn_reconst = self.lbn.loss()
-        lbn_loss = lbn_kl + lbn_reconst
+    def update(self, episodes=None):
+        '''
+        episodes : RolloutEngineが集めたPackedEpisodes. Noneの場合は記憶している直近の1 episodeで更新する
+        '''
+        if episodes is not None:
+            return self.update_packed(episodes)
+        profiler = self.profiler
+        if self.replay is None:
+            # VAEのloss
+            with profiler.section('vae.loss'):
+                vae_memory = torch.squeeze(torch.stack(self.vae_memory))
+                with self.autocast('vae'):
+                    vae_kl, vae_reconst = self.vae.loss(vae_memory)
+                vae_loss = vae_kl + vae_reconst
+
+            # LBNのloss
+            with profiler.section('lbn.loss'):
+                with self.autocast('lbn'):
+                    lbn_kl, lbn_reconst = self.lbn.loss()
+                lbn_loss = lbn_kl + lbn_reconst
+        else:
+            # 今回のepisodeをバッファに入れ、VAE・LBNのlossはバッファからサンプリングしたepisodeで計算する
+            with profiler.section('replay.add'):
+                message_mask = torch.zeros(len(self.vae_memory), dtype=torch.bool)
+                message_mask[self.lbn.t_memory] = True
+                self.replay.add(torch.cat(self.vae_memory), torch.cat(self.lbn.m_memory), message_mask)
+            vae_loss, lbn_kl, lbn_reconst = self.world_model_loss()
+            lbn_loss = lbn_kl + lbn_reconst
 
         # Actor-CriticでControllerのlossを計算
-        R = 0
-        actor_loss = 0
-        critic_loss = 0
-        entropy_loss = 0
-        # エピソード内の各ステップの収益を後ろから計算（方策の良さの指標fをR-vとして, 方策勾配で目的関数を最大化していく）
-        for r, prob, action_probs, v in self.ctrl_memory[::-1]:
-            R = r + self.gamma * R 
-            advantage = R - v # 状態価値関数
-            actor_loss -= torch.log(prob) * advantage.detach() # 負の方策勾配(detach()することでactor側の勾配がcritic側に伝わるのを防ぐ)
-            critic_loss += F.smooth_l1_loss(v, torch.tensor(R).to(device)) # 状態価値関数のloss(元論文ではMSE)
-            entropy_loss += entropy(action_probs) # 探索を活発にするための項、最大化したい
-        actor_loss = actor_loss / len(self.ctrl_memory)
-        critic_loss = critic_loss / len(self.ctrl_memory)
-        entropy_loss = entropy_loss / len(self.ctrl_memory)
-        ctrl_loss = actor_loss + self.lmd_v * critic_loss - self.lmd_ent * entropy_loss
-
-        lwm_loss = vae_loss + lbn_loss + ctrl_loss
-        self.lwm_optimizer.zero_grad()
-        lwm_loss.backward()
-        self.lwm_optimizer.step()
+        with profiler.section('controller.loss'):
+            rewards = torch.tensor([[r for r, _, _, _ in self.ctrl_memory]], dtype=torch.float, device=device)
+            probs = torch.stack([prob for _, prob, _, _ in self.ctrl_memory]).view(1, -1)
+            action_probs = torch.stack([action_prob for _, _, action_prob, _ in self.ctrl_memory]).unsqueeze(0)
+            values = torch.stack([v for _, _, _, v in self.ctrl_memory]).view(1, -1)
+            mask = torch.ones_like(rewards, dtype=torch.bool)
+            if self.controller_mode == 'a2c':
+                actor_loss, critic_loss, entropy_loss = self.controller_loss(rewards, probs, action_probs, values, mask)
+                ctrl_loss = actor_loss + self.lmd_v * critic_loss - self.lmd_ent * entropy_loss
+            else:
+                # PPOではここでは更新せず、行動選択時の入力・確率・状態価値を勾配を切って溜めておく
+                self.rollouts.append((
+                    torch.cat(self.lbn.z_memory).detach(), torch.cat(self.lbn.beta_memory).detach(),
+                    torch.tensor(self.action_memory, device=device), torch.log(probs[0]).detach(),
+                    values[0].detach(), rewards[0]))
+                ctrl_loss = 0
+
+        with profiler.section('lwm.optimizer'):
+            lwm_loss = vae_loss + lbn_loss + ctrl_loss
+            self.optimizer_step(self.lwm_optimizer, self.lwm_scaler, lwm_loss)
+
+        if self.controller_mode == 'ppo':
+            if len(self.rollouts) >= self.ppo_episodes:
+                self._ctrl_losses = self.ppo_update()
+                self.rollouts = []
+            if self._ctrl_losses is None:
+                self._ctrl_losses = (torch.zeros(()), torch.zeros(()), torch.zeros(()))
+            actor_loss, critic_loss, entropy_loss = self._ctrl_losses
+
+        # 2回目以降のVAE・LBNの更新（Controllerの勾配はないので更新されない）
+        if self.replay is not None:
+            for _ in range(self.world_model_updates - 1):
+                vae_loss, lbn_kl, lbn_reconst = self.world_model_loss()
+                with profiler.section('lwm.optimizer'):
+                    self.optimizer_step(self.lwm_optimizer, self.lwm_scaler, vae_loss + lbn_kl + lbn_reconst)
 
         # Speaker
-        speaker_negent, speaker_rec = self.speaker.loss()
-        speaker_loss = speaker_negent + speaker_rec
-        self.speaker_optimizer.zero_grad()
-        speaker_loss.backward()
-        self.speaker_optimizer.step()
-        #self.speaker_scheduler.step()
+        with profiler.section('speaker.loss'):
+            with self.autocast('speaker'):
+                speaker_negent, speaker_rec = self.speaker.loss()
+            speaker_loss = speaker_negent + speaker_rec
+        with profiler.section('speaker.optimizer'):
+            self.optimizer_step(self.speaker_optimizer, self.speaker_scaler, speaker_loss)
+            #self.speaker_scheduler.step()
+
+        # messageを送るタイミングを学習するスケジュール
+        if self.message_schedule.trainable:
+            with profiler.section('message_schedule.update'):
+                z = torch.cat(self.lbn.z_memory)
+                message_mask = torch.zeros(len(z), dtype=torch.bool, device=z.device)
+                message_mask[self.lbn.t_memory] = True
+                self.message_schedule.update(z, torch.cat(self.lbn.beta_memory), message_mask, rewards[0],
+                                             torch.tensor([0, len(z)], device=z.device))
 
         return vae_loss, lbn_kl, lbn_reconst, actor_loss, critic_loss, entropy_loss, speaker_negent, speaker_rec
     
+    def update_packed(self, episodes):
+        '''
+        複数のepisode(PackedEpisodes)でまとめて1回更新する. 返り値はupdate()と同じ
+        列は observations, message_mask, messages（VAE_Seq, LBN）と z, beta, actions, rewards, log_probs（Controller）を使う
+        Controllerの入力(z, beta)は行動選択時のものを使う
+        RolloutEngineは余ったepisodeと途中のepisodeを次のcollectに持ち越すので、前の更新より前の重みで選んだ行動が混ざる
+        （方策はoff-policy）. log_probs(選んだときの行動の対数確率)があれば、a2cでは今の確率との比をimportance_clipで
+        切った重要度重みを方策勾配に掛け、ppoでは古い方策の確率として使う. message_scheduleの更新は補正しない
+        '''
+        profiler = self.profiler
+        if self.replay is None:
+            vae_loss, lbn_kl, lbn_reconst = self.world_model_loss(episodes)
+        else:
+            with profiler.section('replay.add'):
+                for i in range(len(episodes)):
+                    episode = episodes.episode(i)
+                    self.replay.add(episode['observations'], episode['messages'], episode['message_mask'])
+            vae_loss, lbn_kl, lbn_reconst = self.world_model_loss()
+        lbn_loss = lbn_kl + lbn_reconst
+
+        with profiler.section('controller.loss'):
+            with self.autocast('controller'):
+                action_prob, value = self.controller(episodes.z, episodes.beta)
+            prob = action_prob.gather(1, episodes.actions[:, None]).squeeze(1)
+            # advantageの計算だけはepisodeごとに並べ直す（ステップごとの値だけなので小さい）
+            rewards, mask = episodes.to_padded(episodes.rewards)
+            probs, _ = episodes.to_padded(prob)
+            action_probs, _ = episodes.to_padded(action_prob)
+            values, _ = episodes.to_padded(value.squeeze(1))
+            behaviour_log_prob = episodes.columns.get('log_probs')
+            if self.controller_mode == 'a2c':
+                weights = None
+                if behaviour_log_prob is not None:
+                    ratio = torch.exp(torch.log(prob).detach().float() - behaviour_log_prob.float())
+                    weights, _ = episodes.to_padded(ratio.clamp(max=self.importance_clip))
+                actor_loss, critic_loss, entropy_loss = self.controller_loss(rewards, probs, action_probs, values, mask, weights)
+                ctrl_loss = actor_loss + self.lmd_v * critic_loss - self.lmd_ent * entropy_loss
+            else:
+                log_prob = torch.log(prob).detach() if behaviour_log_prob is None else behaviour_log_prob
+                value = value.squeeze(1).detach()
+                for i in range(len(episodes)):
+                    start, end = int(episodes.offsets[i]), int(episodes.offsets[i + 1])
+                    self.rollouts.append((episodes.z[start:end], episodes.beta[start:end], episodes.actions[start:end],
+                                          log_prob[start:end], value[start:end], episodes.rewards[start:end]))
+                ctrl_loss = 0
+
+        with profiler.section('lwm.optimizer'):
+            self.optimizer_step(self.lwm_optimizer, self.lwm_scaler, vae_loss + lbn_loss + ctrl_loss)
+
+        if self.controller_mode == 'ppo':
+            if len(self.rollouts) >= self.ppo_episodes:
+                self._ctrl_losses = self.ppo_update()
+                self.rollouts = []
+            if self._ctrl_losses is None:
+                self._ctrl_losses = (torch.zeros(()), torch.zeros(()), torch.zeros(()))
+            actor_loss, critic_loss, entropy_loss = self._ctrl_losses
+
+        if self.replay is not None:
+            for _ in range(self.world_model_updates - 1):
+                vae_loss, lbn_kl, lbn_reconst = self.world_model_loss()
+                with profiler.section('lwm.optimizer'):
+                    self.optimizer_step(self.lwm_optimizer, self.lwm_scaler, vae_loss + lbn_kl + lbn_reconst)
+
+        with profiler.section('speaker.loss'):
+            with self.autocast('speaker'):
+                speaker_negent, speaker_rec = self.speaker.loss()
+            speaker_loss = speaker_negent + speaker_rec
+        with profiler.section('speaker.optimizer'):
+            self.optimizer_step(self.speaker_optimizer, self.speaker_scaler, speaker_loss)
+
+        if self.message_schedule.trainable:
+            with profiler.section('message_schedule.update'):
+                self.message_schedule.update(episodes.z, episodes.beta, episodes.message_mask, episodes.rewards, episodes.offsets)
+
+        return vae_loss, lbn_kl, lbn_reconst, actor_loss, critic_loss, entropy_loss, speaker_negent, speaker_rec
+
+    def controller_loss(self, rewards, probs, action_probs, values, mask, weights=None):
+        '''
+        episodeのbatchについてActor-Criticのlossを計算する. いずれも1ステップあたりの平均
+            rewards, probs(選択した行動の確率), values : (episode数, 最大ステップ数)
+            action_probs : (episode数, 最大ステップ数, 行動数)
+            mask : 有効なステップはTrue (episode数, 最大ステップ数)
+            weights : 方策勾配に掛ける重要度重み (episode数, 最大ステップ数). Noneの場合は1
+        '''
+        advantages, returns = estimate_advantages(rewards, values, mask, self.gamma, self.advantage_estimator,
+                                                  lmd=self.gae_lambda, n_step=self.n_step)
+        mask = mask.to(values.dtype)
+        num_steps = mask.sum()
+        # 負の方策勾配(advantageは勾配を流さないので、actor側の勾配がcritic側に伝わらない)
+        if weights is not None:
+            advantages = advantages * weights
+        actor_loss = -(torch.log(probs) * advantages * mask).sum() / num_steps
+        # 状態価値関数のloss(元論文ではMSE)
+        critic_loss = (F.smooth_l1_loss(values, returns, reduction='none') * mask).sum() / num_steps
+        # 探索を活発にするための項、最大化したい
+        entropy_loss = entropy(action_probs * mask.unsqueeze(-1)) / num_steps
+        return actor_loss, critic_loss, entropy_loss
+
+    def optimizer_step(self, optimizer, scaler, loss):
+        '''
+        lossの勾配を計算してoptimizerで更新する. gradient_hookがあれば更新の前に勾配を渡す
+        '''
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        if self.gradient_hook is not None:
+            self.gradient_hook(optimizer)
+        scaler.step(optimizer)
+        scaler.update()
+
+    def ppo_update(self):
+        '''
+        溜めたepisodeでControllerをPPO(clipした目的関数)で更新し、最後のminibatchの(actor, critic, entropy)のlossを返す
+        '''
+        profiler = self.profiler
+        with profiler.section('ppo.batch'):
+            lengths = torch.tensor([len(rewards) for *_, rewards in self.rollouts])
+            valid = torch.arange(int(lengths.max()))[None] < lengths[:, None]
+            pad = lambda tensors: nn.utils.rnn.pad_sequence(tensors, batch_first=True)
+            z, beta, actions, old_log_probs, old_values, rewards = [pad(list(tensors)) for tensors in zip(*self.rollouts)]
+            valid = valid.to(rewards.device)
+            advantages, returns = estimate_advantages(rewards, old_values, valid, self.gamma, self.advantage_estimator,
+                                                      lmd=self.gae_lambda, n_step=self.n_step)
+            # 有効なステップだけを並べる
+            z, beta, actions, old_log_probs, advantages, returns = (
+                tensor[valid] for tensor in (z, beta, actions, old_log_probs, advantages, returns))
+            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+
+        num_steps = len(actions)
+        for _ in range(self.ppo_epochs):
+            for index in torch.randperm(num_steps, device=actions.device, generator=self.ppo_generator).split(self.ppo_minibatch_size):
+                with profiler.section('ppo.loss'):
+                    with self.autocast('controller'):
+                        action_probs, values = self.controller(z[index], beta[index])
+                    log_probs = torch.log(action_probs.gather(1, actions[index, None]).squeeze(1))
+                    ratio = torch.exp(log_probs - old_log_probs[index])
+                    clipped = torch.clamp(ratio, 1 - self.ppo_clip, 1 + self.ppo_clip)
+                    actor_loss = -torch.min(ratio * advantages[index], clipped * advantages[index]).mean()
+                    critic_loss = F.smooth_l1_loss(values.squeeze(1), returns[index])
+                    entropy_loss = entropy(action_probs) / len(index)
+                    ctrl_loss = actor_loss + self.lmd_v * critic_loss - self.lmd_ent * entropy_loss
+                with profiler.section('ppo.optimizer'):
+                    self.optimizer_step(self.lwm_optimizer, self.lwm_scaler, ctrl_loss)
+        return actor_loss.detach(), critic_loss.detach(), entropy_loss.detach()
+
+    def world_model_loss(self, episodes=None):
+        '''
+        episodes(PackedEpisodes)、Noneの場合はReplayBufferからサンプリングしたworld_model_batch_size個のepisodeについて、
+        VAEのloss, LBNのKL, 再構成誤差を返す
+        '''
+        profiler = self.profiler
+        indices = None
+        if episodes is None:
+            with profiler.section('replay.sample'):
+                indices, episodes = self.replay.sample(self.world_model_batch_size)
+        x = episodes.observations # 全episodeの全ステップの部分観測 (ステップ数の合計, 3, 9, 9)
+
+        with profiler.section('vae.loss'):
+            with self.autocast('vae'):
+                vae_kl, vae_reconst = self.vae.loss(x)
+            vae_loss = vae_kl + vae_reconst
+
+        with profiler.section('lbn.loss'):
+            # LBNの入力のzは、行動選択のときと同じくVAEからサンプリングする（VAEには勾配を流さない）
+            with torch.no_grad(), self.autocast('vae'):
+                _, z = self.vae(x)
+            with self.autocast('lbn'):
+                lbn_kl, lbn_reconst = self.lbn.packed_loss(z, episodes.messages, episodes.message_mask, episodes.offsets,
+                                                           reduction='none')
+            if indices is not None and self.replay.prioritized:
+                self.replay.update_priorities(indices, lbn_reconst)
+
+        return vae_loss, lbn_kl, lbn_reconst.mean()
+
     # softmaxの出力が最も大きい行動を選択（テスト時）
     def get_greedy_action(self, t, env):
         '''
         t : 時刻（=ステップ数）
         state : 聞き手の位置（row, column）
         '''
-        x_part = env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 聞き手による部分観測
-        x_glb = env.observation(partial=False).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 話し手による全体観測
-        _, z = self.vae(x_part)
-        if t == 0 or np.random.rand()<self.message_prob: # t=0の時にはメッセージが送られ、その後は確率message_probでメッセージが送られる
-            m = self.speaker(x_glb)
-            m = m.view(1,-1)
+        observe = lambda: env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 聞き手による部分観測
+        z = None
+        if t > 0 and self.message_schedule.needs_latent:
+            # スケジュールの判断にはノイズを加えないzを使う
+            with torch.no_grad():
+                z, _ = self.vae._encoder(observe())
+        if self.send_message(t, z): # t=0の時にはメッセージが送られ、その後はmessage_scheduleが決める
+            x_glb = env.observation(partial=False).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 話し手による全体観測
+            m = self.speak(x_glb)
         else: # メッセージが送られない時
             m = None
-        beta = self.lbn(z, m, self.beta_last, t)
+            self.message_tokens = None
+        # テスト時は学習しないので、LBNに記憶させずにV → M → Cをまとめて実行する
+        with torch.no_grad():
+            if self.latent_cache is None:
+                _, beta, action_prob, _ = self.listener(observe(), m, self.beta_last)
+            else:
+                # 同じ部分観測では部分観測の描画とVAE_Seqの畳み込みを省く
+                mean, std = self.latent_cache.encode(env.observation_key(partial=True), observe)
+                _, beta, action_prob, _ = self.listener.step.from_latent(mean, std, m, self.beta_last)
         self.beta_last = beta
-        action_prob, _ = self.controller(z, self.beta_last)
-        action = torch.argmax(action_prob.squeeze().data).item()
+        action = torch.argmax(action_prob.squeeze()).item()
         
         return action
     
@@ -694,23 +1477,75 @@ class LWMAgent:
         t : 時刻（=ステップ数）
         state : 聞き手の状態State(row, column)
         '''
-        x_part = env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 聞き手による部分観測
-        x_glb = env.observation(partial=False).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 話し手による全体観測
+        profiler = self.profiler
+        with profiler.section('env.observation'):
+            x_part = env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 聞き手による部分観測
+            x_glb = env.observation(partial=False).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device) # 話し手による全体観測
         self.add_vae_memory(x_part) 
-        _, z = self.vae(x_part)
-        if t == 0 or np.random.rand()<self.message_prob: # t=0の時にはメッセージが送られ、その後は確率message_probでメッセージが送られる
-            m = self.speaker(x_glb)
-            m = m.view(1,-1)
+        with profiler.section('vae.forward'), self.autocast('vae'):
+            _, z = self.vae(x_part)
+        if self.send_message(t, z): # t=0の時にはメッセージが送られ、その後はmessage_scheduleが決める
+            with profiler.section('speaker.forward'):
+                m = self.speak(x_glb)
         else: # メッセージが送られない時
             m = None
-        beta = self.lbn(z, m, self.beta_last, t)
+            self.message_tokens = None
+        with profiler.section('lbn.forward'), self.autocast('lbn'):
+            beta = self.lbn(z, m, self.beta_last, t)
         self.beta_last = beta
-        action_prob, state_value = self.controller(z, self.beta_last)
-        action_prob, state_value = action_prob.squeeze(), state_value.squeeze()
-        action = Categorical(action_prob).sample().item()
+        with profiler.section('controller.forward'):
+            with self.autocast('controller'):
+                action_prob, state_value = self.controller(z, self.beta_last)
+            action_prob, state_value = action_prob.squeeze(), state_value.squeeze()
+            action = torch.multinomial(action_prob, 1, True, generator=self.action_generator).item()
+        self.action_memory.append(action)
 
         return action, action_prob[action], state_value, action_prob # action_probはControllerのlossにおけるエントロピーの項を計算するのに用いる
 
+    def send_message(self, t, z):
+        '''
+        時刻tにmessageを送るか（message_scheduleで決める）. z : 今の部分観測のz (1, z_dim)
+        '''
+        return self.message_schedule.decide_one(t, z, self.beta_last, self.message_last)
+
+    def speak(self, x_glb):
+        '''
+        話し手が全体観測からmessageを作り、LBNに渡す形にして返す
+        '''
+        # Speakerの学習は自身のlossのみで行われ、LBN側から流れる勾配は使われないので計算グラフを作らない
+        with torch.no_grad(), self.autocast('speaker'):
+            message, tokens = self.speaker(x_glb)
+        self.message_tokens = tokens # 記録用に最後に送ったmessageのトークン列を覚えておく
+        self.message_last = tokens if self.token_message else message.view(1,-1)
+        return self.message_last
+
+    def networks(self):
+        '''
+        学習するモジュールを名前つきで返す（重みの共有・保存用）
+        '''
+        networks = {'vae': self.vae, 'lbn': self.lbn, 'controller': self.controller, 'speaker': self.speaker}
+        if self.message_schedule.module is not None:
+            networks['message_gate'] = self.message_schedule.module
+        return networks
+
+    def optimizers(self):
+        '''
+        重み以外の学習の状態(optimizer, GradScaler, 学習するスケジュール)を名前つきで返す（checkpointの保存用）
+        いずれもstate_dict()とload_state_dict()を持つ
+        '''
+        optimizers = {'lwm_optimizer': self.lwm_optimizer, 'speaker_optimizer': self.speaker_optimizer,
+                      'lwm_scaler': self.lwm_scaler, 'speaker_scaler': self.speaker_scaler}
+        if self.message_schedule.trainable:
+            optimizers['message_schedule'] = self.message_schedule
+        return optimizers
+
+    def autocast(self, name):
+        '''
+        amp_dtypesでnameのモジュールに低精度の型が指定されていればautocastを有効にする
+        '''
+        dtype = self.amp_dtypes.get(name)
+        return torch.autocast(device_type=device.type, dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
     def add_vae_memory(self, x):    
         self.vae_memory.append(x)
 
@@ -720,91 +1555,15 @@ class LWMAgent:
     def reset_memory(self):
         self.vae_memory = []
         self.ctrl_memory = []
+        self.action_memory = []
         self.lbn.reset_memory()
 
 """## 4 学習
 """
 
-num_episode = 200000  # 学習エピソード数
-T = 56 # エピソードの最大ステップ数
-env = Environment(grid_type='A') # 環境
-agent = LWMAgent(env, T) # モデルの定義
-
-# ログ
-writer = SummaryWriter(log_dir="./logs") # TensorBoardの設定
-test_interval = 100
-log_interval = 5000
-success_rate = 0
-test_success_rate = 0
-best_success_rate = 0
-
-for episode in tqdm(range(num_episode)):
-    env.reset()
-    for t in range(T):
-        action, prob, state_value, action_prob = agent.get_action(t, env)  #  行動を選択
-        next_state, reward, done = env.step(action)
-        agent.add_ctrl_memory(reward, prob, action_prob, state_value)
-        #　エピソードが終了、エピソードの最大ステップ数に到達したら
-        if done or t==T-1:
-            if done:
-                success_rate += 1
-            vae_loss, lbn_kl, lbn_reconst, actor_loss, critic_loss, entropy_loss, speaker_negent, speaker_rec = agent.update()
-            agent.reset_memory() # パラメタが更新されているので
-            break
-
-    # テスト 探索ノイズなしでの性能を評価する
-    if (episode + 1) % test_interval == 0:
-        env.reset()
-        for t in range(T):
-            action = agent.get_greedy_action(t, env)  #  行動を選択
-            next_state, reward, done = env.step(action)
-            #　エピソードが終了、エピソードの最大ステップ数に到達したら
-            if done or t==T-1:
-                if done:
-                    test_success_rate += 1
-                agent.reset_memory()
-                break
-        
-    # 記録する
-    writer.add_scalar("t", t, episode+1)
-    writer.add_scalar("vae loss", vae_loss.item(), episode+1)
-    writer.add_scalar("lbn kl", lbn_kl.item(), episode+1)
-    writer.add_scalar("lbn reconst", lbn_reconst.item(), episode+1)
-    writer.add_scalar("actor loss", actor_loss.item(), episode+1)
-    writer.add_scalar("critic loss", critic_loss.item(), episode+1)
-    writer.add_scalar("entropy loss", entropy_loss.item(), episode+1)
-    writer.add_scalar("speaker negent", speaker_negent.item(), episode+1)
-    writer.add_scalar("speaker rec", speaker_rec.item(), episode+1)
-
-    if (episode+1) % log_interval == 0:
-        success_rate /= log_interval
-        test_success_rate /= (log_interval / test_interval)
-
-        writer.add_scalar("success rate", success_rate, episode+1)
-        writer.add_scalar("test success rate", test_success_rate, episode+1)
-
-        print("Episode %d finished | Success rate %f" % (episode+1, success_rate))
-        print("Episode %d finished | Test success rate %f" % (episode+1, test_success_rate))
-
-        # 重みの保存
-        if best_success_rate < test_success_rate:
-            torch.save(agent.vae.state_dict(), './vae_best.pth')
-            torch.save(agent.lbn.state_dict(), './lbn_best.pth')
-            torch.save(agent.controller.state_dict(), './controller_best.pth')
-            torch.save(agent.speaker.state_dict(), './speaker_best.pth')
-            best_success_rate = test_success_rate
-        else:
-            torch.save(agent.vae.state_dict(), './vae_last.pth')
-            torch.save(agent.lbn.state_dict(), './lbn_last.pth')
-            torch.save(agent.controller.state_dict(), './controller_last.pth')
-            torch.save(agent.speaker.state_dict(), './speaker_last.pth')
-            best_success_rate = test_success_rate              
-
-        success_rate = 0
-        test_success_rate = 0
-
-# writerを閉じる
-writer.close()
-
-        # Commented out IPython magic to ensure Python compatibility.
-        # %tensorboard --logdir='./logs'
+if __name__ == '__main__':
+    # 学習の設定(num_episode, T, LWMAgentの引数など)はexperiment.pyで設定ファイル・コマンドライン引数から与える
+    # 例: python LWM_expt_02.py --set T=36 --set agent.lmd_ent=0.05
+    import sys
+    from experiment import main
+    main(['train'] + sys.argv[1:])
@@ -0,0 +1,1107 @@
+# -*- coding: utf-8 -*-
+"""環境・モデルの処理時間を計測するスクリプト
+
+使い方:
+    python benchmark.py reset --num 1000000
+    python benchmark.py step [--num 1000000]
+    python benchmark.py speaker
+    python benchmark.py listener
+    python benchmark.py noise
+    python benchmark.py amp [--episodes 2000]
+    python benchmark.py lbn_width [--episodes 2000]
+    python benchmark.py trajectory [--num 10000]
+    python benchmark.py pretrain [--num 2000] [--episodes 3000]
+    python benchmark.py replay [--episodes 500]
+    python benchmark.py latent_cache [--num 200]
+    python benchmark.py advantage [--episodes 3000]
+    python benchmark.py ppo [--episodes 3000]
+    python benchmark.py weight_sync [--num 20]
+    python benchmark.py distributed [--episodes 30]
+    python benchmark.py env_server
+    python benchmark.py rollout [--episodes 6000]
+    python benchmark.py oracle [--num 2000]
+    python benchmark.py checkpoint [--num 10]
+    python benchmark.py determinism [--num 2000]
+    python benchmark.py threads [--num 32]
+    python benchmark.py message_schedule [--episodes 300] [--num 100]
+
+    # 主要な処理をまとめて計測し、JSONに保存する（同じマシンでコミット間の比較に使う）
+    python benchmark.py suite --output bench_results/$(git rev-parse --short HEAD).json [--quick]
+    python benchmark.py compare bench_results/old.json bench_results/new.json
+
+正しさの確認はtests/にある (python -m pytest tests)
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.profiler import profile, ProfilerActivity
+
+from LWM_expt_02 import (Environment, State, make_envs, LWMAgent, Speaker, StraightThroughArgmax,
+                         ListenerStep, CompiledListenerStep, LowRankLinear, entropy)
+from trajectory import TrajectoryWriter, TrajectoryReader
+from weight_sync import SharedWeights
+from distributed import launch_local
+from rollout import RolloutEngine
+from message_schedule import UncertaintySchedule
+from oracle import solve, min_horizon
+from checkpoint import CheckpointManager, read_index, select_entry
+from threads import available_cpus, cpu_share, configure_threads
+from env_server import EnvServer, REQUEST, RESPONSE, ALLOC, STEP
+from pretrain import (enumerate_partial_observations, enumerate_loader, sequence_loader, collect_trajectories,
+                      pretrain_vae, pretrain_lbn)
+
+
+def bench_reset(num=10**6, grid_type='A', seed=0):
+    '''
+    Environment.resetの1回あたりの処理時間を計測する
+    '''
+    env = Environment(grid_type=grid_type, seed=seed)
+    start = time.perf_counter()
+    for _ in range(num):
+        env.reset()
+    elapsed = time.perf_counter() - start
+    print("reset (grid %s): %.3f us/reset, %d resets" % (grid_type, elapsed / num * 1e6, num))
+    return elapsed / num
+
+
+def bench_step(num=10**6, grid_type='A', move_prob=0.8, seed=0):
+    '''
+    Environment.stepの1秒あたりのステップ数と、1ステップあたりに作られるStateの数を計測する
+    '''
+    env = Environment(grid_type=grid_type, move_prob=move_prob, seed=seed)
+    actions = np.random.default_rng(seed).integers(4, size=num).tolist()
+    start = time.perf_counter()
+    for action in actions:
+        if env.step(action)[2]:
+            env.reset()
+    elapsed = time.perf_counter() - start
+
+    # Stateの生成を数える（数えている間は遅くなるので、時間の計測とは分ける）
+    created = [0]
+    init = State.__init__
+    def counting_init(self, *args):
+        created[0] += 1
+        init(self, *args)
+    State.__init__ = counting_init
+    try:
+        for action in actions[:10000]:
+            if env.step(action)[2]:
+                env.reset()
+    finally:
+        State.__init__ = init
+    print("step (grid %s, move_prob %.1f): %.0f steps/s (%.3f us/step), %.2f States created per step" % (
+        grid_type, move_prob, num / elapsed, elapsed / num * 1e6, created[0] / min(num, 10000)))
+    return elapsed / num
+
+
+def count_allocations(fn):
+    '''
+    fnを1回実行したときのCPU上のメモリ確保の回数とバイト数を数える
+    '''
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    allocations = [e for e in prof.events() if e.cpu_memory_usage > 0]
+    return len(allocations), sum(e.cpu_memory_usage for e in allocations)
+
+def peak_memory(fn):
+    '''
+    fnの実行中にtorchが確保したCPUメモリのピーク(バイト)
+    '''
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    usage = peak = 0
+    for e in sorted(prof.events(), key=lambda e: e.time_range.start):
+        usage += e.self_cpu_memory_usage # 確保は正, 解放は負
+        peak = max(peak, usage)
+    return peak
+
+def time_per_call(fn, num, warmup=10):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(num):
+        fn()
+    return (time.perf_counter() - start) / num
+
+def _one_hot_message(p, m_tokens):
+    # 以前の実装（比較用）
+    label = torch.argmax(p, dim=-1)
+    return F.one_hot(label, num_classes=m_tokens) - p.detach() + p
+
+def bench_speaker(num=10000, m_tokens=2, m_length=10, seed=0):
+    '''
+    Speakerの出力pからmessageを作る部分(straight-through)について、メモリ確保の回数と処理時間を比べる
+    batch 1 は行動選択時のforward, batch buffer_size はSpeaker.lossに対応する
+    '''
+    torch.manual_seed(seed)
+    speaker = Speaker(m_tokens=m_tokens, m_length=m_length)
+    for batch_size in (1, speaker.buffer_size):
+        p = speaker._encoder(torch.rand(batch_size, 3, 9, 9)).detach().requires_grad_()
+        grad = torch.randn(batch_size, m_length, m_tokens)
+        cases = (
+            ('one_hot forward', lambda: _one_hot_message(p, m_tokens)),
+            ('fused forward', lambda: StraightThroughArgmax.apply(p)),
+            ('one_hot forward+backward', lambda: _one_hot_message(p, m_tokens).backward(grad)),
+            ('fused forward+backward', lambda: StraightThroughArgmax.apply(p)[0].backward(grad)),
+        )
+        for name, fn in cases:
+            allocs, nbytes = count_allocations(fn)
+            elapsed = time_per_call(fn, num)
+            print("speaker message (batch %d, %s): %d allocs, %d bytes, %.2f us/call"
+                  % (batch_size, name, allocs, nbytes, elapsed * 1e6))
+
+    # 行動選択時の Speaker -> LBN._encoder の経路全体
+    env = Environment(seed=seed)
+    x_glb = env.observation(partial=False).permute(2, 0, 1).reshape(-1, 3, 9, 9)
+    z = torch.randn(1, 8)
+    for token_message in (False, True):
+        agent = LWMAgent(env, 56, token_message=token_message)
+        fn = lambda: agent.lbn._encoder(z, agent.speak(x_glb))
+        allocs, nbytes = count_allocations(fn)
+        elapsed = time_per_call(fn, num)
+        print("speaker -> lbn encoder (token_message=%s): %d allocs, %d bytes, %.2f us/call"
+              % (token_message, allocs, nbytes, elapsed * 1e6))
+
+def bench_listener(num=1000, batch_sizes=(1, 64, 4096), seed=0):
+    '''
+    聞き手の1ステップ(V → M → C)のCPU上の処理時間を、eager / TorchScript / torch.compile で比べる
+    （出力がeagerと一致することはtests/test_listener.pyで確かめる）
+    '''
+    torch.manual_seed(seed)
+    env = Environment(seed=seed)
+    agent = LWMAgent(env, 56)
+    step = ListenerStep(agent.vae, agent.lbn, agent.controller)
+    for mode in ('eager', 'script', 'compile'):
+        compiled = CompiledListenerStep(step, mode=mode)
+        for batch_size in batch_sizes:
+            x = torch.rand(batch_size, 3, 9, 9)
+            m = torch.rand(batch_size, step.lbn.m_dim)
+            beta = torch.randn(batch_size, step.lbn.beta_dim)
+            n = max(num * 64 // max(batch_size, 64), 10)
+            with torch.no_grad():
+                with_message = time_per_call(lambda: compiled(x, m, None), n)
+                without_message = time_per_call(lambda: compiled(x, None, beta), n)
+            print("listener step (%s, batch %d): %.1f us with message, %.1f us without message"
+                  % (compiled.mode, batch_size, with_message * 1e6, without_message * 1e6))
+
+def bench_noise(num=10000, seed=0):
+    '''
+    再パラメータ化トリック(VAE_Seq._sample_z + LBN._sample_beta)の1ステップあたりのメモリ確保の回数と処理時間
+    '''
+    torch.manual_seed(seed)
+    env = Environment(seed=seed)
+    mean_z, std_z = torch.randn(1, 8), torch.rand(1, 8)
+    mean_beta, std_beta = torch.randn(1, 10), torch.rand(1, 10)
+
+    def old():
+        # 以前の実装（比較用）
+        z = mean_z + std_z * torch.randn(mean_z.shape).to(mean_z.device)
+        beta = mean_beta + std_beta * torch.randn(mean_beta.shape).to(mean_beta.device)
+        return z, beta
+
+    cases = [('randn().to(device)', None, old)]
+    for name, kwargs in (('randn_like', None), ('seeded', {'seed': seed}), ('pool', {'pool_size': 4096})):
+        agent = LWMAgent(env, 56) if kwargs is None else LWMAgent(env, 56, noise_seed=kwargs.get('seed'),
+                                                                  noise_pool_size=kwargs.get('pool_size', 0))
+        fn = (lambda agent: lambda: (agent.vae._sample_z(mean_z, std_z), agent.lbn._sample_beta(mean_beta, std_beta)))(agent)
+        cases.append((name, agent, fn))
+
+    for name, agent, fn in cases:
+        fn() # poolを作っておく
+        allocs, nbytes = count_allocations(fn)
+        elapsed = time_per_call(fn, num)
+        print("noise (%s): %d allocs, %d bytes, %.2f us/step" % (name, allocs, nbytes, elapsed * 1e6))
+
+    # 行動選択1回分(get_action)全体
+    for name, agent, _ in cases[1:]:
+        env.reset()
+        agent.get_action(0, env)
+        allocs, nbytes = count_allocations(lambda: agent.get_action(0, env))
+        agent.reset_memory()
+        print("get_action (%s): %d allocs, %d bytes" % (name, allocs, nbytes))
+
+def run_episode(agent, env, T, train=True):
+    '''
+    1 episodeを実行し、成功したかどうかを返す（学習時はupdateまで行う）
+    '''
+    env.reset()
+    for t in range(T):
+        if train:
+            action, prob, state_value, action_prob = agent.get_action(t, env)
+        else:
+            action = agent.get_greedy_action(t, env)
+        with agent.profiler.section('env.step'):
+            _, reward, done = env.step(action)
+        if train:
+            agent.add_ctrl_memory(reward, prob, action_prob, state_value)
+        if done or t == T-1:
+            if train:
+                agent.update()
+            agent.reset_memory()
+            return done
+
+def make_lbn_update(agent, env, T):
+    '''
+    最大長(T)のepisodeの記憶を作り、その記憶でLBNを1回更新する(loss + backward + optimizer.step)関数を返す
+    '''
+    env.reset()
+    for t in range(T):
+        agent.get_action(t, env)
+    # 記憶は行動選択時の計算グラフから切り離しておく（毎回同じ記憶でlossを計算するため）
+    memory = ([z.detach() for z in agent.lbn.z_memory], [m.detach() for m in agent.lbn.m_memory],
+              [beta.detach() for beta in agent.lbn.beta_memory], list(agent.lbn.t_memory))
+
+    def update():
+        agent.lbn.z_memory, agent.lbn.m_memory, agent.lbn.beta_memory, agent.lbn.t_memory = [list(m) for m in memory]
+        with agent.autocast('lbn'):
+            kl, reconst = agent.lbn.loss()
+        agent.lwm_optimizer.zero_grad()
+        agent.lwm_scaler.scale(kl + reconst).backward()
+        agent.lwm_scaler.step(agent.lwm_optimizer)
+        agent.lwm_scaler.update()
+        return kl.item(), reconst.item()
+    return update
+
+def train_success_rate(agent_kwargs, episodes, T=56, seed=0):
+    '''
+    レイアウトAでepisodes回学習し、(全体のsuccess rate, 最後の1割のepisodeのsuccess rate)を返す
+    '''
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    env = Environment(seed=seed)
+    agent = LWMAgent(env, T, **agent_kwargs)
+    successes = [run_episode(agent, env, T) for _ in range(episodes)]
+    return np.mean(successes), np.mean(successes[-max(episodes // 10, 1):])
+
+def bench_amp(num=3, T=56, episodes=0, seed=0):
+    '''
+    LBNの更新(loss + backward + optimizer.step)の処理時間とメモリのピークを、float32 / bfloat16 / float16で比べる
+    episodes > 0 の場合は、レイアウトAでその回数だけ学習したときのsuccess rateも比べる
+    '''
+    settings = (('float32', None), ('bfloat16', {'lbn': 'bfloat16'}), ('float16', {'lbn': 'float16'}))
+    for name, amp_dtypes in settings:
+        torch.manual_seed(seed)
+        env = Environment(seed=seed)
+        agent = LWMAgent(env, T, amp_dtypes=amp_dtypes)
+        update = make_lbn_update(agent, env, T)
+        try:
+            losses = update()
+        except RuntimeError as e:
+            # CPUではLSTMがfloat16に対応していないことがある
+            print("lbn update (%s, T=%d): not supported on %s (%s)" % (name, T, agent.lbn.sigma.device, str(e).splitlines()[0]))
+            continue
+        elapsed = time_per_call(update, num, warmup=1)
+        peak = peak_memory(update)
+        print("lbn update (%s, T=%d): %.1f ms, peak %.1f MB, loss kl %.4f reconst %.4f"
+              % (name, T, elapsed * 1e3, peak / 2**20, *losses))
+
+    if episodes > 0:
+        for name, amp_dtypes in settings[:2]:
+            success_rate, last_success_rate = train_success_rate({'amp_dtypes': amp_dtypes}, episodes, T, seed)
+            print("training (%s, %d episodes): success rate %.3f (last 10%% %.3f)"
+                  % (name, episodes, success_rate, last_success_rate))
+
+def lbn_flops(lbn, T, num_messages):
+    '''
+    長さTのepisode(messageをnum_messages回受け取る)に対するLBN.lossの順伝播の浮動小数点演算数の見積もり
+    (積和を2回と数える. 逆伝播はおよそその2倍)
+    '''
+    def linear(layer):
+        if isinstance(layer, LowRankLinear):
+            return linear(layer.dense_u) + linear(layer.dense_v)
+        return 2 * layer.in_features * layer.out_features
+    encoder = linear(lbn.dense_enc1) + linear(lbn.dense_enc2) + linear(lbn.dense_encmean) + linear(lbn.dense_encvar)
+    gates = 4 if isinstance(lbn.rnn, nn.LSTM) else 3
+    decoder_step = 2 * gates * lbn.rnn_hidden_dim * (lbn.rnn.input_size + lbn.rnn_hidden_dim) + linear(lbn.dense_dec)
+    # 時刻tのbetaから t ~ T-1 のzを予測するので、Decoderは全部で T(T+1)/2 ステップ回る
+    return num_messages * encoder + T * (T + 1) // 2 * decoder_step
+
+def bench_lbn_width(num=3, T=56, episodes=0, seed=0):
+    '''
+    LBNの幅・構造ごとに、パラメータ数・FLOPs・更新時間（episodes > 0 の場合はsuccess rateも）を比べる
+    '''
+    settings = (
+        ('lstm 1000', {}),
+        ('lstm 256', {'lbn_hidden_dim': 256}),
+        ('lstm 64', {'lbn_hidden_dim': 64}),
+        ('lstm 1000, rank 64', {'lbn_rank': 64}),
+        ('gru 1000', {'lbn_rnn_type': 'gru'}),
+        ('gru 256', {'lbn_hidden_dim': 256, 'lbn_rnn_type': 'gru'}),
+        ('gru 64', {'lbn_hidden_dim': 64, 'lbn_rnn_type': 'gru'}),
+    )
+    print("| LBN | params | GFLOPs / loss (fwd) | update ms | success rate |")
+    print("|--|--|--|--|--|")
+    for name, agent_kwargs in settings:
+        torch.manual_seed(seed)
+        env = Environment(seed=seed)
+        agent = LWMAgent(env, T, **agent_kwargs)
+        update = make_lbn_update(agent, env, T)
+        params = sum(p.numel() for p in agent.lbn.parameters())
+        flops = lbn_flops(agent.lbn, T, len(agent.lbn.t_memory))
+        elapsed = time_per_call(update, num, warmup=1)
+        success = '-'
+        if episodes > 0:
+            success = '%.3f' % train_success_rate(agent_kwargs, episodes, T, seed)[1]
+        print("| %s | %d | %.2f | %.1f | %s |" % (name, params, flops / 1e9, elapsed * 1e3, success))
+
+def bench_trajectory(num=10000, T=56, seed=0):
+    '''
+    episodeの書き出し・読み込みの速さと1ステップあたりの容量を計測する
+    '''
+    # ランダムな行動のepisodeをnum個書き出して読み込む
+    env = Environment(seed=seed)
+    rng = np.random.default_rng(seed)
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        with TrajectoryWriter(directory, grid_type=env.grid_type, m_length=10) as writer:
+            for _ in range(num):
+                goal_index = env.reset()
+                for t in range(T):
+                    state = env.state
+                    action = int(rng.integers(4))
+                    _, reward, done = env.step(action)
+                    tokens = rng.integers(2, size=10) if rng.random() < 0.5 else None
+                    writer.add_step(state, action, reward, tokens)
+                    if done or t == T - 1:
+                        writer.end_episode(goal_index, done)
+                        break
+        write_time = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(directory) for f in files)
+
+        start = time.perf_counter()
+        reader = TrajectoryReader(directory)
+        steps = 0
+        for index in range(len(reader)):
+            steps += len(reader.observations(index))
+        read_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+    print("%d episodes, %d steps" % (num, steps))
+    print("write: %.1f episodes/s" % (num / write_time))
+    print("read + render: %.1f episodes/s (%.0f steps/s)" % (num / read_time, steps / read_time))
+    print("size: %.1f bytes/step (observation image: %d bytes)" % (size / steps, 9 * 9 * 3 * 4))
+
+def episodes_to_success(agent, env, episodes, T=56, target=0.9, window=100):
+    '''
+    学習しながら直近window個のepisodeのsuccess rateがtargetに達するまでのepisode数（達しなければNone）と、
+    最後のwindow個のsuccess rateを返す
+    '''
+    successes = []
+    for episode in range(episodes):
+        successes.append(run_episode(agent, env, T))
+        if len(successes) >= window and np.mean(successes[-window:]) >= target:
+            return episode + 1, np.mean(successes[-window:])
+    return None, np.mean(successes[-window:])
+
+def _format_episodes_to_success(result, episodes):
+    reached, rate = result
+    if reached is None:
+        return 'not reached in %d episodes (success rate of the last 100: %.2f)' % (episodes, rate)
+    return '%d episodes to reach success rate 0.9' % reached
+
+def bench_pretrain(num=2000, T=56, episodes=3000, lbn_hidden_dim=64, seed=0):
+    '''
+    LBN.sequence_lossとepisodeごとのloss()の処理時間を比べる
+    num個のepisodeを記録してVAE_Seq, LBNを事前学習し、レイアウトAでsuccess rate 0.9に達するまでのepisode数を事前学習なしと比べる
+    '''
+    _seed_all(seed)
+    env = Environment(seed=seed)
+    agent = LWMAgent(env, T, lbn_hidden_dim=lbn_hidden_dim)
+    lbn = agent.lbn
+    batch = []
+    for _ in range(32):
+        env.reset()
+        for t in range(T):
+            agent.get_action(t, env)
+        z = torch.cat(lbn.z_memory).detach()
+        m = torch.cat(lbn.m_memory)
+        mask = torch.zeros(T, dtype=torch.bool)
+        mask[lbn.t_memory] = True
+        batch.append((z, m, mask, [z.detach() for z in lbn.z_memory], [m for m in lbn.m_memory],
+                      [beta.detach() for beta in lbn.beta_memory], list(lbn.t_memory)))
+        agent.reset_memory()
+
+    def per_episode():
+        for _, _, _, *memory in batch:
+            lbn.z_memory, lbn.m_memory, lbn.beta_memory, lbn.t_memory = [list(m) for m in memory]
+            kl, reconst = lbn.loss()
+            (kl + reconst).backward()
+        lbn.reset_memory()
+    z_batch = torch.stack([z for z, _, _, *_ in batch])
+    m_batch = torch.cat([m for _, m, _, *_ in batch])
+    mask_batch = torch.stack([mask for _, _, mask, *_ in batch])
+    lengths = torch.full((len(batch),), T)
+    def batched():
+        kl, reconst = lbn.sequence_loss(z_batch, m_batch, mask_batch, lengths)
+        (kl + reconst).backward()
+    print("LBN loss + backward for %d episodes (T=%d): loss() %.1f ms, sequence_loss() %.1f ms" % (
+        len(batch), T, time_per_call(per_episode, 3, warmup=1) * 1e3, time_per_call(batched, 3, warmup=1) * 1e3))
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for pretrain in (False, True):
+            _seed_all(seed)
+            env = Environment(seed=seed)
+            agent = LWMAgent(env, T, lbn_hidden_dim=lbn_hidden_dim)
+            if pretrain:
+                start = time.perf_counter()
+                collect_trajectories(agent, env, directory, num, T)
+                pretrain_vae(agent.vae, enumerate_loader(env.grid_type), epochs=500, log=None)
+                pretrain_lbn(agent.vae, agent.lbn, sequence_loader(directory), epochs=20, log=None)
+                print("pretraining (%d recorded episodes): %.1f s" % (num, time.perf_counter() - start))
+            results[pretrain] = episodes_to_success(agent, env, episodes, T)
+            print("%s: %s" % ('pretrained' if pretrain else 'from scratch',
+                              _format_episodes_to_success(results[pretrain], episodes)))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def bench_replay(T=56, episodes=500, lbn_hidden_dim=64, seed=0):
+    '''
+    ReplayBufferを使った場合と使わない場合で、1 episodeあたりの学習時間と、
+    episodes回学習した後のVAE_Seqの再構成誤差（全ての部分観測に対する）・success rateを比べる
+    '''
+    observations = enumerate_partial_observations('A')
+    configs = [
+        ('on-policy', {}),
+        ('replay batch 16', {'replay_capacity': 1000}),
+        ('replay batch 16 x4 updates', {'replay_capacity': 1000, 'world_model_updates': 4}),
+        ('prioritized batch 16', {'replay_capacity': 1000, 'replay_prioritized': True}),
+    ]
+    for name, kwargs in configs:
+        _seed_all(seed)
+        env = Environment(seed=seed)
+        agent = LWMAgent(env, T, lbn_hidden_dim=lbn_hidden_dim, **kwargs)
+        start = time.perf_counter()
+        successes = [run_episode(agent, env, T) for _ in range(episodes)]
+        elapsed = time.perf_counter() - start
+        torch.manual_seed(seed)
+        with torch.no_grad():
+            _, reconst = agent.vae.loss(observations.to(agent.vae.dense_dec.weight.device))
+        print("%-28s %6.1f ms/episode, vae reconst %7.2f, success rate of the last 100 %.2f" % (
+            name, elapsed / episodes * 1e3, reconst.item(), np.mean(successes[-100:])))
+
+def bench_latent_cache(num=200, T=56, seed=0):
+    '''
+    テスト(get_greedy_action)のnum episode分のLatentCacheのhit rateと1ステップの処理時間を比べる
+    '''
+    # キャッシュの大きさの上限（部分観測の種類数）
+    for grid_type in ('A', 'B'):
+        env = Environment(grid_type=grid_type)
+        keys = set()
+        for goal_index in range(len(env.grid_table)):
+            env.goal_index = goal_index
+            env.grid = env.grid_table[goal_index]
+            for state in env.states:
+                env.state = state
+                keys.add(env.observation_key(partial=True))
+        print("layout %s: %d distinct partial observation keys" % (grid_type, len(keys)))
+
+    for use_cache in (False, True):
+        _seed_all(seed)
+        env = Environment(seed=seed)
+        agent = LWMAgent(env, T, lbn_hidden_dim=64, latent_cache=use_cache)
+        steps, elapsed = 0, 0
+        for episode in range(num):
+            if episode % 10 == 0:
+                run_episode(agent, env, T) # 10 episodeごとに重みを更新する
+            env.reset()
+            start = time.perf_counter()
+            for t in range(T):
+                action = agent.get_greedy_action(t, env)
+                _, _, done = env.step(action)
+                steps += 1
+                if done:
+                    break
+            elapsed += time.perf_counter() - start
+            agent.reset_memory()
+        hit_rate = ", hit rate %.3f" % agent.latent_cache.hit_rate if use_cache else ''
+        print("%-10s %.1f us/step%s" % ('cache' if use_cache else 'no cache', elapsed / steps * 1e6, hit_rate))
+
+def _loop_controller_loss(ctrl_memory, gamma):
+    # 以前のLWMAgent.updateのMonte-Carlo収益によるlossの計算（処理時間の比較用）
+    R = 0
+    actor_loss = 0
+    critic_loss = 0
+    entropy_loss = 0
+    for r, prob, action_probs, v in ctrl_memory[::-1]:
+        R = r + gamma * R
+        advantage = R - v
+        actor_loss -= torch.log(prob) * advantage.detach()
+        critic_loss += F.smooth_l1_loss(v, torch.tensor(R, dtype=torch.float))
+        entropy_loss += entropy(action_probs)
+    return actor_loss / len(ctrl_memory), critic_loss / len(ctrl_memory), entropy_loss / len(ctrl_memory)
+
+def bench_advantage(num=1000, T=56, episodes=3000, lbn_hidden_dim=64, seed=0):
+    '''
+    estimate_advantagesによるControllerのlossと以前のループの処理時間を比べ、
+    advantageの推定方法ごとにレイアウトAでsuccess rate 0.9に達するまでのepisode数を比べる
+    '''
+    _seed_all(seed)
+    env = Environment(seed=seed)
+    agent = LWMAgent(env, T, lbn_hidden_dim=lbn_hidden_dim)
+    env.reset()
+    for t in range(T):
+        action, prob, state_value, action_prob = agent.get_action(t, env)
+        _, reward, done = env.step(action)
+        agent.add_ctrl_memory(reward, prob, action_prob, state_value)
+        if done:
+            break
+    memory = agent.ctrl_memory
+    def vectorized():
+        rewards = torch.tensor([[r for r, _, _, _ in memory]], dtype=torch.float)
+        probs = torch.stack([prob for _, prob, _, _ in memory]).view(1, -1)
+        action_probs = torch.stack([action_prob for _, _, action_prob, _ in memory]).unsqueeze(0)
+        values = torch.stack([v for _, _, _, v in memory]).view(1, -1)
+        return agent.controller_loss(rewards, probs, action_probs, values, torch.ones_like(rewards, dtype=torch.bool))
+    print("controller loss (%d steps): loop %.1f us, vectorized %.1f us" % (
+        len(memory), time_per_call(lambda: _loop_controller_loss(memory, agent.gamma), num) * 1e6, time_per_call(vectorized, num) * 1e6))
+    agent.reset_memory()
+
+    for name, kwargs in (('mc', {}), ('gae lambda=0.95', {'advantage_estimator': 'gae', 'gae_lambda': 0.95}),
+                         ('nstep n=5', {'advantage_estimator': 'nstep', 'n_step': 5})):
+        _seed_all(seed)
+        env = Environment(seed=seed)
+        agent = LWMAgent(env, T, lbn_hidden_dim=lbn_hidden_dim, **kwargs)
+        print("%-16s %s" % (name, _format_episodes_to_success(episodes_to_success(agent, env, episodes, T), episodes)))
+
+def bench_ppo(T=56, episodes=3000, lbn_hidden_dim=64, seed=0):
+    '''
+    Controllerを毎episode1回更新する場合(a2c)とPPOで更新する場合で、1 episodeあたりの学習時間と
+    レイアウトAでsuccess rate 0.9に達するまでのepisode数を比べる
+    '''
+    for name, kwargs in (('a2c', {}),
+                         ('ppo 8 episodes x 4 epochs', {'controller_mode': 'ppo', 'advantage_estimator': 'gae'})):
+        _seed_all(seed)
+        env = Environment(seed=seed)
+        agent = LWMAgent(env, T, lbn_hidden_dim=lbn_hidden_dim, **kwargs)
+        start = time.perf_counter()
+        result = episodes_to_success(agent, env, episodes, T)
+        elapsed = time.perf_counter() - start
+        print("%-26s %6.1f ms/episode, %s" % (name, elapsed / (result[0] or episodes) * 1e3,
+                                              _format_episodes_to_success(result, episodes)))
+
+def _weight_sync_worker(conn, shared, agent_kwargs, T):
+    # rolloutのworkerの代わり. 命令を受けとるたびに重みを読み込んで返事をする
+    networks = LWMAgent(Environment(), T, **agent_kwargs).networks()
+    version = -1
+    while True:
+        command = conn.recv()
+        if command == 'stop':
+            break
+        if command == 'shared':
+            version = shared.pull(networks, version)
+        else:
+            state_dicts = pickle.loads(conn.recv_bytes())
+            for name, module in networks.items():
+                module.load_state_dict(state_dicts[name])
+        conn.send(version)
+
+def bench_weight_sync(num=20, T=56, seed=0):
+    '''
+    学習プロセスからworkerへの重みの同期(送る側の書き込みから、workerが読み込み終わるまで)の処理時間を、
+    SharedWeightsとpickleしたstate_dictをPipeで送る場合で比べる
+    '''
+    for name, agent_kwargs in (('lbn_hidden_dim=1000', {}), ('lbn_hidden_dim=256', {'lbn_hidden_dim': 256})):
+        _seed_all(seed)
+        agent = LWMAgent(Environment(), T, **agent_kwargs)
+        networks = agent.networks()
+        shared = SharedWeights(networks)
+        context = multiprocessing.get_context('fork')
+        conn, worker_conn = context.Pipe()
+        worker = context.Process(target=_weight_sync_worker, args=(worker_conn, shared, agent_kwargs, T))
+        worker.start()
+        try:
+            def perturb():
+                with torch.no_grad():
+                    for module in networks.values():
+                        for p in module.parameters():
+                            p.add_(1e-3)
+
+            def sync_shared():
+                shared.publish(networks)
+                conn.send('shared')
+                return conn.recv()
+
+            def sync_pickle():
+                conn.send('pickle')
+                conn.send_bytes(pickle.dumps({key: module.state_dict() for key, module in networks.items()}))
+                return conn.recv()
+
+            elapsed = {}
+            for sync in (sync_shared, sync_pickle):
+                times = []
+                for _ in range(num):
+                    perturb()
+                    start = time.perf_counter()
+                    sync()
+                    times.append(time.perf_counter() - start)
+                elapsed[sync.__name__] = np.median(times)
+            # 重みが変わっていなければworkerはversionを見るだけ
+            sync_shared()
+            start = time.perf_counter()
+            for _ in range(num):
+                conn.send('shared')
+                conn.recv()
+            unchanged = (time.perf_counter() - start) / num
+            conn.send('stop')
+        finally:
+            worker.join(timeout=10)
+        print("%s (%.1fM parameters): shared memory %.2f ms, pickled state_dict %.2f ms, unchanged check %.3f ms" % (
+            name, shared.numel / 1e6, elapsed['sync_shared'] * 1e3, elapsed['sync_pickle'] * 1e3, unchanged * 1e3))
+
+def bench_distributed(T=56, episodes=30, lbn_hidden_dim=64):
+    '''
+    1台でrankを1, 2, 4, 8個起動し、rankごとにepisodes回データ並列で学習したときのepisode/sとスケーリング効率を計測する
+    '''
+    print("cpu cores: %d" % len(os.sched_getaffinity(0)))
+    base = None
+    for index, world_size in enumerate((1, 2, 4, 8)):
+        results = launch_local(world_size, episodes, T=T, port=29500 + index, lbn_hidden_dim=lbn_hidden_dim)
+        throughput = world_size * episodes / max(elapsed for _, elapsed in results)
+        base = throughput if base is None else base
+        print("%d ranks: %6.2f episodes/s, scaling efficiency %.2f" % (world_size, throughput, throughput / (base * world_size)))
+
+async def _env_client_load(path, num_clients, duration, depth):
+    # num_clients個の接続からそれぞれdepth個ずつ要求を送り続け、応答までの時間を記録する
+    latencies = []
+    async def client(index):
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(REQUEST.pack(ALLOC, 0, 0, 0))
+        env_id = RESPONSE.unpack(await reader.readexactly(RESPONSE.size))[2]
+        sent = {}
+        request_id = 0
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            for _ in range(depth):
+                request_id += 1
+                sent[request_id] = time.perf_counter()
+                writer.write(REQUEST.pack(STEP, request_id, env_id, request_id % 4))
+            await writer.drain()
+            for _ in range(depth):
+                response = RESPONSE.unpack(await reader.readexactly(RESPONSE.size))
+                latencies.append(time.perf_counter() - sent.pop(response[0]))
+        writer.close()
+    start = time.perf_counter()
+    await asyncio.gather(*(client(index) for index in range(num_clients)))
+    return latencies, time.perf_counter() - start
+
+def bench_env_server(duration=2.0, T=56, seed=0):
+    '''
+    EnvServerに1, 8, 64個のクライアントから要求を送り、requests/sと応答時間のパーセンタイルを計測する
+    '''
+    path = os.path.join(tempfile.mkdtemp(), 'env.sock')
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    server = context.Process(target=EnvServer(path, num_envs=64, seed=seed).run, args=(ready,), daemon=True)
+    server.start()
+    try:
+        ready.wait(10)
+        for depth in (1, 16):
+            for num_clients in (1, 8, 64):
+                latencies, elapsed = asyncio.run(_env_client_load(path, num_clients, duration, depth))
+                latencies = np.asarray(latencies) * 1e6
+                print("%2d clients, %2d in flight each: %8.0f requests/s, latency p50 %7.0f us, p99 %7.0f us" % (
+                    num_clients, depth, len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    finally:
+        server.terminate()
+        server.join()
+
+def bench_rollout(T=56, episodes=6000, num_envs=4, lbn_hidden_dim=64, seed=0, window=1000):
+    '''
+    RolloutEngineでnum_envs個の環境からepisodeを集め、num_envs個ずつPackedEpisodesでまとめて更新しながらレイアウトAで学習する
+    window episodeごとに、success rate, 平均ステップ数と、最大ステップ数T・batch内で最長のepisodeに揃えた場合の無駄なステップの割合を表示する
+    '''
+    _seed_all(seed)
+    env = Environment(seed=seed)
+    agent = LWMAgent(env, T, lbn_hidden_dim=lbn_hidden_dim)
+    engine = RolloutEngine(agent, make_envs(num_envs, seed=seed), T)
+
+    stats = [] # (成功したか, ステップ数)
+    batch_waste = []
+    start = time.perf_counter()
+    last = (start, 0, 0)
+    while len(stats) < episodes:
+        batch = engine.collect(num_envs)
+        agent.update(batch)
+        batch_waste.append(batch.padding_waste())
+        stats += [(bool(r), int(l)) for r, l in zip(batch.rewards[batch.offsets[1:] - 1] > 0, batch.lengths)]
+        if len(stats) // window > last[2]:
+            recent = stats[-window:]
+            lengths = [length for _, length in recent]
+            now = time.perf_counter()
+            print("episodes %5d: success rate %.2f, mean length %4.1f, padding to T %.2f, padding to batch max %.2f, %6.0f steps/s" % (
+                len(stats), np.mean([success for success, _ in recent]), np.mean(lengths),
+                1 - np.sum(lengths) / (len(recent) * T), np.mean(batch_waste[-(window // num_envs):]),
+                (sum(length for _, length in stats) - last[1]) / (now - last[0])))
+            last = (now, sum(length for _, length in stats), len(stats) // window)
+    print("total: %d episodes, %d steps; padding to T would have added %d steps (%.2f of the padded batch)" % (
+        len(stats), sum(length for _, length in stats), len(stats) * T - sum(length for _, length in stats),
+        1 - sum(length for _, length in stats) / (len(stats) * T)))
+
+def bench_oracle(num=2000, seed=0):
+    '''
+    価値反復の最適方策でのsuccess rateとepisodeの長さを、レイアウト・move_prob・Tごとに表示する
+    最適方策でEnvironmentをnum回動かしたときのsuccess rateも価値反復の値と並べて表示する
+    '''
+    for grid_type in ('A', 'B'):
+        for move_prob in (1.0, 0.9, 0.8):
+            start = time.perf_counter()
+            solutions = [solve(grid_type, T, move_prob) for T in (16, 20, 36, 56)]
+            elapsed = time.perf_counter() - start
+            print("%s move_prob=%.1f: %s, min T for 0.9: %s (%.1f ms)" % (
+                grid_type, move_prob, ', '.join("T=%d %.3f / %.1f steps" % (s.T, s.success_rate, s.mean_length)
+                                                for s in solutions),
+                min_horizon(grid_type, move_prob), elapsed * 1e3))
+
+    _seed_all(seed)
+    solution = solve('A', 20, 0.8)
+    env = Environment(grid_type='A', move_prob=0.8, seed=seed)
+    successes, lengths = 0, 0
+    for _ in range(num):
+        env.reset()
+        for t in range(solution.T):
+            _, reward, done = env.step(solution.action(env, t))
+            if done or t == solution.T - 1:
+                successes += reward == 1
+                lengths += t + 1
+                break
+    rate = successes / num
+    print("A move_prob=0.8 T=20: simulated %.3f / %.1f steps, value iteration %.3f / %.1f steps" % (
+        rate, lengths / num, solution.success_rate, solution.mean_length))
+
+def bench_checkpoint(num=10, T=56, seed=0):
+    '''
+    CheckpointManagerでnum回保存し、学習側が待つ時間を同期・非同期の書き込みで比べる
+    '''
+    _seed_all(seed)
+    agent = LWMAgent(Environment(), T)
+    networks = agent.networks()
+    rates = [0.1, 0.5, 0.3, 0.9, 0.2, 0.6, 0.9, 0.4, 0.7, 0.1]
+    rates = (rates * (num // len(rates) + 1))[:num]
+    for async_write in (False, True):
+        directory = tempfile.mkdtemp()
+        try:
+            manager = CheckpointManager(directory, top_k=3, keep_last=2, config={'T': T}, async_write=async_write)
+            times = []
+            for index, rate in enumerate(rates):
+                with torch.no_grad():
+                    for p in agent.controller.parameters():
+                        p.add_(1e-3)
+                start = time.perf_counter()
+                manager.save(networks, (index + 1) * 5000, {'test_success_rate': rate})
+                times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            manager.close()
+            drain = time.perf_counter() - start
+            index = read_index(directory)
+            files = [file for file in os.listdir(directory) if file.endswith('.pth')]
+            best = select_entry(index, 'best')
+            print("%-5s writes: save() blocks %.1f ms (median), close() waits %.1f ms, %d files kept, best episode %d (%.1f)" % (
+                'async' if async_write else 'sync', np.median(times) * 1e3, drain * 1e3, len(files),
+                best['episode'], best['metrics']['test_success_rate']))
+        finally:
+            shutil.rmtree(directory)
+
+def bench_determinism(T=56, num=2000, lbn_hidden_dim=64):
+    '''
+    行動選択(get_action)の処理時間を、グローバルな乱数を使う場合とseedを与えた専用の乱数を使う場合で比べる
+    '''
+    for name, seed in (('global RNG', None), ('seeded generators', 0)):
+        env = Environment(seed=0)
+        agent = LWMAgent(env, T, seed=seed, lbn_hidden_dim=lbn_hidden_dim)
+        env.reset()
+        def act():
+            agent.get_action(1, env)
+            agent.reset_memory()
+        agent.get_action(0, env)
+        print("get_action with %-17s %.1f us" % (name, time_per_call(act, num) * 1e6))
+
+def _thread_worker(mode, runs, index, T, lbn_hidden_dim, ready, start, deadline, results):
+    # mode='auto'ならコアをruns個に分けたうちのindex番目を使い、'default'ならtorchのデフォルトのまま学習する
+    if mode == 'auto':
+        configure_threads('auto', 'auto', 'auto', concurrent_runs=runs, run_index=index)
+    env_seed, agent_seed = np.random.SeedSequence(index).spawn(2)
+    env = Environment(seed=env_seed)
+    agent = LWMAgent(env, T, seed=agent_seed, lbn_hidden_dim=lbn_hidden_dim)
+    run_episode(agent, env, T)
+    ready.put(index)
+    start.wait()
+    # 全ての学習で共通の締め切りまでに始めたepisodeを数え、最後のepisodeが終わった時刻も返す
+    count = 0
+    while time.perf_counter() < deadline.value:
+        run_episode(agent, env, T)
+        count += 1
+    results.put((count, time.perf_counter()))
+
+def bench_threads(duration=5.0, T=56, num=32, lbn_hidden_dim=64):
+    '''
+    1~num個の学習を同時に動かし、全体のepisode/sをtorchのデフォルトのスレッド設定とconfigure_threadsの'auto'で比べる
+    各学習はduration秒の間、独立に学習を続ける
+    '''
+    cpus = available_cpus()
+    print("cpu cores: %d, default threads: intra-op %d, inter-op %d" % (
+        len(cpus), torch.get_num_threads(), torch.get_num_interop_threads()))
+    context = multiprocessing.get_context('fork')
+    runs = 1
+    while runs <= num:
+        throughput = {}
+        for mode in ('default', 'auto'):
+            ready, results, start, deadline = context.Queue(), context.Queue(), context.Event(), context.Value('d')
+            workers = [context.Process(target=_thread_worker,
+                                       args=(mode, runs, index, T, lbn_hidden_dim, ready, start, deadline, results))
+                       for index in range(runs)]
+            for worker in workers:
+                worker.start()
+            for _ in workers:
+                ready.get()
+            begin = time.perf_counter()
+            deadline.value = begin + duration
+            start.set()
+            counts, ends = zip(*[results.get() for _ in workers])
+            for worker in workers:
+                worker.join()
+            throughput[mode] = sum(counts) / (max(ends) - begin)
+        print("%2d runs: default %7.2f episodes/s, auto %7.2f episodes/s (x%.2f), auto share of run 0: cpus %s" % (
+            runs, throughput['default'], throughput['auto'], throughput['auto'] / throughput['default'],
+            cpu_share(runs, 0, cpus)))
+        runs *= 2
+
+def _calibrated_uncertainty(quantile, T, lbn_hidden_dim, seed=0, episodes=5):
+    # 計測と同じseedの学習前のagentで、t>0のステップのbetaのstdの平均を集め、その分位点をthresholdにしたスケジュールを返す
+    # （stdの平均は重みの初期値ごとにほぼ一定の値の周りに集まるので、別のseedの値は使えない）
+    schedule = UncertaintySchedule(threshold=float('inf'))
+    env_seed, agent_seed = np.random.SeedSequence(seed).spawn(2)
+    env = Environment(seed=env_seed)
+    agent = LWMAgent(env, T, seed=agent_seed, lbn_hidden_dim=lbn_hidden_dim, message_schedule=schedule)
+    values = []
+    decide = schedule._decide
+    def recording_decide(t, z, beta, message_last):
+        values.extend(schedule.uncertainty(z, message_last).tolist())
+        return decide(t, z, beta, message_last)
+    schedule._decide = recording_decide
+    for _ in range(episodes):
+        run_episode(agent, env, T)
+    return {'type': 'uncertainty', 'threshold': float(np.quantile(values, quantile))}
+
+def bench_message_schedule(episodes=300, T=56, num=100, lbn_hidden_dim=64):
+    '''
+    messageのスケジュールごとに、episodes回学習したあとのnum回のテストのsuccess rateと、1 episodeあたりのmessageの数・
+    Speakerとスケジュールの計算量(FLOPs)・学習の処理時間を比べる
+    '''
+    schedules = [
+        ('probability 0.5', None),
+        ('probability 0.1', {'type': 'probability', 'prob': 0.1}),
+        ('interval 4', {'type': 'interval', 'interval': 4}),
+        ('interval 8', {'type': 'interval', 'interval': 8}),
+        ('uncertainty q0.75', _calibrated_uncertainty(0.75, T, lbn_hidden_dim)),
+        ('gate cost 0.01', {'type': 'gate', 'cost': 0.01}),
+        ('gate cost 0.1', {'type': 'gate', 'cost': 0.1}),
+    ]
+    print("%-18s %8s %8s %9s %14s %14s %10s" % ('schedule', 'train', 'test', 'msgs/ep', 'speaker MF/ep', 'sched MF/ep', 'ms/ep'))
+    for name, spec in schedules:
+        env_seed, agent_seed = np.random.SeedSequence(0).spawn(2)
+        env = Environment(seed=env_seed)
+        agent = LWMAgent(env, T, seed=agent_seed, lbn_hidden_dim=lbn_hidden_dim, message_schedule=spec)
+        start = time.perf_counter()
+        train = [run_episode(agent, env, T) for _ in range(episodes)]
+        elapsed = time.perf_counter() - start
+        training = agent.message_schedule.stats()
+        test = [run_episode(agent, env, T, train=False) for _ in range(num)]
+        print("%-18s %8.3f %8.3f %9.2f %14.3f %14.3f %10.1f" % (
+            name, np.mean(train[episodes // 2:]), np.mean(test), training['messages_per_episode'],
+            training['speaker_flops_per_episode'] / 1e6, training['schedule_flops_per_episode'] / 1e6,
+            elapsed / episodes * 1e3))
+
+    # LBNの幅によっては、聞き手側でEncoderを毎ステップ計算する方がSpeakerより重い
+    for hidden_dim in (64, 1000):
+        agent = LWMAgent(Environment(), T, seed=0, lbn_hidden_dim=hidden_dim, message_schedule={'type': 'uncertainty'})
+        speaker_flops, decision_flops = agent.message_schedule.flops_per_call()
+        print("lbn_hidden_dim %4d: Speaker %.3f MFLOPs per message, uncertainty check %.3f MFLOPs per step" % (
+            hidden_dim, speaker_flops / 1e6, decision_flops / 1e6))
+
+def _seed_all(seed):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+def _rate(fn, num, warmup=10):
+    # 1秒あたりの実行回数
+    return 1.0 / time_per_call(fn, num, warmup)
+
+def run_suite(quick=False, seed=0):
+    '''
+    主要な処理の性能をまとめて計測し、{名前: {'value': 値, 'unit': 単位}} を返す
+    乱数は全て固定する. quick=Trueの場合は計測の規模を小さくする
+    '''
+    results = {}
+    def record(name, value, unit):
+        results[name] = {'value': value, 'unit': unit}
+        print("%-40s %14.3f %s" % (name, value, unit))
+
+    T = 56
+    scale = 10 if quick else 1
+
+    # 環境
+    _seed_all(seed)
+    env = Environment(seed=seed)
+    actions = np.random.randint(0, 4, size=1024).tolist()
+    state = {'i': 0}
+    def step():
+        _, _, done = env.step(actions[state['i'] % 1024])
+        state['i'] += 1
+        if done:
+            env.reset()
+    record('env.step', _rate(step, 100000 // scale), 'steps/s')
+    record('env.reset', _rate(env.reset, 100000 // scale), 'resets/s')
+    record('env.observation partial', _rate(lambda: env.observation(partial=True), 10000 // scale), 'renders/s')
+    record('env.observation global', _rate(lambda: env.observation(partial=False), 10000 // scale), 'renders/s')
+
+    # 聞き手の1ステップ
+    _seed_all(seed)
+    agent = LWMAgent(env, T)
+    listener = ListenerStep(agent.vae, agent.lbn, agent.controller)
+    for batch_size in (1, 64, 4096):
+        x = torch.rand(batch_size, 3, 9, 9)
+        m = torch.rand(batch_size, agent.lbn.m_dim)
+        num = max(2000 * 64 // max(batch_size, 64) // scale, 5)
+        with torch.no_grad():
+            record('listener step batch %d' % batch_size, time_per_call(lambda: listener(x, m, None), num) * 1e6, 'us')
+
+    # LBN.lossの処理時間 (Tに対してO(T^2))
+    for episode_length in ((8, 16, 32) if quick else (8, 16, 32, 56)):
+        _seed_all(seed)
+        update = make_lbn_update(LWMAgent(env, episode_length), env, episode_length)
+        record('lbn update T=%d' % episode_length, time_per_call(update, 1, warmup=1) * 1e3, 'ms')
+
+    # Speaker.lossの処理時間 (buffer_sizeに比例)
+    for buffer_size in (50, 150, 500):
+        _seed_all(seed)
+        speaker = Speaker(m_tokens=2, m_length=10, buffer_size=buffer_size).to(agent.speaker.speaker_memory.device)
+        speaker.speaker_memory.uniform_()
+        def speaker_update():
+            negent, rec = speaker.loss()
+            (negent + rec).backward()
+        record('speaker loss buffer=%d' % buffer_size, time_per_call(speaker_update, 50 // scale, warmup=2) * 1e3, 'ms')
+
+    # 学習全体 (episode/s)
+    _seed_all(seed)
+    env = Environment(seed=seed)
+    agent = LWMAgent(env, T)
+    episodes = 1 if quick else 5
+    record('training episodes', _rate(lambda: run_episode(agent, env, T), episodes, warmup=1), 'episodes/s')
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(output=None, quick=False, seed=0):
+    '''
+    run_suiteを実行し、マシンの情報とともにJSONに保存する
+    '''
+    results = run_suite(quick=quick, seed=seed)
+    record = {
+        'commit': _git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                    'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads()},
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'quick': quick,
+        'seed': seed,
+        'results': results,
+    }
+    if output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(record, f, indent=2)
+        print("saved to %s" % output)
+    return record
+
+# 値が大きいほど良い単位（それ以外は小さいほど良い）
+_HIGHER_IS_BETTER = ('steps/s', 'resets/s', 'renders/s', 'episodes/s')
+
+def compare(old_path, new_path, threshold=0.1):
+    '''
+    2つのsuiteの結果を比べる. threshold以上悪化した項目には印をつける
+    '''
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if old['machine'] != new['machine']:
+        print("warning: results were measured on different machines")
+    print("%-40s %14s %14s %8s" % ('benchmark', old['commit'], new['commit'], 'ratio'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['value'], result['value']
+        # ratio > 1 は改善
+        ratio = after / before if result['unit'] in _HIGHER_IS_BETTER else before / after
+        mark = '  <-- slower' if ratio < 1 - threshold else ''
+        print("%-40s %14.3f %14.3f %7.2fx%s" % (name, before, after, ratio, mark))
+
+BENCHMARKS = {
+    'reset': bench_reset,
+    'step': bench_step,
+    'speaker': bench_speaker,
+    'listener': bench_listener,
+    'noise': bench_noise,
+    'amp': bench_amp,
+    'lbn_width': bench_lbn_width,
+    'trajectory': bench_trajectory,
+    'pretrain': bench_pretrain,
+    'replay': bench_replay,
+    'latent_cache': bench_latent_cache,
+    'advantage': bench_advantage,
+    'ppo': bench_ppo,
+    'weight_sync': bench_weight_sync,
+    'distributed': bench_distributed,
+    'env_server': bench_env_server,
+    'rollout': bench_rollout,
+    'oracle': bench_oracle,
+    'checkpoint': bench_checkpoint,
+    'determinism': bench_determinism,
+    'threads': bench_threads,
+    'message_schedule': bench_message_schedule,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('name', choices=sorted(BENCHMARKS) + ['suite', 'compare'])
+    parser.add_argument('files', nargs='*', help="compareで比べる2つのJSON")
+    parser.add_argument('--num', type=int, default=None)
+    parser.add_argument('--episodes', type=int, default=None)
+    parser.add_argument('--output', default=None, help="suiteの結果を保存するJSON")
+    parser.add_argument('--quick', action='store_true', help="suiteの計測の規模を小さくする")
+    args = parser.parse_args()
+    if args.name == 'suite':
+        bench_suite(output=args.output, quick=args.quick)
+    elif args.name == 'compare':
+        if len(args.files) != 2:
+            parser.error("compare needs two result files")
+        compare(*args.files)
+    else:
+        kwargs = {key: value for key, value in (('num', args.num), ('episodes', args.episodes)) if value is not None}
+        BENCHMARKS[args.name](**kwargs)
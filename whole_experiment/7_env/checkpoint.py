@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""学習中の重みの保存と選択
+
+metricが大きい順にtop_k個と、新しい順にkeep_last個のcheckpointを残し、それ以外は消す。
+書き込みは別スレッドで行うので、学習は保存を待たない（重みは保存を呼んだ時点でコピーする）。
+
+保存形式:
+    <directory>/index.json                 残っているcheckpointの一覧
+        entries : [{'file', 'episode', 'metrics', 'config_hash', 'time'}, ...]（episode順）
+        metric, top_k, keep_last
+    <directory>/checkpoint_00005000.pth    {モジュール名: state_dict}
+                                           optimizerも保存した場合は 'optimizers': {名前: state_dict} も含む
+index.jsonはcheckpointを書き終わってから置き換えるので、一覧にあるファイルは必ず読める。
+評価用のツールはindex.jsonだけを見てcheckpointを選べる。
+
+    manager = CheckpointManager('checkpoints', metric='test_success_rate', config=config)
+    manager.save(agent.networks(), episode, {'test_success_rate': 0.9}, optimizers=agent.optimizers())
+    manager.close()
+    load_checkpoint('checkpoints', agent.networks(), which='best')
+    load_checkpoint('checkpoints', agent.networks(), which='last', optimizers=agent.optimizers()) # 学習を続ける場合
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+INDEX_FILE = 'index.json'
+OPTIMIZERS_KEY = 'optimizers'
+
+
+def config_hash(config):
+    '''
+    学習の設定(dict)のハッシュ. 同じ設定のcheckpointかを見分けるのに使う
+    '''
+    text = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+def read_index(directory):
+    '''
+    index.jsonを読んで返す（checkpointは読み込まない）. まだない場合は空の一覧を返す
+    '''
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return {'entries': []}
+    with open(path) as f:
+        return json.load(f)
+
+def select_entry(index, which='best', metric=None):
+    '''
+    index(read_indexの返り値)からcheckpointを選ぶ
+        which : 'best'（metricが最大）, 'last'（最も新しい）, もしくはepisode番号
+        metric : 'best'で比べる指標. Noneの場合はindexに記録されたもの
+    '''
+    entries = index['entries']
+    if not entries:
+        raise Exception("no checkpoints in the index")
+    if which == 'last':
+        return max(entries, key=lambda entry: entry['episode'])
+    if which == 'best':
+        metric = index.get('metric') if metric is None else metric
+        scored = [entry for entry in entries if metric in entry['metrics']]
+        if not scored:
+            raise Exception("no checkpoints have metric '%s'" % metric)
+        # 同じ値なら新しい方
+        return max(scored, key=lambda entry: (entry['metrics'][metric], entry['episode']))
+    for entry in entries:
+        if entry['episode'] == which:
+            return entry
+    raise Exception("no checkpoint for episode %s" % which)
+
+def load_checkpoint(directory, networks, which='best', map_location=None, optimizers=None):
+    '''
+    選んだcheckpointの重みをnetworks({名前: nn.Module})に読み込み、indexの項目を返す
+    optimizers({名前: state_dictを持つもの})を指定した場合は、保存したoptimizerなどの状態も読み込む
+    '''
+    entry = select_entry(read_index(directory), which)
+    state_dicts = torch.load(os.path.join(directory, entry['file']), map_location=map_location)
+    for name, module in networks.items():
+        module.load_state_dict(state_dicts[name])
+    if optimizers is not None:
+        saved = state_dicts.get(OPTIMIZERS_KEY, {})
+        for name, optimizer in optimizers.items():
+            if name not in saved:
+                raise Exception("checkpoint %s has no state for '%s'" % (entry['file'], name))
+            optimizer.load_state_dict(saved[name])
+    return entry
+
+def _copy_to_cpu(value):
+    # state_dictの中のテンソルをCPUにコピーする（入れ子のdict, listも）
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: _copy_to_cpu(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy_to_cpu(item) for item in value)
+    return value
+
+
+class CheckpointManager():
+    '''
+    directory : 保存先
+    metric : top_kを選ぶ指標の名前（大きいほど良い）
+    top_k : metricが大きい順に残す個数
+    keep_last : 新しい順に残す個数
+    config : 学習の設定(dict). ハッシュを各checkpointに記録する
+    async_write : Falseのときはsave()の中で書き終わるまで待つ
+    '''
+    def __init__(self, directory, metric='test_success_rate', top_k=3, keep_last=2, config=None, async_write=True):
+        if top_k < 0 or keep_last < 1:
+            raise Exception("'top_k' must be >= 0 and 'keep_last' must be >= 1")
+        self.directory = directory
+        self.metric = metric
+        self.top_k = top_k
+        self.keep_last = keep_last
+        self.config_hash = config_hash(config or {})
+        os.makedirs(directory, exist_ok=True)
+        # 同じディレクトリに前の学習のcheckpointがあれば引き継ぐ
+        self.entries = read_index(directory)['entries']
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if async_write else None
+        self._pending = []
+
+    def save(self, networks, episode, metrics, optimizers=None):
+        '''
+        networks({名前: nn.Module})の重みを保存し、残すcheckpointを選び直す. 書き込みのFuture(同期の場合はNone)を返す
+        metrics : {指標の名前: 値}
+        optimizers : {名前: state_dictを持つもの}. 指定すると学習を再開するためのoptimizerなどの状態も保存する
+        '''
+        # 学習を続けても変わらないように、ここでCPUにコピーする
+        state_dicts = {name: {key: tensor.detach().to('cpu', copy=True) for key, tensor in module.state_dict().items()}
+                       for name, module in networks.items()}
+        if optimizers is not None:
+            state_dicts[OPTIMIZERS_KEY] = {name: _copy_to_cpu(optimizer.state_dict()) for name, optimizer in optimizers.items()}
+        entry = {'file': 'checkpoint_%08d.pth' % episode, 'episode': episode,
+                 'metrics': {key: float(value) for key, value in metrics.items()},
+                 'config_hash': self.config_hash, 'time': time.time()}
+        if self._executor is None:
+            self._write(state_dicts, entry)
+            return None
+        # 失敗した書き込みはwait()/close()で例外を投げるために残す
+        self._pending = [future for future in self._pending if not future.done() or future.exception() is not None]
+        future = self._executor.submit(self._write, state_dicts, entry)
+        self._pending.append(future)
+        return future
+
+    def _retained(self, entries):
+        # top_k個とkeep_last個の和集合
+        by_episode = sorted(entries, key=lambda entry: entry['episode'])
+        keep = {entry['file'] for entry in by_episode[-self.keep_last:]}
+        scored = [entry for entry in by_episode if self.metric in entry['metrics']]
+        scored.sort(key=lambda entry: (entry['metrics'][self.metric], entry['episode']), reverse=True)
+        keep.update(entry['file'] for entry in scored[:self.top_k])
+        return [entry for entry in by_episode if entry['file'] in keep]
+
+    def _write(self, state_dicts, entry):
+        path = os.path.join(self.directory, entry['file'])
+        torch.save(state_dicts, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        with self._lock:
+            entries = [other for other in self.entries if other['file'] != entry['file']] + [entry]
+            retained = self._retained(entries)
+            removed = [other['file'] for other in entries if other not in retained]
+            self.entries = retained
+            index = {'metric': self.metric, 'top_k': self.top_k, 'keep_last': self.keep_last, 'entries': retained}
+            index_path = os.path.join(self.directory, INDEX_FILE)
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(index_path + '.tmp', index_path)
+        # 一覧から外してからファイルを消す
+        for file in removed:
+            if os.path.exists(os.path.join(self.directory, file)):
+                os.remove(os.path.join(self.directory, file))
+
+    def best(self):
+        with self._lock:
+            return select_entry({'metric': self.metric, 'entries': list(self.entries)}, 'best')
+
+    def last(self):
+        with self._lock:
+            return select_entry({'metric': self.metric, 'entries': list(self.entries)}, 'last')
+
+    def wait(self):
+        '''
+        書き込み中のcheckpointを全て書き終わるまで待つ（書き込みでの例外はここで投げる）
+        失敗したものが複数あれば最初の例外を投げる. 投げた例外は次のwait()では投げない
+        '''
+        pending, self._pending = self._pending, []
+        errors = [future.exception() for future in pending]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
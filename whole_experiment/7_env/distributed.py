@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""torch.distributed (gloo) によるデータ並列学習
+
+各プロセス(rank)が自分の環境でepisodeを集めて勾配を計算し、optimizerの更新の前に全rankで勾配を平均する。
+重みは最初にrank 0から配るので、以降は全rankで同じ重みのまま学習が進む。
+
+    # 1台で4プロセス
+    python distributed.py --world-size 4 --episodes 1000
+    # 複数ノード (torchrunがRANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORTを設定する)
+    torchrun --nnodes 2 --nproc-per-node 4 --rdzv-endpoint HOST:PORT distributed.py --episodes 1000
+
+ControllerをPPOで更新する場合(controller_mode='ppo')は、rankごとにminibatchの数が変わるので使えない。
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from LWM_expt_02 import Environment, LWMAgent, invalidate_latent_caches
+from threads import configure_threads
+
+
+def broadcast_networks(networks, src=0):
+    '''
+    srcのrankの重み（state_dict）を全rankに配る
+    '''
+    with torch.no_grad():
+        for module in networks.values():
+            for tensor in module.state_dict().values():
+                dist.broadcast(tensor, src)
+    # broadcastは重みをその場で書き換えるので、キャッシュした潜在変数を捨てる
+    invalidate_latent_caches(networks)
+
+def all_reduce_gradients(optimizer):
+    '''
+    optimizerのパラメータの勾配を1本にまとめて全rankで平均する（LWMAgent.gradient_hookに使う）
+    勾配がNoneのパラメータはゼロの勾配にする（rankによってNoneかどうかが違っても、全rankで同じ形のbufferを平均する）
+    '''
+    params = [p for group in optimizer.param_groups for p in group['params']]
+    if not params:
+        return
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    grads = [p.grad for p in params]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+def make_agent(T, seed=0, grid_type='A', **agent_kwargs):
+    '''
+    このrankの環境とagentを作る. 環境とagentの乱数はrankごとに独立な乱数列にし、重みはrank 0に揃える
+    '''
+    if agent_kwargs.get('controller_mode') == 'ppo':
+        raise Exception("controller_mode='ppo' is not supported in data-parallel training")
+    rank = dist.get_rank()
+    env_seed, agent_seed = np.random.SeedSequence(seed).spawn(dist.get_world_size())[rank].spawn(2)
+    env = Environment(grid_type=grid_type, seed=env_seed)
+    agent = LWMAgent(env, T, seed=agent_seed, **agent_kwargs)
+    broadcast_networks(agent.networks())
+    agent.gradient_hook = all_reduce_gradients
+    return env, agent
+
+def train(episodes, T=56, seed=0, **agent_kwargs):
+    '''
+    このrankでepisodes回学習し、(success rate, 経過時間)を返す. 全rankが同じ回数だけupdateを呼ぶ
+    '''
+    env, agent = make_agent(T, seed=seed, **agent_kwargs)
+    successes = 0
+    dist.barrier()
+    start = time.perf_counter()
+    for episode in range(episodes):
+        env.reset()
+        for t in range(T):
+            action, prob, state_value, action_prob = agent.get_action(t, env)
+            _, reward, done = env.step(action)
+            agent.add_ctrl_memory(reward, prob, action_prob, state_value)
+            if done or t == T-1:
+                successes += done
+                agent.update()
+                agent.reset_memory()
+                break
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    check_synchronized(agent.networks())
+    return successes / episodes, elapsed
+
+def check_synchronized(networks):
+    '''
+    全rankの重みが一致していることを確かめる
+    '''
+    checksum = torch.tensor([sum(float(tensor.double().sum()) for module in networks.values()
+                                 for tensor in module.state_dict().values())], dtype=torch.float64)
+    checksums = [torch.zeros_like(checksum) for _ in range(dist.get_world_size())]
+    dist.all_gather(checksums, checksum)
+    if any(not torch.equal(other, checksums[0]) for other in checksums):
+        raise Exception("weights differ across ranks: %s" % [float(other) for other in checksums])
+
+def _local_worker(rank, world_size, port, episodes, T, agent_kwargs, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    # 同じマシンのプロセス同士でコアを取り合わないように、コアをrankで分ける
+    configure_threads(intra_op='auto', inter_op='auto', affinity='auto', concurrent_runs=world_size, run_index=rank)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        success_rate, elapsed = train(episodes, T=T, **agent_kwargs)
+        results[rank] = (success_rate, elapsed)
+    finally:
+        dist.destroy_process_group()
+
+def launch_local(world_size, episodes, T=56, port=29500, **agent_kwargs):
+    '''
+    1台のマシンでworld_size個のrankを起動して学習し、rankごとの(success rate, 経過時間)を返す
+    '''
+    results = mp.Manager().dict()
+    mp.spawn(_local_worker, args=(world_size, port, episodes, T, agent_kwargs, results), nprocs=world_size)
+    return [results[rank] for rank in range(world_size)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--world-size', type=int, default=None, help="1台で起動するrankの数（torchrunで起動する場合は指定しない）")
+    parser.add_argument('--episodes', type=int, default=1000, help="rankごとのepisode数")
+    parser.add_argument('--T', type=int, default=56)
+    parser.add_argument('--lbn-hidden-dim', type=int, default=1000)
+    args = parser.parse_args()
+    agent_kwargs = {'lbn_hidden_dim': args.lbn_hidden_dim}
+    if args.world_size is not None:
+        for rank, (success_rate, elapsed) in enumerate(launch_local(args.world_size, args.episodes, T=args.T, **agent_kwargs)):
+            print("rank %d: success rate %.3f, %.1f s" % (rank, success_rate, elapsed))
+    else:
+        dist.init_process_group('gloo')
+        success_rate, elapsed = train(args.episodes, T=args.T, **agent_kwargs)
+        print("rank %d: success rate %.3f, %.1f s" % (dist.get_rank(), success_rate, elapsed))
+        dist.destroy_process_group()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Unixソケットで環境(Environment)を提供するasyncioのサーバー
+
+サーバーはnum_envs個の迷路を持ち、複数のagentプロセスからのreset/stepの要求を処理する。
+要求・応答は固定長のバイナリで、クライアントは応答を待たずに次の要求を送ってよい（パイプライン）。
+1回の読み込みで届いた要求はまとめて処理し、応答もまとめて書き込む。
+
+    # サーバー
+    python env_server.py /tmp/lwm_env.sock --num-envs 64
+    # クライアント（LWMAgentからは普通のEnvironmentと同じように使える）
+    env = RemoteEnvironment('/tmp/lwm_env.sock')
+    agent = LWMAgent(env, T)
+
+要求 (8 byte):  opcode (uint8), 要求id (uint32), 環境id (uint16), 行動 (uint8)
+応答 (19 byte): 要求id (uint32), status (uint8), 環境id (uint16), reward cellの位置 (int8), row (int8), column (int8),
+               報酬 (float64), 終了したか (bool)
+LAYOUTの応答だけは、reward cellの位置の欄にレイアウト(LAYOUT_NAMESのindex)、報酬の欄にmove_probを入れる。
+範囲外の行動や、借りていない環境への要求にはstatus ERRORを返す（接続は切らない）。
+"""
+
+import argparse
+import asyncio
+import itertools
+import socket
+import struct
+
+from LWM_expt_02 import Environment, make_envs, LAYOUTS
+
+REQUEST = struct.Struct('<BIHB')
+RESPONSE = struct.Struct('<IBHbbbd?')
+
+# opcode
+ALLOC, RESET, STEP, FREE, LAYOUT = range(5)
+# status
+OK, TERMINAL, ERROR = range(3)
+
+LAYOUT_NAMES = sorted(LAYOUTS) # LAYOUTの応答でのレイアウトの番号
+NUM_ACTIONS = 4 # Environment.actions
+
+
+class EnvServer():
+    '''
+    num_envs個の環境を持ち、ALLOCで空いている環境を貸し出す
+    貸し出した環境へのRESET, STEP, FREEは、ALLOCした接続からのものだけを受け付ける
+    '''
+    def __init__(self, path, num_envs=64, grid_type='A', move_prob=1.0, seed=None):
+        self.path = path
+        self.grid_type = grid_type
+        self.move_prob = move_prob
+        self.envs = make_envs(num_envs, grid_type=grid_type, move_prob=move_prob, seed=seed)
+        self.free = list(range(num_envs))[::-1]
+        self.owners = [None] * num_envs # 各環境を借りている接続の番号（空いている環境はNone）
+        self._client_ids = itertools.count()
+        self.num_requests = 0
+
+    def handle(self, opcode, env_id, action, client):
+        '''
+        1つの要求を処理して (status, 環境id, reward cellの位置, row, column, 報酬, 終了したか) を返す
+            client : 要求を送った接続の番号
+        '''
+        if opcode == LAYOUT:
+            return OK, 0, LAYOUT_NAMES.index(self.grid_type), -1, -1, self.move_prob, False
+        if opcode == ALLOC:
+            if not self.free:
+                return ERROR, 0, -1, -1, -1, 0.0, False
+            env_id = self.free.pop()
+            self.owners[env_id] = client
+            env = self.envs[env_id]
+            return OK, env_id, env.goal_index, env.state.row, env.state.column, 0.0, False
+        if not 0 <= env_id < len(self.envs) or self.owners[env_id] != client:
+            # 借りていない環境は操作できない
+            return ERROR, env_id, -1, -1, -1, 0.0, False
+        env = self.envs[env_id]
+        if opcode == RESET:
+            goal_index = env.reset()
+            return OK, env_id, goal_index, env.state.row, env.state.column, 0.0, False
+        if opcode == STEP:
+            if not 0 <= action < NUM_ACTIONS:
+                return ERROR, env_id, -1, -1, -1, 0.0, False
+            next_state, reward, done = env.step(action)
+            if next_state is None:
+                return TERMINAL, env_id, env.goal_index, env.state.row, env.state.column, 0.0, True
+            return OK, env_id, env.goal_index, env.state.row, env.state.column, reward, done
+        if opcode == FREE:
+            self.owners[env_id] = None
+            self.free.append(env_id)
+            return OK, env_id, -1, -1, -1, 0.0, False
+        return ERROR, env_id, -1, -1, -1, 0.0, False
+
+    async def _serve_client(self, reader, writer):
+        client = next(self._client_ids)
+        buffer = b''
+        allocated = set()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+                count = len(buffer) // REQUEST.size
+                responses = bytearray()
+                for opcode, request_id, env_id, action in REQUEST.iter_unpack(buffer[:count * REQUEST.size]):
+                    result = self.handle(opcode, env_id, action, client)
+                    if opcode == ALLOC and result[0] == OK:
+                        allocated.add(result[1])
+                    elif opcode == FREE and result[0] == OK:
+                        allocated.discard(env_id)
+                    responses += RESPONSE.pack(request_id, *result)
+                buffer = buffer[count * REQUEST.size:]
+                self.num_requests += count
+                writer.write(responses)
+                await writer.drain()
+        finally:
+            # 切断したクライアントの環境は返してもらう
+            for env_id in allocated:
+                self.owners[env_id] = None
+            self.free.extend(allocated)
+            writer.close()
+
+    async def serve(self, ready=None):
+        server = await asyncio.start_unix_server(self._serve_client, path=self.path)
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def run(self, ready=None):
+        asyncio.run(self.serve(ready))
+
+
+class EnvClient():
+    '''
+    サーバーとの同期の接続. request()は応答を待つ. send()で送った要求の応答はreceive()で順に受けとる（パイプライン）
+    '''
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self._request_ids = itertools.count()
+        self._buffer = b''
+
+    def send(self, opcode, env_id=0, action=0):
+        request_id = next(self._request_ids) & 0xffffffff
+        self.sock.sendall(REQUEST.pack(opcode, request_id, env_id, action))
+        return request_id
+
+    def receive(self):
+        while len(self._buffer) < RESPONSE.size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise Exception("environment server closed the connection")
+            self._buffer += data
+        response = RESPONSE.unpack(self._buffer[:RESPONSE.size])
+        self._buffer = self._buffer[RESPONSE.size:]
+        return response
+
+    def request(self, opcode, env_id=0, action=0):
+        request_id = self.send(opcode, env_id, action)
+        response = self.receive()
+        if response[0] != request_id:
+            raise Exception("unexpected response %d for request %d" % (response[0], request_id))
+        if response[1] == ERROR:
+            raise Exception("environment server could not handle opcode %d for env %d" % (opcode, env_id))
+        return response
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteEnvironment(Environment):
+    '''
+    サーバー上の環境を1つ借りて使うEnvironment. 状態遷移はサーバーで行い、観測は手元で作る
+        grid_type : Noneの場合はサーバーのレイアウトを使う. 指定してサーバーと違う場合は例外を投げる
+    '''
+    def __init__(self, path, grid_type=None):
+        self.client = EnvClient(path)
+        self.env_id = None
+        # 観測はサーバーと同じレイアウトで作らないと、サーバーの状態と合わない
+        _, _, _, layout, _, _, move_prob, _ = self.client.request(LAYOUT)
+        server_grid_type = LAYOUT_NAMES[layout]
+        if grid_type is not None and grid_type != server_grid_type:
+            self.client.close()
+            raise Exception("grid_type '%s' does not match the server's layout '%s'" % (grid_type, server_grid_type))
+        super().__init__(grid_type=server_grid_type, move_prob=move_prob)
+        # 借りた環境の今の状態をそのまま使う（episodeはreset()から始める）
+        response = self.client.request(ALLOC)
+        self.env_id = response[2]
+        self._apply(response)
+
+    def _apply(self, response):
+        _, status, _, goal_index, row, column, reward, done = response
+        if goal_index != self.goal_index:
+            # Environment.reset()と同じく、テーブルのgridとマスの種類の表を使う（作り直さない）
+            self.goal_index = goal_index
+            self._grid = self.grid_table[goal_index]
+            self._attributes = self._attribute_table[goal_index]
+        # Stateは環境が持っているものを共有する
+        self.state = self._cells[row * self._columns + column]
+        return status, reward, done
+
+    def reset(self):
+        if self.env_id is None:
+            # Environment.__init__から呼ばれたとき（まだサーバーの環境を借りていない）
+            return super().reset()
+        self._apply(self.client.request(RESET, self.env_id))
+        return self.goal_index
+
+    def step(self, action):
+        status, reward, done = self._apply(self.client.request(STEP, self.env_id, action))
+        if status == TERMINAL:
+            return None, None, True
+        return self.state, reward, done
+
+    def close(self):
+        self.client.request(FREE, self.env_id)
+        self.client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help="Unixソケットのパス")
+    parser.add_argument('--num-envs', type=int, default=64)
+    parser.add_argument('--grid-type', default='A')
+    parser.add_argument('--move-prob', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    EnvServer(args.path, num_envs=args.num_envs, grid_type=args.grid_type, move_prob=args.move_prob, seed=args.seed).run()
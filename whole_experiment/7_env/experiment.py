@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""設定ファイル・コマンドライン引数から実験を組み立てて実行する
+
+    # 学習. 設定はJSONで与え、--setで個別に上書きする（ドット区切りでLWMAgentの引数も指定できる）
+    python experiment.py train --config config.json --set T=36 --set agent.lmd_ent=0.05
+    # 学習済みの重みを探索ノイズなしで評価する（checkpointは'best', 'last'またはepisode番号）
+    python experiment.py eval --config runs/<name>/config.json --checkpoint best --episodes 100
+    # LBNの入力（全体観測）と出力(beta)のt-SNEを画像に保存する
+    python experiment.py visualize --config runs/<name>/config.json
+    # 強化学習の前にVAE_Seq, LBNを事前学習する（2000 episodeを記録してから）
+    python experiment.py train --set pretrain.episodes=2000 --set pretrain.vae_epochs=200
+    # 設定を検証して、全ての値を埋めたものを表示する
+    python experiment.py config --set agent.controller_mode=ppo
+    # 同じマシンで8個の学習を同時に動かすうちのi番目（コアを8等分して使う）
+    python experiment.py train --set concurrent_runs=8 --set run_index=$i --set intra_op_threads=auto --set cpu_affinity=auto
+
+1つの実験は<output_dir>/<name>に保存する（nameを指定しない場合は設定のハッシュ）
+    config.json       全ての値を埋めた設定
+    logs/             TensorBoardのログ
+    checkpoints/      CheckpointManagerの保存先
+    pretrain_trajectories/  事前学習に使うepisode（pretrain.trajectory_dirを指定しない場合）
+"""
+
+import argparse
+import copy
+import inspect
+import json
+import os
+import random
+import sys
+
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from tqdm import tqdm
+
+from LWM_expt_02 import Environment, LWMAgent, LAYOUTS, device, invalidate_latent_caches
+from profiling import Profiler
+from trajectory import TrajectoryWriter, TrajectoryReader
+from checkpoint import CheckpointManager, config_hash, load_checkpoint
+from oracle import solve
+from threads import configure_threads
+from pretrain import (collect_trajectories, enumerate_loader, trajectory_loader, sequence_loader,
+                      pretrain_vae, pretrain_lbn)
+
+DEFAULT_CONFIG = {
+    'name': None, # 実験の名前（Noneの場合は設定のハッシュ）
+    'output_dir': './runs',
+    'seed': None,
+    'grid_type': 'A',
+    'move_prob': 1.0,
+    'T': 56, # エピソードの最大ステップ数
+    'num_episode': 200000, # 学習エピソード数
+    'test_interval': 100,
+    'log_interval': 5000,
+    'checkpoint_top_k': 3,
+    'checkpoint_keep_last': 2,
+    'profile': False, # Trueにすると処理時間の内訳をlog_intervalごとに表示・記録する
+    'trace_dir': None, # 指定するとtorch.profilerのtraceも書き出す
+    'record_dir': None, # 指定すると学習時のepisodeを記録する（オフラインでの学習に使う）
+    # スレッド数・CPU affinity（threads.configure_threadsの引数）. 同じマシンで複数の学習を動かす場合は
+    # concurrent_runsとrun_indexを与え、'auto'でコアを分ける
+    'intra_op_threads': None,
+    'inter_op_threads': None,
+    'cpu_affinity': None,
+    'concurrent_runs': 1,
+    'run_index': 0,
+    'agent': {'latent_cache': True}, # LWMAgentの引数（指定しなかったものはLWMAgentのデフォルト）
+    'pretrain': {}, # 強化学習の前のVAE_Seq, LBNの事前学習（指定しなかったものはPRETRAIN_DEFAULTS）
+}
+
+# 事前学習の設定（pretrain.py）. episodesが0の場合は事前学習しない
+PRETRAIN_DEFAULTS = {
+    'episodes': 0, # 学習せずにagentを動かして記録するepisode数（LBNの学習に使う）
+    'trajectory_dir': None, # 記録先（Noneの場合は<実験のディレクトリ>/pretrain_trajectories）. 既にあるepisodeは使い回す
+    'vae_data': 'enumerate', # VAE_Seqの学習データ. 'enumerate'（全ての部分観測）または'trajectories'（記録したepisodeの観測）
+    'vae_epochs': 200,
+    'vae_lr': 1e-3,
+    'vae_batch_size': 256,
+    'lbn_epochs': 20,
+    'lbn_lr': 1e-4,
+    'lbn_batch_size': 64,
+    'num_workers': 2, # 記録したepisodeを読み込むDataLoaderのworker数
+}
+
+# 設定の中の入れ子のdict（'agent.xxx', 'pretrain.xxx'の形で上書きできる）
+_SECTIONS = ('agent', 'pretrain')
+
+# 実行環境だけに関わる設定（結果は変わらないので、実験のハッシュには含めない）
+_RUNTIME_KEYS = ('name', 'intra_op_threads', 'inter_op_threads', 'cpu_affinity', 'concurrent_runs', 'run_index')
+
+# 設定では指定しないLWMAgentの引数
+_AGENT_EXCLUDED = ('self', 'env', 'T', 'profiler', 'seed')
+
+
+def agent_defaults():
+    '''
+    LWMAgentの引数とデフォルト値のdict
+    '''
+    parameters = inspect.signature(LWMAgent.__init__).parameters
+    return {name: parameter.default for name, parameter in parameters.items() if name not in _AGENT_EXCLUDED}
+
+def _parse_value(text):
+    # JSONとして読めなければ文字列とする（--set grid_type=B のように書けるように）
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+def _check_type(key, value, default):
+    # デフォルト値と同じ型か（デフォルトがNoneのものは何でもよい）
+    if default is None:
+        return value
+    if isinstance(default, bool):
+        if not isinstance(value, bool):
+            raise Exception("'%s' must be a bool, got %r" % (key, value))
+    elif isinstance(default, int):
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise Exception("'%s' must be an int, got %r" % (key, value))
+    elif isinstance(default, float):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise Exception("'%s' must be a number, got %r" % (key, value))
+        value = float(value)
+    elif isinstance(default, str):
+        if not isinstance(value, str):
+            raise Exception("'%s' must be a string, got %r" % (key, value))
+    return value
+
+def load_config(path=None, overrides=()):
+    '''
+    デフォルトの設定に、path(JSON)の設定とoverrides('key=value'のlist)を順に上書きし、検証して返す
+    '''
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path) as f:
+            loaded = json.load(f)
+        sections = {section: loaded.pop(section, {}) for section in _SECTIONS}
+        config.update(loaded)
+        for section, values in sections.items():
+            config[section].update(values)
+    for override in overrides:
+        if '=' not in override:
+            raise Exception("override must be 'key=value', got %r" % override)
+        key, text = override.split('=', 1)
+        section, _, name = key.partition('.')
+        if section in _SECTIONS and name:
+            config[section][name] = _parse_value(text)
+        else:
+            config[key] = _parse_value(text)
+    return validate_config(config)
+
+def validate_config(config):
+    '''
+    未知のキー・型・値の範囲を確かめ、LWMAgentの引数を全て埋めた設定を返す
+    '''
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise Exception("unknown config keys: %s" % sorted(unknown))
+    defaults = agent_defaults()
+    unknown = set(config['agent']) - set(defaults)
+    if unknown:
+        raise Exception("unknown agent arguments: %s" % sorted(unknown))
+
+    unknown = set(config['pretrain']) - set(PRETRAIN_DEFAULTS)
+    if unknown:
+        raise Exception("unknown pretrain keys: %s" % sorted(unknown))
+
+    agent = dict(defaults)
+    agent.update(config['agent'])
+    pretrain = dict(PRETRAIN_DEFAULTS)
+    pretrain.update(config['pretrain'])
+    config = {key: _check_type(key, value, DEFAULT_CONFIG[key]) for key, value in config.items() if key not in _SECTIONS}
+    config['agent'] = {key: _check_type('agent.' + key, value, defaults[key]) for key, value in agent.items()}
+    config['pretrain'] = {key: _check_type('pretrain.' + key, value, PRETRAIN_DEFAULTS[key]) for key, value in pretrain.items()}
+    if config['grid_type'] not in LAYOUTS:
+        raise Exception("'grid_type' must be one of %s" % sorted(LAYOUTS))
+    if not 0 <= config['move_prob'] <= 1:
+        raise Exception("'move_prob' must be in [0, 1]")
+    for key in ('T', 'num_episode', 'test_interval', 'log_interval'):
+        if config[key] <= 0:
+            raise Exception("'%s' must be positive" % key)
+    if config['log_interval'] % config['test_interval'] != 0:
+        raise Exception("'log_interval' must be a multiple of 'test_interval'")
+    for key in ('intra_op_threads', 'inter_op_threads'):
+        value = config[key]
+        if value is not None and value != 'auto' and not (isinstance(value, int) and value > 0):
+            raise Exception("'%s' must be a positive int or 'auto'" % key)
+    affinity = config['cpu_affinity']
+    if affinity is not None and affinity != 'auto' and not (isinstance(affinity, list) and all(isinstance(cpu, int) for cpu in affinity)):
+        raise Exception("'cpu_affinity' must be a list of CPU numbers or 'auto'")
+    if not 0 <= config['run_index'] < config['concurrent_runs']:
+        raise Exception("'run_index' must be in [0, concurrent_runs)")
+    pretrain = config['pretrain']
+    for key in ('episodes', 'vae_epochs', 'lbn_epochs', 'num_workers'):
+        if pretrain[key] < 0:
+            raise Exception("'pretrain.%s' must be >= 0" % key)
+    for key in ('vae_batch_size', 'lbn_batch_size'):
+        if pretrain[key] <= 0:
+            raise Exception("'pretrain.%s' must be positive" % key)
+    if pretrain['vae_data'] not in ('enumerate', 'trajectories'):
+        raise Exception("'pretrain.vae_data' must be 'enumerate' or 'trajectories'")
+    return config
+
+def experiment_config(config):
+    '''
+    実行環境だけに関わる設定を除いた設定（ハッシュの計算用）
+    '''
+    return {key: value for key, value in config.items() if key not in _RUNTIME_KEYS}
+
+def run_dir(config):
+    '''
+    実験の保存先 <output_dir>/<name>
+    '''
+    name = config['name'] or config_hash(experiment_config(config))
+    return os.path.join(config['output_dir'], name)
+
+def build(config):
+    '''
+    設定から環境とagentを作る
+    '''
+    configure_threads(config['intra_op_threads'], config['inter_op_threads'], config['cpu_affinity'],
+                      concurrent_runs=config['concurrent_runs'], run_index=config['run_index'])
+    env_seed, agent_seed = None, None
+    if config['seed'] is not None:
+        # 環境とagentは同じseedから作った独立な乱数列を使う. グローバルな乱数はテスト(get_greedy_action)のノイズのために固定する
+        env_seed, agent_seed = np.random.SeedSequence(config['seed']).spawn(2)
+        torch.manual_seed(config['seed'])
+        np.random.seed(config['seed'])
+        random.seed(config['seed'])
+    env = Environment(grid_type=config['grid_type'], move_prob=config['move_prob'], seed=env_seed)
+    agent = LWMAgent(env, config['T'], seed=agent_seed, **config['agent'])
+    return env, agent
+
+def pretrain_agent(config, env, agent, directory):
+    '''
+    config['pretrain']の設定で、episodeを記録してVAE_Seq, LBNを事前学習する（episodesが0の場合は何もしない）
+    '''
+    settings = config['pretrain']
+    if settings['episodes'] == 0:
+        return
+    trajectory_dir = settings['trajectory_dir'] or os.path.join(directory, 'pretrain_trajectories')
+    recorded = len(TrajectoryReader(trajectory_dir)) if os.path.exists(os.path.join(trajectory_dir, 'meta.json')) else 0
+    if recorded < settings['episodes']:
+        collect_trajectories(agent, env, trajectory_dir, settings['episodes'] - recorded, config['T'])
+    print("Pretraining on %d recorded episodes" % max(recorded, settings['episodes']))
+
+    if settings['vae_data'] == 'enumerate':
+        vae_loader = enumerate_loader(env.grid_type, batch_size=settings['vae_batch_size'])
+    else:
+        vae_loader = trajectory_loader(trajectory_dir, batch_size=settings['vae_batch_size'], num_workers=settings['num_workers'])
+    pretrain_vae(agent.vae, vae_loader, settings['vae_epochs'], lr=settings['vae_lr'])
+    pretrain_lbn(agent.vae, agent.lbn, sequence_loader(trajectory_dir, batch_size=settings['lbn_batch_size'],
+                                                       num_workers=settings['num_workers']),
+                 settings['lbn_epochs'], lr=settings['lbn_lr'], token_message=agent.token_message)
+    # 事前学習はLWMAgentのoptimizerを通さないので、キャッシュした潜在変数を捨てる
+    invalidate_latent_caches(agent.networks())
+
+def save_config(config, directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=1, sort_keys=True)
+
+def train(config):
+    '''
+    設定どおりに学習する. 設定はログ・checkpointと同じディレクトリに保存する
+    '''
+    directory = run_dir(config)
+    save_config(config, directory)
+    env, agent = build(config)
+    pretrain_agent(config, env, agent, directory)
+    T, num_episode = config['T'], config['num_episode']
+    test_interval, log_interval = config['test_interval'], config['log_interval']
+
+    # ログ
+    writer = SummaryWriter(log_dir=os.path.join(directory, 'logs')) # TensorBoardの設定
+    profile = config['profile']
+    profiler = Profiler(enabled=profile, trace_dir=config['trace_dir'])
+    agent.profiler = profiler
+    record_dir = config['record_dir']
+    recorder = None if record_dir is None else TrajectoryWriter(record_dir, grid_type=env.grid_type, m_length=agent.speaker.m_length)
+    checkpoints = CheckpointManager(os.path.join(directory, 'checkpoints'), metric='test_success_rate',
+                                    top_k=config['checkpoint_top_k'], keep_last=config['checkpoint_keep_last'],
+                                    config=experiment_config(config))
+    success_rate = 0
+    test_success_rate = 0
+
+    for episode in tqdm(range(num_episode)):
+        profiler.episode(episode)
+        goal_index = env.reset()
+        for t in range(T):
+            action, prob, state_value, action_prob = agent.get_action(t, env)  #  行動を選択
+            state = env.state
+            with profiler.section('env.step'):
+                next_state, reward, done = env.step(action)
+            agent.add_ctrl_memory(reward, prob, action_prob, state_value)
+            if recorder is not None:
+                recorder.add_step(state, action, reward, agent.message_tokens)
+            #　エピソードが終了、エピソードの最大ステップ数に到達したら
+            if done or t==T-1:
+                if done:
+                    success_rate += 1
+                if recorder is not None:
+                    recorder.end_episode(goal_index, done)
+                vae_loss, lbn_kl, lbn_reconst, actor_loss, critic_loss, entropy_loss, speaker_negent, speaker_rec = agent.update()
+                agent.reset_memory() # パラメタが更新されているので
+                break
+
+        # テスト 探索ノイズなしでの性能を評価する
+        if (episode + 1) % test_interval == 0:
+            test_success_rate += run_greedy_episode(agent, env, T)
+
+        # 記録する
+        writer.add_scalar("t", t, episode+1)
+        writer.add_scalar("vae loss", vae_loss.item(), episode+1)
+        writer.add_scalar("lbn kl", lbn_kl.item(), episode+1)
+        writer.add_scalar("lbn reconst", lbn_reconst.item(), episode+1)
+        writer.add_scalar("actor loss", actor_loss.item(), episode+1)
+        writer.add_scalar("critic loss", critic_loss.item(), episode+1)
+        writer.add_scalar("entropy loss", entropy_loss.item(), episode+1)
+        writer.add_scalar("speaker negent", speaker_negent.item(), episode+1)
+        writer.add_scalar("speaker rec", speaker_rec.item(), episode+1)
+
+        if (episode+1) % log_interval == 0:
+            success_rate /= log_interval
+            test_success_rate /= (log_interval / test_interval)
+
+            writer.add_scalar("success rate", success_rate, episode+1)
+            writer.add_scalar("test success rate", test_success_rate, episode+1)
+
+            # messageの数と、その計算量（テストのepisodeも含む）
+            messages = agent.message_schedule.stats()
+            agent.message_schedule.reset_stats()
+            writer.add_scalar("messages per episode", messages['messages_per_episode'], episode+1)
+            writer.add_scalar("speaker flops per episode", messages['speaker_flops_per_episode'], episode+1)
+            writer.add_scalar("schedule flops per episode", messages['schedule_flops_per_episode'], episode+1)
+
+            print("Episode %d finished | Success rate %f" % (episode+1, success_rate))
+            print("Episode %d finished | Test success rate %f" % (episode+1, test_success_rate))
+            print("Episode %d finished | Messages per episode %.2f" % (episode+1, messages['messages_per_episode']))
+            if profile:
+                print(profiler.summary())
+                profiler.write(writer, episode+1)
+                profiler.reset()
+
+            # 重みとoptimizerの状態の保存（test success rateが上位のものと最新のものを残す）
+            checkpoints.save(agent.networks(), episode+1, {'success_rate': success_rate, 'test_success_rate': test_success_rate},
+                             optimizers=agent.optimizers())
+
+            success_rate = 0
+            test_success_rate = 0
+
+    # writerを閉じる
+    writer.close()
+    checkpoints.close()
+    if recorder is not None:
+        recorder.close()
+    return agent
+
+def run_greedy_episode(agent, env, T):
+    '''
+    探索ノイズなしで1 episode行い、reward cellに到達したかを返す
+    '''
+    env.reset()
+    with torch.no_grad():
+        for t in range(T):
+            action = agent.get_greedy_action(t, env)  #  行動を選択
+            next_state, reward, done = env.step(action)
+            #　エピソードが終了、エピソードの最大ステップ数に到達したら
+            if done or t==T-1:
+                agent.reset_memory()
+                return bool(done)
+
+def load_weights(config, agent, checkpoint='best', legacy_dir=None):
+    '''
+    実験のcheckpoint（'best', 'last'またはepisode番号）を読み込む
+    legacy_dirを指定した場合は、以前の形式の <モジュール名>_<checkpoint>.pth を読み込む
+    '''
+    networks = agent.networks()
+    if legacy_dir is None:
+        entry = load_checkpoint(os.path.join(run_dir(config), 'checkpoints'), networks, which=checkpoint, map_location=device)
+        return "episode %d %s" % (entry['episode'], entry['metrics'])
+    paths = {name: os.path.join(legacy_dir, '%s_%s.pth' % (name, checkpoint)) for name in networks}
+    missing = [path for path in paths.values() if not os.path.exists(path)]
+    if missing:
+        raise Exception("missing weights: %s" % missing)
+    for name, module in networks.items():
+        module.load_state_dict(torch.load(paths[name], map_location=device))
+    return ', '.join(paths.values())
+
+def evaluate(config, episodes=100, checkpoint='best', legacy_dir=None):
+    '''
+    学習済みの重みを探索ノイズなしでepisodes回試し、success rateを返す（最適方策のsuccess rateと並べて表示する）
+    '''
+    env, agent = build(config)
+    source = load_weights(config, agent, checkpoint, legacy_dir)
+    success_rate = np.mean([run_greedy_episode(agent, env, config['T']) for _ in tqdm(range(episodes))])
+    optimal = solve(config['grid_type'], config['T'], config['move_prob']).success_rate
+    print("%s: success rate %.3f (optimal %.3f)" % (source, success_rate, optimal))
+    return success_rate
+
+def visualize(config, checkpoint='best', legacy_dir=None, output_dir=None, samples=1000):
+    '''
+    reward cellの位置ごとに、全体観測(lbn_input.jpg)と、そのmessageを受けとったLBNのbetaをsamples回サンプリングしたもののt-SNE(lbn_output.jpg)を保存する
+    '''
+    import matplotlib.pyplot as plt
+    from sklearn.manifold import TSNE
+
+    output_dir = run_dir(config) if output_dir is None else output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    env, agent = build(config)
+    load_weights(config, agent, checkpoint, legacy_dir)
+    num_goals = len(env.grid_table)
+
+    with torch.no_grad():
+        fig, ax = plt.subplots(1, num_goals, figsize=(3 * num_goals, 3), squeeze=False)
+        betas = []
+        goals = []
+        for goal_index in range(num_goals):
+            env.reset()
+            env.goal_index = goal_index
+            env.grid = env.grid_table[goal_index]
+            x_glb = env.observation(partial=False)
+            ax[0, goal_index].imshow(x_glb)
+
+            m = agent.speak(x_glb.permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device))
+            x_part = env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9).to(device)
+            _, z_init = agent.vae(x_part)
+            mean, std = agent.lbn._encoder(z_init.expand(samples, -1), m.expand(samples, *m.shape[1:]))
+            betas.append(agent.lbn._sample_beta(mean, std).cpu().numpy())
+            goals += [goal_index] * samples
+        fig.savefig(os.path.join(output_dir, 'lbn_input.jpg'))
+
+    embedded = TSNE(n_components=2).fit_transform(np.concatenate(betas)).T
+    colors = ['red', 'blue', 'green', 'magenta', 'cyan', 'yellow']
+    plt.figure(figsize=(8, 8))
+    plt.scatter(embedded[0], embedded[1], s=0.7, c=[colors[goal] for goal in goals])
+    plt.savefig(os.path.join(output_dir, 'lbn_output.jpg'))
+
+
+def _checkpoint_arg(text):
+    return int(text) if text.isdigit() else text
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="LWMAgentの学習・評価・可視化")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('train', 'eval', 'visualize', 'config'):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument('--config', default=None, help="設定のJSONファイル")
+        subparser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                               help="設定の上書き. 値はJSONとして読む（例 T=36, agent.lmd_ent=0.05）")
+        if command in ('eval', 'visualize'):
+            subparser.add_argument('--checkpoint', type=_checkpoint_arg, default='best', help="'best', 'last'またはepisode番号")
+            subparser.add_argument('--legacy-dir', default=None, help="以前の形式の<モジュール名>_<checkpoint>.pthがあるディレクトリ")
+        if command == 'eval':
+            subparser.add_argument('--episodes', type=int, default=100)
+        if command == 'visualize':
+            subparser.add_argument('--output-dir', default=None)
+    args = parser.parse_args(argv)
+    config = load_config(args.config, args.set)
+
+    if args.command == 'train':
+        train(config)
+    elif args.command == 'eval':
+        evaluate(config, episodes=args.episodes, checkpoint=args.checkpoint, legacy_dir=args.legacy_dir)
+    elif args.command == 'visualize':
+        visualize(config, checkpoint=args.checkpoint, legacy_dir=args.legacy_dir, output_dir=args.output_dir)
+    else:
+        json.dump(config, sys.stdout, indent=1, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""話し手がmessageを送るタイミングを決めるスケジュールと、その通信・計算量の記録
+
+messageを送るたびにSpeakerの畳み込みを1回実行するので、送る回数を減らせば話し手の計算が減る。
+t=0では必ず送り（LBNのbetaを新しいepisodeのものにするため）、それ以降は各スケジュールが決める。
+
+    'probability' : 確率probで送る（今まで通り. LWMAgentのデフォルトはprob=message_prob）
+    'interval'    : intervalステップごとに送る
+    'uncertainty' : 最後に受けとったmessageと今のzでLBNのEncoderを計算し、betaのstdの平均がthresholdを超えたら送る
+                    （話し手の代わりに聞き手側の小さいEncoderを毎ステップ実行する）
+    'gate'        : zとbetaから送る確率を出す小さいネットワーク. episodeの報酬の和から、送ったmessage 1回あたりcostを
+                    引いたものを報酬としてREINFORCEで学習する
+
+    agent = LWMAgent(env, T, message_schedule={'type': 'interval', 'interval': 4})
+    ...
+    print(agent.message_schedule.stats())    # 1 episodeあたりのmessageの数とFLOPs
+
+スケジュールはLWMAgentの学習(get_action)・テスト(get_greedy_action)とRolloutEngineのどちらでも使う。
+"""
+
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.flop_counter import FlopCounterMode
+
+
+def _count_flops(fn):
+    # fnを1回実行したときの浮動小数点演算の回数
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        fn()
+    return counter.get_total_flops()
+
+
+class MessageSchedule():
+    '''
+    スケジュールの基底クラス. _decide()で t>0 のステップに送るかを決める
+    送った回数と、Speakerとスケジュール自身の計算量を記録する
+    '''
+    trainable = False # Trueの場合はLWMAgentの更新のたびにupdate()を呼ぶ
+    needs_latent = False # Trueの場合は_decide()でzを使う（テストでもzを計算する）
+    module = None # 学習するnn.Module（重みの保存・共有のためにLWMAgent.networks()に含める）
+
+    def __init__(self):
+        self.agent = None
+        self._flops = None
+        self._t = torch.zeros(1, dtype=torch.long) # decide_one()で_decide()に渡す時刻
+        self.reset_stats()
+
+    def bind(self, agent):
+        '''
+        LWMAgentから呼ばれる. agentのLBN, Speaker, 乱数(agent.rng)を使う
+        '''
+        self.agent = agent
+
+    def reset_stats(self):
+        self.num_episodes = 0
+        self.num_steps = 0
+        self.num_messages = 0
+        self.num_decisions = 0 # _decide()で判断したステップの数（スケジュールの計算量の分）
+
+    def decide(self, t, z, beta, message_last):
+        '''
+        各環境がこのステップでmessageを送るかを返す (batch) のbool tensor
+            t : 各環境の時刻 (batch) のLongTensor
+            z : 今の部分観測のz (batch, z_dim). needs_latentがFalseの場合はNoneでもよい
+            beta : 前のステップまでのbeta (batch, beta_dim). t=0の環境の値は使わない
+            message_last : 最後に受けとったmessage (batch, ...). t=0の環境の値は使わない
+        '''
+        send = t == 0
+        later = (~send).nonzero()[:, 0]
+        if len(later) > 0:
+            # needs_latentがFalseのスケジュールではzはNoneでもよい
+            pick = lambda x: None if x is None else x[later]
+            send[later] = self._decide(t[later], pick(z), pick(beta), pick(message_last)).to(send.device)
+        self.num_episodes += int((t == 0).sum())
+        self.num_steps += len(t)
+        self.num_messages += int(send.sum())
+        self.num_decisions += len(later)
+        return send
+
+    def decide_one(self, t, z, beta, message_last):
+        '''
+        1つの環境でdecide()と同じ判断をしてboolを返す（LWMAgentの1ステップごとの行動選択用）
+            t : 時刻(int)
+            z, beta, message_last : batchが1のtensor（t=0の場合は使わない）
+        '''
+        send = t == 0 or bool(self._decide_one(t, z, beta, message_last))
+        self.num_episodes += t == 0
+        self.num_steps += 1
+        self.num_messages += send
+        self.num_decisions += t != 0
+        return send
+
+    def _decide(self, t, z, beta, message_last):
+        raise NotImplementedError
+
+    def _decide_one(self, t, z, beta, message_last):
+        # 時刻のtensorを作らずに_decide()を呼ぶ. 乱数や計算が1環境で済むスケジュールは上書きする
+        self._t[0] = t
+        return self._decide(self._t, z, beta, message_last)[0]
+
+    def update(self, z, beta, message_mask, rewards, offsets):
+        '''
+        学習するスケジュールの更新. 引数はPackedEpisodesの列と同じ形（betaは各ステップの後の値）
+        '''
+        return None
+
+    def _decision_flops(self, z, beta, message_last):
+        # _decide()の1回あたりの計算量（乱数を引くだけのものは0）
+        return 0
+
+    def state_dict(self):
+        '''
+        moduleの重み以外の学習の状態（checkpointに保存する）
+        '''
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+    def flops_per_call(self):
+        '''
+        (Speakerの1回あたりのFLOPs, _decide()の1回あたりのFLOPs). 最初に呼ばれたときに計測する
+        '''
+        if self._flops is None:
+            agent = self.agent
+            # Speaker.forwardはx_glbを記憶するので、コピーで計測する
+            speaker = copy.deepcopy(agent.speaker)
+            param = next(agent.lbn.parameters())
+            z = torch.zeros(1, agent.lbn.z_dim, device=param.device)
+            beta = torch.zeros(1, agent.lbn.beta_dim, device=param.device)
+            with torch.no_grad():
+                message, tokens = speaker(torch.zeros(1, 3, 9, 9, device=param.device))
+            message_last = tokens if agent.token_message else message.view(1, -1)
+            self._flops = (_count_flops(lambda: speaker(torch.zeros(1, 3, 9, 9, device=param.device))),
+                           self._decision_flops(z, beta, message_last))
+        return self._flops
+
+    def stats(self):
+        '''
+        これまでの記録. 1 episodeあたりのmessageの数と計算量、全ステップのうちmessageを送った割合など
+        '''
+        speaker_flops, decision_flops = self.flops_per_call()
+        episodes = max(self.num_episodes, 1)
+        return {'episodes': self.num_episodes, 'steps': self.num_steps, 'messages': self.num_messages,
+                'messages_per_episode': self.num_messages / episodes,
+                'send_rate': self.num_messages / max(self.num_steps, 1),
+                'speaker_flops_per_episode': speaker_flops * self.num_messages / episodes,
+                'schedule_flops_per_episode': decision_flops * self.num_decisions / episodes}
+
+
+class ProbabilitySchedule(MessageSchedule):
+    '''
+    t>0の各ステップで確率probで送る
+    '''
+    def __init__(self, prob=0.5):
+        super().__init__()
+        self.prob = prob
+
+    def _decide(self, t, z, beta, message_last):
+        # 1環境の場合は今まで(self.rng.random()を1回)と同じ乱数列になる
+        return torch.from_numpy(self.agent.rng.random(len(t)) < self.prob)
+
+    def _decide_one(self, t, z, beta, message_last):
+        return self.agent.rng.random() < self.prob
+
+
+class IntervalSchedule(MessageSchedule):
+    '''
+    intervalステップごと（t % interval == 0）に送る
+    '''
+    def __init__(self, interval=4):
+        super().__init__()
+        if interval < 1:
+            raise Exception("'interval' must be >= 1")
+        self.interval = interval
+
+    def _decide(self, t, z, beta, message_last):
+        return t % self.interval == 0
+
+    def _decide_one(self, t, z, beta, message_last):
+        return t % self.interval == 0
+
+
+class UncertaintySchedule(MessageSchedule):
+    '''
+    最後に受けとったmessageと今のzから求めたbetaのstdの平均がthresholdを超えたら送る
+    '''
+    needs_latent = True
+
+    def __init__(self, threshold=0.5):
+        super().__init__()
+        self.threshold = threshold
+
+    def uncertainty(self, z, message_last):
+        '''
+        message_lastのままでの信念の不確かさ（LBNのEncoderのstdの平均） (batch)
+        '''
+        with torch.no_grad(), self.agent.autocast('lbn'):
+            _, std = self.agent.lbn._encoder(z, message_last)
+        return std.mean(dim=1)
+
+    def _decide(self, t, z, beta, message_last):
+        return self.uncertainty(z, message_last) > self.threshold
+
+    def _decision_flops(self, z, beta, message_last):
+        return _count_flops(lambda: self.agent.lbn._encoder(z, message_last))
+
+
+class MessageGate(nn.Module):
+    '''
+    (z, 前のステップまでのbeta)からmessageを送る確率のlogitを出力する
+    '''
+    def __init__(self, z_dim, beta_dim, hidden_dim=32):
+        super().__init__()
+        self.dense1 = nn.Linear(z_dim + beta_dim, hidden_dim)
+        self.dense2 = nn.Linear(hidden_dim, 1)
+
+    def forward(self, z, beta):
+        x = F.relu(self.dense1(torch.cat([z, beta], dim=1)))
+        return self.dense2(x).squeeze(1)
+
+
+class GateSchedule(MessageSchedule):
+    '''
+    MessageGateが出力した確率で送る
+        cost : 送ったmessage 1回あたりに報酬から引く値（大きいほど送らなくなる）
+        lr : MessageGateの学習率
+        baseline_decay : REINFORCEのベースライン（報酬の指数移動平均）の減衰率
+    '''
+    trainable = True
+    needs_latent = True
+
+    def __init__(self, cost=0.05, lr=1e-3, hidden_dim=32, baseline_decay=0.99):
+        super().__init__()
+        self.cost = cost
+        self.lr = lr
+        self.hidden_dim = hidden_dim
+        self.baseline_decay = baseline_decay
+        self.baseline = None
+
+    def bind(self, agent):
+        super().bind(agent)
+        param = next(agent.lbn.parameters())
+        self.module = MessageGate(agent.lbn.z_dim, agent.lbn.beta_dim, self.hidden_dim).to(param.device)
+        self.optimizer = torch.optim.Adam(self.module.parameters(), lr=self.lr)
+        self.scaler = torch.amp.GradScaler(param.device.type, enabled=False) # MessageGateはfloat32で計算する
+
+    def _decide(self, t, z, beta, message_last):
+        with torch.no_grad():
+            prob = torch.sigmoid(self.module(z.float(), beta.float())).cpu()
+        return torch.from_numpy(self.agent.rng.random(len(t))) < prob
+
+    def _decision_flops(self, z, beta, message_last):
+        return _count_flops(lambda: self.module(z, beta))
+
+    def state_dict(self):
+        return {'optimizer': self.optimizer.state_dict(), 'baseline': self.baseline}
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        self.baseline = state_dict['baseline']
+
+    def update(self, z, beta, message_mask, rewards, offsets):
+        '''
+        各episodeの (報酬の和 - cost * t>0で送ったmessageの数) を報酬として、t>0の判断をREINFORCEで更新し、lossを返す
+        '''
+        num_steps = len(z)
+        lengths = offsets[1:] - offsets[:-1]
+        episode_index = torch.repeat_interleave(torch.arange(len(lengths), device=z.device), lengths)
+        later = torch.ones(num_steps, dtype=torch.bool, device=z.device)
+        later[offsets[:-1]] = False
+        steps = later.nonzero()[:, 0]
+        # 判断のときに見ていたbetaは前のステップの後の値
+        logits = self.module(z[steps].detach().float(), beta[steps - 1].detach().float())
+        sent = message_mask[steps].to(logits.dtype)
+        log_probs = -F.binary_cross_entropy_with_logits(logits, sent, reduction='none')
+
+        returns = torch.zeros(len(lengths), device=z.device).index_add_(0, episode_index, rewards.float())
+        messages = torch.zeros(len(lengths), device=z.device).index_add_(0, episode_index[steps], sent.detach())
+        objective = returns - self.cost * messages
+        mean = float(objective.mean())
+        self.baseline = mean if self.baseline is None else self.baseline_decay * self.baseline + (1 - self.baseline_decay) * mean
+        advantages = objective - self.baseline
+        loss = -(advantages[episode_index[steps]] * log_probs).sum() / len(lengths)
+
+        # LWMAgent.gradient_hook（分散学習での勾配の平均）を通して更新する
+        self.agent.optimizer_step(self.optimizer, self.scaler, loss)
+        return loss.detach()
+
+
+SCHEDULES = {
+    'probability': ProbabilitySchedule,
+    'interval': IntervalSchedule,
+    'uncertainty': UncertaintySchedule,
+    'gate': GateSchedule,
+}
+
+def make_schedule(spec, message_prob=0.5):
+    '''
+    spec(MessageSchedule, {'type': 名前, その他の引数} またはNone)からスケジュールを作る
+    Noneの場合は確率message_probで送る（今まで通り）
+    '''
+    if spec is None:
+        return ProbabilitySchedule(message_prob)
+    if isinstance(spec, MessageSchedule):
+        return spec
+    spec = dict(spec)
+    name = spec.pop('type', None)
+    if name not in SCHEDULES:
+        raise Exception("'message_schedule' type must be one of %s" % ', '.join(sorted(SCHEDULES)))
+    return SCHEDULES[name](**spec)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""迷路の状態遷移(Environment.transit_func)から最適方策を価値反復で求める
+
+聞き手がreward cellの位置を知っている（話し手のmessageが完全に伝わった）場合の最適方策なので、
+LWMAgentのsuccess rateの上限になる。各Tでの最適なsuccess rateと、その方策でのepisodeの長さの期待値を返す。
+
+    solution = solve('A', T=56, move_prob=1.0)
+    print(solution.success_rate, solution.mean_length)
+    print(success_rate / solution.success_rate)    # 最適に対する割合
+    min_horizon('A', move_prob=0.8, target=0.9)    # success rate 0.9に届く最小のT
+
+行動は T ステップ以内にreward cellに到達する確率が最大のものを選び、同じ確率なら報酬の和の期待値が大きいものを選ぶ。
+"""
+
+import numpy as np
+
+from LWM_expt_02 import Environment, LAYOUTS, grid_table
+
+_transition_tables = {} # (grid_type, move_prob)ごとの遷移確率のキャッシュ
+_solutions = {} # (grid_type, move_prob, T)ごとの解のキャッシュ
+
+
+def transition_table(grid_type='A', move_prob=1.0):
+    '''
+    レイアウトの全てのreward cellの位置について、遷移確率などを配列にして返す
+    返り値は (状態のlist [(row, column)], 遷移確率 (候補数, 行動数, 状態数, 状態数), 報酬 (候補数, 状態数),
+             終了する状態か (候補数, 状態数), reward cellか (候補数, 状態数))
+    報酬はその状態に移ったときに受けとる値
+    '''
+    key = (grid_type, move_prob)
+    if key not in _transition_tables:
+        env = Environment(grid_type=grid_type, move_prob=move_prob)
+        table = grid_table(grid_type)
+        state_objects = env.states
+        states = [(state.row, state.column) for state in state_objects]
+        index = {state: i for i, state in enumerate(states)}
+        num_goals, num_states = len(table), len(states)
+        transitions = np.zeros((num_goals, len(env.actions), num_states, num_states))
+        rewards = np.zeros((num_goals, num_states))
+        terminal = np.zeros((num_goals, num_states), dtype=bool)
+        for goal_index in range(num_goals):
+            env.grid = table[goal_index]
+            for s, state in enumerate(state_objects):
+                rewards[goal_index, s], terminal[goal_index, s] = env.reward_func(state)
+                for a in env.actions:
+                    for next_state, prob in env.transit_func(state, a).items():
+                        transitions[goal_index, a, s, index[(next_state.row, next_state.column)]] += prob
+        success = table[:, [row for row, _ in states], [column for _, column in states]] == 1
+        _transition_tables[key] = (states, transitions, rewards, terminal, success)
+    return _transition_tables[key]
+
+
+class OracleSolution():
+    '''
+    solve()の結果
+        success_rate, mean_length : 最適方策でのsuccess rateとepisodeの長さの期待値（reward cellの位置について平均）
+        success_rates, mean_lengths : reward cellの位置ごとの値 (候補数)
+        success_by_horizon, length_by_horizon : 最大ステップ数を0~Tにしたときの値 (T+1)
+        policy : 残りkステップのときの行動 (T+1, 候補数, 状態数). policy[0]は使わない
+    '''
+    def __init__(self, grid_type, move_prob, T, states, policy, success, length):
+        self.grid_type = grid_type
+        self.move_prob = move_prob
+        self.T = T
+        self.states = states
+        self.policy = policy
+        self._index = {state: i for i, state in enumerate(states)}
+        start = self._index[LAYOUTS[grid_type]['start']]
+        self.success_by_horizon = success[:, :, start].mean(axis=1)
+        self.length_by_horizon = length[:, :, start].mean(axis=1)
+        self.success_rates = success[T, :, start]
+        self.mean_lengths = length[T, :, start]
+        self.success_rate = float(self.success_by_horizon[T])
+        self.mean_length = float(self.length_by_horizon[T])
+
+    def __repr__(self):
+        return "<OracleSolution: grid_type={}, move_prob={}, T={}, success_rate={:.3f}, mean_length={:.1f}>".format(
+            self.grid_type, self.move_prob, self.T, self.success_rate, self.mean_length)
+
+    def action(self, env, t):
+        '''
+        時刻tにenvの状態で最適方策が選ぶ行動
+        '''
+        return int(self.policy[self.T - t, env.goal_index, self._index[(env.state.row, env.state.column)]])
+
+
+def solve(grid_type='A', T=56, move_prob=1.0):
+    '''
+    最大ステップ数Tの有限ホライズンで価値反復を行い、OracleSolutionを返す（レイアウト・move_prob・Tごとにキャッシュする）
+    '''
+    key = (grid_type, move_prob, T)
+    if key in _solutions:
+        return _solutions[key]
+    states, transitions, rewards, terminal, goal = transition_table(grid_type, move_prob)
+    num_goals, num_actions, num_states, _ = transitions.shape
+    # 残りkステップのときの、reward cellに到達する確率・報酬の和・episodeの長さの期待値 (候補数, 状態数)
+    # 終了する状態ではそれ以上進まない
+    success = np.zeros((T + 1, num_goals, num_states))
+    value = np.zeros((T + 1, num_goals, num_states))
+    length = np.zeros((T + 1, num_goals, num_states))
+    policy = np.zeros((T + 1, num_goals, num_states), dtype=np.int64)
+    success[0] = goal
+    for k in range(1, T + 1):
+        # 行動ごとの期待値 (候補数, 行動数, 状態数)
+        q_success = np.einsum('gasn,gn->gas', transitions, success[k - 1])
+        q_value = np.einsum('gasn,gn->gas', transitions, rewards + np.where(terminal, 0, value[k - 1]))
+        q_length = 1 + np.einsum('gasn,gn->gas', transitions, np.where(terminal, 0, length[k - 1]))
+        # success rateが最大の行動のうち、報酬の和が最大のもの
+        best = q_success >= q_success.max(axis=1, keepdims=True) - 1e-12
+        action = np.argmax(np.where(best, q_value, -np.inf), axis=1)
+        policy[k] = action
+        take = lambda q: np.take_along_axis(q, action[:, None], axis=1)[:, 0]
+        success[k] = np.where(terminal, goal, take(q_success))
+        value[k] = np.where(terminal, 0, take(q_value))
+        length[k] = np.where(terminal, 0, take(q_length))
+    _solutions[key] = OracleSolution(grid_type, move_prob, T, states, policy, success, length)
+    return _solutions[key]
+
+def min_horizon(grid_type='A', move_prob=1.0, target=0.9, max_T=200):
+    '''
+    最適方策のsuccess rateがtarget以上になる最小の最大ステップ数T（max_Tまでで届かなければNone）
+    '''
+    reached = np.nonzero(solve(grid_type, max_T, move_prob).success_by_horizon >= target)[0]
+    return int(reached[0]) if len(reached) else None
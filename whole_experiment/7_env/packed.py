@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""長さの異なるepisodeを詰めて並べる形式
+
+各ステップの値は全episode分を1本のテンソルにつなげ、episodeの境界はoffsetsで表す（最大ステップ数に揃えない）。
+
+    offsets       (episode数+1)       i番目のepisodeはステップ offsets[i]:offsets[i+1]
+    observations  (ステップ数の合計, 3, 9, 9)  などステップごとの列
+    messages      (messageを受けとった回数の合計, ...)  message_maskがTrueのステップの分だけ、順に並べる
+"""
+
+import torch
+
+
+class PackedEpisodes():
+    '''
+    offsets : 各episodeの開始位置 (episode数+1) のLongTensor
+    messages : 受けとったmessage（ステップ数とは行数が違うので別に持つ）
+    columns : ステップごとの列. いずれも1次元目がステップ数の合計
+    '''
+    def __init__(self, offsets, messages=None, **columns):
+        self.offsets = offsets
+        self.messages = messages
+        self.columns = columns
+        num_steps = int(offsets[-1])
+        for name, column in columns.items():
+            if len(column) != num_steps:
+                raise Exception("column '%s' has %d rows for %d steps" % (name, len(column), num_steps))
+
+    @classmethod
+    def concat(cls, episodes):
+        '''
+        episodeごとの列のdict（'messages'以外は1次元目がステップ数）のlistから作る
+        '''
+        lengths = [len(next(iter(v for k, v in episode.items() if k != 'messages'))) for episode in episodes]
+        offsets = torch.zeros(len(episodes) + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(torch.tensor(lengths), 0)
+        names = [name for name in episodes[0] if name != 'messages']
+        columns = {name: torch.cat([episode[name] for episode in episodes]) for name in names}
+        messages = torch.cat([episode['messages'] for episode in episodes]) if 'messages' in episodes[0] else None
+        return cls(offsets, messages=messages, **columns)
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_steps(self):
+        return int(self.offsets[-1])
+
+    @property
+    def lengths(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    @property
+    def episode_index(self):
+        # 各ステップが何番目のepisodeか
+        return torch.repeat_interleave(torch.arange(len(self)), self.lengths)
+
+    @property
+    def step_index(self):
+        # 各ステップのepisode内での時刻
+        return torch.arange(self.num_steps) - self.offsets[:-1][self.episode_index]
+
+    def episode(self, i):
+        '''
+        i番目のepisodeをconcatに渡せるdictで返す（messagesを分けるにはmessage_maskの列が必要）
+        '''
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        episode = {name: column[start:end] for name, column in self.columns.items()}
+        if self.messages is not None:
+            message_start = int(self.message_mask[:start].sum())
+            episode['messages'] = self.messages[message_start:message_start + int(episode['message_mask'].sum())]
+        return episode
+
+    def to_padded(self, values, max_steps=None):
+        '''
+        ステップごとの値を (episode数, 最大ステップ数, ...) に並べ直し、有効なステップのmaskと一緒に返す（勾配は流れる）
+        '''
+        max_steps = int(self.lengths.max()) if max_steps is None else max_steps
+        episode_index = self.episode_index.to(values.device)
+        step_index = self.step_index.to(values.device)
+        padded = values.new_zeros(len(self), max_steps, *values.shape[1:])
+        padded[episode_index, step_index] = values
+        mask = torch.zeros(len(self), max_steps, dtype=torch.bool, device=values.device)
+        mask[episode_index, step_index] = True
+        return padded, mask
+
+    def padding_waste(self, max_steps=None):
+        '''
+        max_steps（Noneの場合は最も長いepisode）に揃えた場合に、無駄になるステップの割合
+        '''
+        max_steps = int(self.lengths.max()) if max_steps is None else max_steps
+        return 1 - self.num_steps / (len(self) * max_steps)
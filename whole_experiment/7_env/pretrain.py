@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""VAE_SeqとLBNのオフラインでの事前学習
+
+強化学習ではVAE_Seqは直近のepisodeの部分観測だけで学習するので、学習が遅くノイズも大きい。
+強化学習を始める前に、
+    1. 全ての部分観測（またはTrajectoryWriterで記録したepisodeの観測）でVAE_Seqを大きなminibatchで学習し、
+    2. 記録したepisodeの系列でLBNをまとめて学習する。
+
+    agent = LWMAgent(env, T)
+    collect_trajectories(agent, env, 'trajectories', episodes=2000, T=T)
+    pretrain_vae(agent.vae, enumerate_loader('A'), epochs=200)
+    pretrain_lbn(agent.vae, agent.lbn, sequence_loader('trajectories'), epochs=20)
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, TensorDataset
+
+from LWM_expt_02 import grid_table, device
+from trajectory import TrajectoryWriter, TrajectoryReader, render_observations
+
+
+def enumerate_partial_observations(grid_type='A'):
+    '''
+    レイアウトの全てのreward cellの位置・聞き手の位置についての部分観測を、重複を除いて返す (観測数, 3, 9, 9)
+    '''
+    table = grid_table(grid_type)
+    goals, rows, columns = np.nonzero(table != 9)
+    images = render_observations(table, goals, rows, columns, partial=True).permute(0, 3, 1, 2)
+    return torch.unique(images, dim=0)
+
+def enumerate_loader(grid_type='A', batch_size=256):
+    '''
+    enumerate_partial_observationsの観測をシャッフルして返すDataLoader（全てメモリ上にあるのでworkerは使わない）
+    '''
+    dataset = TensorDataset(enumerate_partial_observations(grid_type))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True)
+
+
+class TrajectoryObservationDataset(Dataset):
+    '''
+    記録したepisodeの各ステップの部分観測
+    観測は読み込むときに作り直すので、DataLoaderのworkerで並列に作れる
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        reader = TrajectoryReader(directory)
+        self.grid_table = reader.grid_table
+        # 各ステップの (reward cellの位置, 聞き手の位置). 1ステップ3byteなのでメモリに載せる
+        goals, rows, columns = [], [], []
+        for chunk in reader.chunks:
+            goals.append(np.repeat(chunk['goal'], np.diff(chunk['episode_offsets'])))
+            rows.append(np.asarray(chunk['row']))
+            columns.append(np.asarray(chunk['column']))
+        self.goals = np.concatenate(goals)
+        self.rows = np.concatenate(rows)
+        self.columns = np.concatenate(columns)
+
+    def __len__(self):
+        return len(self.goals)
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        # DataLoaderはminibatchのindexをまとめて渡してくるので、観測もまとめて作る
+        indices = np.asarray(indices)
+        images = render_observations(self.grid_table, self.goals[indices], self.rows[indices],
+                                     self.columns[indices], partial=True).permute(0, 3, 1, 2)
+        return list(images)
+
+def trajectory_loader(directory, batch_size=256, num_workers=2):
+    return DataLoader(TrajectoryObservationDataset(directory), batch_size=batch_size, shuffle=True,
+                      num_workers=num_workers, persistent_workers=num_workers > 0)
+
+
+class TrajectorySequenceDataset(Dataset):
+    '''
+    記録したepisodeの (部分観測の系列, messageを受けとった時刻, messageのトークン列)
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self._reader = None
+        self._length = len(TrajectoryReader(directory))
+
+    @property
+    def reader(self):
+        # memory-mapはworkerのプロセスごとに開く
+        if self._reader is None:
+            self._reader = TrajectoryReader(self.directory)
+        return self._reader
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        episode = self.reader.episode(index)
+        mask = np.array(episode['message_mask']) # memory-mapは書き込めないのでコピーする
+        images = self.reader.observations(index, partial=True).permute(0, 3, 1, 2)
+        tokens = torch.from_numpy(np.asarray(episode['tokens'][mask], dtype=np.int64))
+        return images, torch.from_numpy(mask), tokens
+
+def collate_sequences(batch):
+    '''
+    長さの異なるepisodeを最大ステップ数に揃える. 観測 (episode数, 最大ステップ数, 3, 9, 9), message_mask (episode数, 最大ステップ数),
+    トークン列 (messageを受けとった回数, m_length), 各episodeのステップ数を返す
+    '''
+    lengths = torch.tensor([len(images) for images, _, _ in batch])
+    max_steps = int(lengths.max())
+    images = torch.zeros(len(batch), max_steps, *batch[0][0].shape[1:])
+    mask = torch.zeros(len(batch), max_steps, dtype=torch.bool)
+    for i, (episode_images, episode_mask, _) in enumerate(batch):
+        images[i, :len(episode_images)] = episode_images
+        mask[i, :len(episode_mask)] = episode_mask
+    tokens = torch.cat([episode_tokens for _, _, episode_tokens in batch])
+    return images, mask, tokens, lengths
+
+def sequence_loader(directory, batch_size=64, num_workers=2):
+    return DataLoader(TrajectorySequenceDataset(directory), batch_size=batch_size, shuffle=True,
+                      num_workers=num_workers, collate_fn=collate_sequences, persistent_workers=num_workers > 0)
+
+
+def collect_trajectories(agent, env, directory, episodes, T, chunk_episodes=1000):
+    '''
+    学習せずにagentを動かしてepisodeを記録する（LBNの事前学習のmessageは、このときのSpeakerのもの）
+    '''
+    with TrajectoryWriter(directory, grid_type=env.grid_type, m_length=agent.speaker.m_length,
+                          chunk_episodes=chunk_episodes) as writer:
+        for _ in range(episodes):
+            goal_index = env.reset()
+            for t in range(T):
+                with torch.no_grad():
+                    action, _, _, _ = agent.get_action(t, env)
+                state = env.state
+                _, reward, done = env.step(action)
+                writer.add_step(state, action, reward, agent.message_tokens)
+                if done or t == T - 1:
+                    writer.end_episode(goal_index, done)
+                    agent.reset_memory()
+                    break
+
+def pretrain_vae(vae, loader, epochs, lr=1e-3, log=print):
+    '''
+    VAE_Seqをminibatchで学習する. loaderは観測 (batch, 3, 9, 9) のminibatchを返す
+    '''
+    optimizer = torch.optim.Adam(vae.parameters(), lr=lr)
+    for epoch in range(epochs):
+        total_kl, total_reconst, count = 0, 0, 0
+        for x in loader:
+            if isinstance(x, (list, tuple)):
+                x = x[0]
+            x = x.to(device, non_blocking=True)
+            kl, reconst = vae.loss(x)
+            optimizer.zero_grad()
+            (kl + reconst).backward()
+            optimizer.step()
+            total_kl += kl.item() * len(x)
+            total_reconst += reconst.item() * len(x)
+            count += len(x)
+        if log is not None:
+            log("vae epoch %d: kl %.3f reconst %.3f" % (epoch, total_kl / count, total_reconst / count))
+
+def pretrain_lbn(vae, lbn, loader, epochs, lr=1e-4, token_message=False, log=print):
+    '''
+    VAE_Seqを固定し、LBNを記録したepisodeの系列でまとめて学習する. loaderはcollate_sequencesの形のminibatchを返す
+        token_message : TrueのときはmessageをトークンのままLBNに渡す
+    '''
+    optimizer = torch.optim.Adam(lbn.parameters(), lr=lr)
+    for epoch in range(epochs):
+        total_kl, total_reconst, count = 0, 0, 0
+        for images, mask, tokens, lengths in loader:
+            images, mask, tokens = images.to(device), mask.to(device), tokens.to(device)
+            with torch.no_grad():
+                # 強化学習のときと同じく、VAE_Seqからサンプリングしたzを使う
+                _, z = vae(images.view(-1, *images.shape[2:]))
+                z = z.view(*images.shape[:2], -1)
+            m = tokens if token_message else F.one_hot(tokens, lbn.m_tokens).view(len(tokens), -1).float()
+            kl, reconst = lbn.sequence_loss(z, m, mask, lengths)
+            optimizer.zero_grad()
+            (kl + reconst).backward()
+            optimizer.step()
+            total_kl += kl.item() * len(lengths)
+            total_reconst += reconst.item() * len(lengths)
+            count += len(lengths)
+        if log is not None:
+            log("lbn epoch %d: kl %.3f reconst %.3f" % (epoch, total_kl / count, total_reconst / count))
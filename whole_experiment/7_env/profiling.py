@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""学習ステップの処理時間の内訳を計測する
+
+    profiler = Profiler(enabled=True)
+    with profiler.section('env.step'):
+        env.step(action)
+    print(profiler.summary())
+
+enabled=Falseの場合、section()は何もしないコンテキストマネージャを返すだけなので、ほぼコストはかからない。
+"""
+
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+_NULL_SECTION = nullcontext()
+
+
+class _Section():
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.profiler.durations.setdefault(self.name, []).append(time.perf_counter() - self.start)
+        return False
+
+
+class Profiler():
+    '''
+    区間ごとの処理時間を集計する
+        enabled : Falseの場合は何も計測しない
+        trace_dir : 指定するとtrace_start番目のepisodeからtrace_episodes個分、torch.profilerのtraceを書き出す
+        synchronize : 区間の終わりでCUDAの処理を待つか（Noneの場合はCUDAが使えれば待つ）
+    '''
+    def __init__(self, enabled=False, trace_dir=None, trace_start=10, trace_episodes=5, synchronize=None):
+        self.enabled = enabled
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_episodes = trace_episodes
+        if synchronize is None:
+            synchronize = torch.cuda.is_available()
+        self.synchronize = enabled and synchronize
+        self.durations = {} # 区間名 -> 処理時間(秒)のlist
+        self._trace = None
+
+    def section(self, name):
+        '''
+        with profiler.section(name): で囲んだ区間の処理時間を記録する
+        '''
+        if not self.enabled:
+            return _NULL_SECTION
+        return _Section(self, name)
+
+    def episode(self, episode):
+        '''
+        episodeの開始時に呼ぶ. torch.profilerのtraceを取る範囲を管理する
+        '''
+        if not self.enabled or self.trace_dir is None:
+            return
+        if episode == self.trace_start:
+            self._trace = torch.profiler.profile(record_shapes=True, with_stack=False)
+            self._trace.start()
+        elif self._trace is not None and episode == self.trace_start + self.trace_episodes:
+            self._trace.stop()
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, 'trace_%d-%d.json' % (self.trace_start, episode))
+            self._trace.export_chrome_trace(path)
+            self._trace = None
+
+    def summary(self):
+        '''
+        区間ごとの合計・平均・中央値・95パーセンタイル・全体に占める割合を表にする
+        '''
+        total = sum(sum(d) for d in self.durations.values())
+        lines = ['%-24s %8s %10s %10s %10s %10s %6s' % ('section', 'count', 'total s', 'mean ms', 'p50 ms', 'p95 ms', '%')]
+        for name, d in sorted(self.durations.items(), key=lambda item: -sum(item[1])):
+            d = np.asarray(d)
+            lines.append('%-24s %8d %10.3f %10.3f %10.3f %10.3f %6.1f' % (
+                name, len(d), d.sum(), d.mean() * 1e3, np.percentile(d, 50) * 1e3,
+                np.percentile(d, 95) * 1e3, 100 * d.sum() / total if total > 0 else 0))
+        return '\n'.join(lines)
+
+    def write(self, writer, step):
+        '''
+        TensorBoardに区間ごとの処理時間のヒストグラムと合計を書き込む
+        '''
+        for name, d in self.durations.items():
+            d = np.asarray(d)
+            writer.add_histogram('time/' + name, d * 1e3, step)
+            writer.add_scalar('time total/' + name, d.sum(), step)
+
+    def reset(self):
+        self.durations = {}
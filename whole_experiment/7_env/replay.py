@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""過去のepisodeを保存しておくリプレイバッファ
+
+VAE_SeqとLBNはController（方策）に依存しない自己教師ありの損失なので、過去のepisodeを使ってもよい。
+LWMAgentはreplay_capacity > 0 のとき、各episodeをこのバッファに入れ、VAE_SeqとLBNの損失は
+バッファからサンプリングしたminibatchで計算する（Controllerは今まで通り直近のepisodeで学習する）。
+"""
+
+import torch
+
+from packed import PackedEpisodes
+
+
+class ReplayBuffer():
+    '''
+    容量capacity個までのepisodeを保存する
+        prioritized : Falseの場合は古いepisodeから捨て、一様にサンプリングする
+                      Trueの場合は優先度(update_prioritiesで与える損失)が最も低いepisodeから捨て、優先度**alphaに比例してサンプリングする
+        generator : サンプリングに使うCPUのtorch.Generator（Noneの場合はグローバルな乱数）
+    '''
+    def __init__(self, capacity, prioritized=False, alpha=0.6, generator=None):
+        if capacity <= 0:
+            raise Exception("'capacity' must be positive!")
+        self.capacity = capacity
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.generator = generator
+        self.episodes = [] # {'observations': (ステップ数, 3, 9, 9), 'message_mask': (ステップ数), 'messages': (受けとった回数, ...)}
+        self.priorities = torch.zeros(capacity)
+        self._next = 0 # FIFOで次に上書きする位置
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def add(self, observations, messages, message_mask):
+        '''
+        observations : 聞き手の部分観測の系列 (ステップ数, 3, 9, 9)
+        messages : 受けとったmessage (受けとった回数, m_dim) もしくはトークン列
+        message_mask : messageを受けとった時刻 (ステップ数) のbool tensor
+        '''
+        episode = {'observations': observations.detach(), 'message_mask': message_mask, 'messages': messages.detach()}
+        # 新しいepisodeは少なくとも1回はサンプリングされるように、今までの最大の優先度を与える
+        priority = self.priorities[:len(self)].max() if len(self) > 0 else torch.tensor(1.0)
+        if len(self) < self.capacity:
+            index = len(self)
+            self.episodes.append(episode)
+        elif self.prioritized:
+            index = int(torch.argmin(self.priorities))
+            self.episodes[index] = episode
+        else:
+            index = self._next
+            self.episodes[index] = episode
+        self._next = (index + 1) % self.capacity
+        self.priorities[index] = priority
+        return index
+
+    def sample(self, batch_size):
+        '''
+        batch_size個（足りなければ全て）のepisodeを重複なしでサンプリングし、(index, PackedEpisodes) を返す
+        PackedEpisodesの列は observations (ステップ数の合計, 3, 9, 9), message_mask (ステップ数の合計) と messages
+        '''
+        batch_size = min(batch_size, len(self))
+        if self.prioritized:
+            weights = self.priorities[:len(self)] ** self.alpha
+            indices = torch.multinomial(weights, batch_size, replacement=False, generator=self.generator)
+        else:
+            indices = torch.randperm(len(self), generator=self.generator)[:batch_size]
+        indices = indices.tolist()
+        return indices, PackedEpisodes.concat([self.episodes[i] for i in indices])
+
+    def update_priorities(self, indices, priorities):
+        '''
+        サンプリングしたepisodeの優先度を更新する（LBNのepisodeごとの再構成誤差など）
+        '''
+        self.priorities[indices] = torch.as_tensor(priorities, dtype=torch.float).detach().cpu().clamp(min=1e-6)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""複数の環境でまとめて行動を選ぶrollout
+
+各ステップで全環境の観測をまとめてVAE_Seq, Speaker, LBN, Controllerに通す。終わった環境（reward cellに到達した、
+または最大ステップ数Tに達した）はその場でresetして次のepisodeを始めるので、短いepisodeの環境が長いepisodeを待つことはない。
+終わったepisodeはPackedEpisodesの形で溜めるので、最大ステップ数に揃えるための無駄なステップもない。
+collectで余ったepisodeと途中のepisodeは捨てずに次に回すので、LWMAgent.update_packedは重要度重みで補正する。
+
+    engine = RolloutEngine(agent, make_envs(16), T)
+    for _ in range(num_updates):
+        episodes = engine.collect(16)
+        agent.update(episodes)
+"""
+
+import torch
+
+from LWM_expt_02 import device
+from packed import PackedEpisodes
+
+
+class RolloutEngine():
+    '''
+    agent : LWMAgent. 重みとmessage_schedule, token_messageを使う（agentの記憶(vae_memoryなど)は使わない）
+    envs : Environmentのlist
+    T : episodeの最大ステップ数
+    '''
+    def __init__(self, agent, envs, T):
+        self.agent = agent
+        self.envs = envs
+        self.T = T
+        self.t = [0] * len(envs)
+        self.beta = None # 各環境で最後にmessageを受けとったときのbeta (環境数, beta_dim)
+        self.message_last = None # 各環境で最後に受けとったmessage (環境数, ...)
+        self.steps = [[] for _ in envs] # 各環境の今のepisodeのステップごとの記録
+        self.messages = [[] for _ in envs]
+        self.finished = [] # 終わったがまだcollectで返していないepisode
+        self.num_episodes = 0
+        self.num_steps = 0
+        self.num_successes = 0
+        for env in envs:
+            env.reset()
+
+    def _observe(self, envs, partial):
+        return torch.stack([env.observation(partial=partial).permute(2, 0, 1) for env in envs]).to(device)
+
+    def step(self):
+        '''
+        全環境を1ステップ進める
+        '''
+        agent = self.agent
+        t = torch.tensor(self.t)
+        x_part = self._observe(self.envs, partial=True)
+        with torch.no_grad():
+            with agent.autocast('vae'):
+                _, z = agent.vae(x_part)
+            # t=0の時にはメッセージが送られ、その後はagent.message_scheduleが決める
+            send = agent.message_schedule.decide(t, z, self.beta, self.message_last)
+            sending = send.nonzero()[:, 0].tolist()
+            m = []
+            if sending:
+                x_glb = self._observe([self.envs[i] for i in sending], partial=False)
+                with agent.autocast('speaker'):
+                    message, tokens = agent.speaker(x_glb)
+                m = tokens if agent.token_message else message.view(len(sending), -1)
+                with agent.autocast('lbn'):
+                    mean, std = agent.lbn._encoder(z[sending], m)
+                    beta = agent.lbn._sample_beta(mean, std)
+                if self.beta is None:
+                    self.beta = beta.new_zeros(len(self.envs), beta.shape[1])
+                self.beta[sending] = beta
+                if self.message_last is None:
+                    self.message_last = m.new_zeros(len(self.envs), *m.shape[1:])
+                self.message_last[sending] = m
+            with agent.autocast('controller'):
+                action_prob, _ = agent.controller(z, self.beta)
+            actions = torch.multinomial(action_prob, 1, True, generator=agent.action_generator)[:, 0]
+            # 更新までに重みが変わることがあるので、選んだときの確率を記録する（LWMAgent.update_packedで補正に使う）
+            log_probs = torch.log(action_prob.gather(1, actions[:, None]))[:, 0].float()
+        # 以降で書き換えるので、このステップのbetaはコピーして記録する
+        beta = self.beta.clone()
+
+        received = dict(zip(sending, m))
+        for i, env in enumerate(self.envs):
+            _, reward, done = env.step(int(actions[i]))
+            self.steps[i].append((x_part[i], z[i], beta[i], actions[i], log_probs[i], reward, i in received))
+            if i in received:
+                self.messages[i].append(received[i])
+            self.t[i] += 1
+            if done or self.t[i] == self.T:
+                self._finish(i, done)
+                env.reset()
+
+    def _finish(self, i, done):
+        observations, z, beta, actions, log_probs, rewards, message_mask = zip(*self.steps[i])
+        self.finished.append({
+            'observations': torch.stack(observations), 'z': torch.stack(z), 'beta': torch.stack(beta),
+            'actions': torch.stack(actions), 'log_probs': torch.stack(log_probs), 'rewards': torch.tensor(rewards, dtype=torch.float, device=device),
+            'message_mask': torch.tensor(message_mask, device=device), 'messages': torch.stack(self.messages[i])})
+        self.num_episodes += 1
+        self.num_steps += self.t[i]
+        self.num_successes += bool(done)
+        self.steps[i], self.messages[i], self.t[i] = [], [], 0
+
+    def collect(self, num_episodes):
+        '''
+        num_episodes個のepisodeが終わるまで進め、終わった順にPackedEpisodesにして返す
+        余った分と途中のepisodeは次に回すので、前のcollectの後の更新より前の重みで選んだ行動を含むことがある
+        （log_probsに選んだときの確率を記録している）
+        '''
+        while len(self.finished) < num_episodes:
+            self.step()
+        episodes, self.finished = self.finished[:num_episodes], self.finished[num_episodes:]
+        return PackedEpisodes.concat(episodes)
+
+    def padding_waste(self):
+        '''
+        これまでのepisodeを最大ステップ数Tに揃えて並べた場合に、無駄になるステップの割合
+        '''
+        return 1 - self.num_steps / max(self.num_episodes * self.T, 1)
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# 7_envのモジュールは同じディレクトリから直接importする形なので、テストからも同じようにimportできるようにする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
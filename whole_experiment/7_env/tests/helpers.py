@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""テストで共通に使う関数"""
+
+import numpy as np
+
+from LWM_expt_02 import Environment, LWMAgent
+
+
+def run_episode(agent, env, T, train=True):
+    '''
+    1 episodeを実行し、成功したかどうかを返す（学習時はupdateまで行う）
+    '''
+    env.reset()
+    for t in range(T):
+        if train:
+            action, prob, state_value, action_prob = agent.get_action(t, env)
+        else:
+            action = agent.get_greedy_action(t, env)
+        _, reward, done = env.step(action)
+        if train:
+            agent.add_ctrl_memory(reward, prob, action_prob, state_value)
+        if done or t == T-1:
+            if train:
+                agent.update()
+            agent.reset_memory()
+            return done
+
+def checksum(networks):
+    '''
+    全モジュールの重みの和（重みが一致するかの比較に使う）
+    '''
+    return sum(float(tensor.double().sum()) for module in networks.values() for tensor in module.state_dict().values())
+
+def seeded_agent(seed, T, **agent_kwargs):
+    '''
+    seedから環境とagentの乱数列を分けて作った(env, agent)
+    '''
+    env_seed, agent_seed = np.random.SeedSequence(seed).spawn(2)
+    env = Environment(seed=env_seed)
+    return env, LWMAgent(env, T, seed=agent_seed, **agent_kwargs)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""estimate_advantagesを使ったControllerのlossが、Monte-Carlo収益のループと一致することを確かめる"""
+
+import torch
+import torch.nn.functional as F
+
+from LWM_expt_02 import Environment, LWMAgent, entropy
+
+T = 56
+
+
+def _loop_controller_loss(ctrl_memory, gamma):
+    # 1ステップずつ後ろから収益を計算する（以前のLWMAgent.update）
+    R = 0
+    actor_loss = 0
+    critic_loss = 0
+    entropy_loss = 0
+    for r, prob, action_probs, v in ctrl_memory[::-1]:
+        R = r + gamma * R
+        advantage = R - v
+        actor_loss -= torch.log(prob) * advantage.detach()
+        critic_loss += F.smooth_l1_loss(v, torch.tensor(R, dtype=torch.float))
+        entropy_loss += entropy(action_probs)
+    return actor_loss / len(ctrl_memory), critic_loss / len(ctrl_memory), entropy_loss / len(ctrl_memory)
+
+def test_vectorized_loss_matches_loop():
+    env = Environment(seed=0)
+    agent = LWMAgent(env, T, lbn_hidden_dim=64, seed=0)
+    env.reset()
+    for t in range(T):
+        action, prob, state_value, action_prob = agent.get_action(t, env)
+        _, reward, done = env.step(action)
+        agent.add_ctrl_memory(reward, prob, action_prob, state_value)
+        if done:
+            break
+    memory = agent.ctrl_memory
+    rewards = torch.tensor([[r for r, _, _, _ in memory]], dtype=torch.float)
+    probs = torch.stack([prob for _, prob, _, _ in memory]).view(1, -1)
+    action_probs = torch.stack([action_prob for _, _, action_prob, _ in memory]).unsqueeze(0)
+    values = torch.stack([v for _, _, _, v in memory]).view(1, -1)
+    vectorized = agent.controller_loss(rewards, probs, action_probs, values, torch.ones_like(rewards, dtype=torch.bool))
+    for before, after in zip(_loop_controller_loss(memory, agent.gamma), vectorized):
+        assert torch.allclose(before, after, rtol=1e-4, atol=1e-6), (before, after)
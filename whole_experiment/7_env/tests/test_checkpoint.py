@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""CheckpointManagerが残すcheckpointとindex.jsonの対応"""
+
+import os
+
+import pytest
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent
+from checkpoint import CheckpointManager, read_index, select_entry, load_checkpoint
+from helpers import checksum, run_episode
+
+T = 56
+RATES = [0.1, 0.5, 0.3, 0.9, 0.2, 0.6, 0.9, 0.4, 0.7, 0.1]
+
+
+@pytest.mark.parametrize('async_write', [False, True])
+def test_keeps_top_k_and_last(tmp_path, async_write):
+    agent = LWMAgent(Environment(), T, lbn_hidden_dim=64, seed=0)
+    networks = agent.networks()
+    manager = CheckpointManager(str(tmp_path), top_k=3, keep_last=2, config={'T': T}, async_write=async_write)
+    for index, rate in enumerate(RATES):
+        with torch.no_grad():
+            for p in agent.controller.parameters():
+                p.add_(1e-3)
+        manager.save(networks, (index + 1) * 5000, {'test_success_rate': rate})
+    manager.close()
+
+    index = read_index(str(tmp_path))
+    files = sorted(file for file in os.listdir(str(tmp_path)) if file.endswith('.pth'))
+    assert files == sorted(entry['file'] for entry in index['entries'])
+    kept = sorted((entry['metrics']['test_success_rate'] for entry in index['entries']), reverse=True)[:3]
+    assert kept == sorted(RATES, reverse=True)[:3]
+    # 新しい方の2個も残る
+    assert [entry['episode'] for entry in index['entries']][-2:] == [45000, 50000]
+    best = select_entry(index, 'best')
+    assert best['metrics']['test_success_rate'] == max(RATES)
+
+    # 最後のcheckpointは保存したときの重み
+    restored = LWMAgent(Environment(), T, lbn_hidden_dim=64, seed=1).networks()
+    load_checkpoint(str(tmp_path), restored, which='last')
+    assert checksum(restored) == checksum(networks)
+
+def test_saves_optimizer_and_gate_state(tmp_path):
+    env = Environment(seed=0)
+    agent = LWMAgent(env, T, lbn_hidden_dim=64, seed=0, message_schedule={'type': 'gate'})
+    for _ in range(2):
+        run_episode(agent, env, T)
+    manager = CheckpointManager(str(tmp_path), async_write=False)
+    manager.save(agent.networks(), 2, {'test_success_rate': 0.0}, optimizers=agent.optimizers())
+    manager.close()
+
+    restored = LWMAgent(Environment(seed=0), T, lbn_hidden_dim=64, seed=1, message_schedule={'type': 'gate'})
+    assert restored.message_schedule.baseline is None
+    load_checkpoint(str(tmp_path), restored.networks(), which='last', optimizers=restored.optimizers())
+    gate, restored_gate = agent.message_schedule, restored.message_schedule
+    assert restored_gate.baseline == gate.baseline is not None
+    for optimizer, restored_optimizer in ((gate.optimizer, restored_gate.optimizer),
+                                          (agent.lwm_optimizer, restored.lwm_optimizer)):
+        expected, actual = optimizer.state_dict()['state'], restored_optimizer.state_dict()['state']
+        assert expected.keys() == actual.keys()
+        for key in expected:
+            assert torch.equal(expected[key]['exp_avg'], actual[key]['exp_avg'])
+            assert torch.equal(expected[key]['step'], actual[key]['step'])
+
+def test_load_without_optimizer_state_fails(tmp_path):
+    agent = LWMAgent(Environment(), T, lbn_hidden_dim=64, seed=0)
+    manager = CheckpointManager(str(tmp_path), async_write=False)
+    manager.save(agent.networks(), 1, {'test_success_rate': 0.0})
+    manager.close()
+    load_checkpoint(str(tmp_path), agent.networks(), which='last')
+    with pytest.raises(Exception):
+        load_checkpoint(str(tmp_path), agent.networks(), which='last', optimizers=agent.optimizers())
+
+def test_failed_async_write_is_raised(tmp_path, monkeypatch):
+    agent = LWMAgent(Environment(), T, lbn_hidden_dim=64, seed=0)
+    manager = CheckpointManager(str(tmp_path), async_write=True)
+    def fail(state_dicts, entry):
+        raise OSError("disk full")
+    monkeypatch.setattr(manager, '_write', fail)
+    future = manager.save(agent.networks(), 1, {'test_success_rate': 0.0})
+    future.exception() # 書き込みが終わるまで待つ
+    monkeypatch.undo()
+    # 次のsaveで失敗したFutureを捨てない
+    manager.save(agent.networks(), 2, {'test_success_rate': 0.0})
+    with pytest.raises(OSError):
+        manager.wait()
+    manager.close()
+    assert [entry['episode'] for entry in read_index(str(tmp_path))['entries']] == [2]
+
+def test_close_raises_failed_write(tmp_path, monkeypatch):
+    agent = LWMAgent(Environment(), T, lbn_hidden_dim=64, seed=0)
+    manager = CheckpointManager(str(tmp_path), async_write=True)
+    monkeypatch.setattr(manager, '_write', lambda state_dicts, entry: 1 / 0)
+    manager.save(agent.networks(), 1, {'test_success_rate': 0.0})
+    with pytest.raises(ZeroDivisionError):
+        manager.close()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""seedを与えたLWMAgentと環境の学習が、グローバルな乱数に関係なく再現することを確かめる"""
+
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent, make_envs
+from rollout import RolloutEngine
+from helpers import run_episode, checksum, seeded_agent
+
+T = 56
+EPISODES = 10
+
+
+def _seeded_run(seed, disturb=False, **agent_kwargs):
+    # episodes回学習し、(各episodeが成功したか, 重みのchecksum)を返す
+    # disturb=Trueのときは毎episodeグローバルな乱数を進める
+    env, agent = seeded_agent(seed, T, lbn_hidden_dim=64, **agent_kwargs)
+    successes = []
+    for _ in range(EPISODES):
+        if disturb:
+            np.random.rand(), torch.rand(3), random.random()
+        successes.append(bool(run_episode(agent, env, T)))
+    return successes, checksum(agent.networks())
+
+@pytest.mark.parametrize('agent_kwargs', [{}, {'replay_capacity': 20}, {'controller_mode': 'ppo', 'ppo_episodes': 4}],
+                         ids=['a2c', 'replay', 'ppo'])
+def test_same_seed_reproduces(agent_kwargs):
+    first = _seeded_run(0, **agent_kwargs)
+    assert _seeded_run(0, disturb=True, **agent_kwargs) == first
+    assert _seeded_run(1, **agent_kwargs)[1] != first[1]
+
+def test_rollout_engine_reproduces():
+    def run(seed):
+        env_seed, agent_seed = np.random.SeedSequence(seed).spawn(2)
+        agent = LWMAgent(Environment(), T, seed=agent_seed, lbn_hidden_dim=64)
+        engine = RolloutEngine(agent, make_envs(4, seed=env_seed), T)
+        for _ in range(3):
+            np.random.rand(), torch.rand(3)
+            agent.update(engine.collect(4))
+        return checksum(agent.networks())
+    assert run(0) == run(0)
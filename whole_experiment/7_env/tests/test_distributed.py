@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""torch.distributed (gloo) で2つのrankを起動し、重みの配布と同期を確かめる"""
+
+import multiprocessing
+
+import torch
+import torch.distributed as dist
+
+from LWM_expt_02 import Environment, LWMAgent
+from distributed import all_reduce_gradients, broadcast_networks, make_agent, check_synchronized
+from helpers import checksum, run_episode
+
+T = 56
+WORLD_SIZE = 2
+
+
+def _run(target, tmp_path):
+    # target(rank)を各rankで実行し、rankごとの返り値を返す
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    init_method = 'file://%s' % (tmp_path / 'store')
+
+    def worker(rank):
+        dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=WORLD_SIZE)
+        try:
+            queue.put((rank, target(rank)))
+        except Exception as e:
+            queue.put((rank, e))
+        finally:
+            dist.destroy_process_group()
+
+    processes = [context.Process(target=worker, args=(rank,)) for rank in range(WORLD_SIZE)]
+    for process in processes:
+        process.start()
+    results = dict(queue.get(timeout=120) for _ in processes)
+    for process in processes:
+        process.join(timeout=10)
+    for result in results.values():
+        if isinstance(result, Exception):
+            raise result
+    return [results[rank] for rank in range(WORLD_SIZE)]
+
+def _broadcast_invalidates_cache(rank):
+    env = Environment(seed=0)
+    agent = LWMAgent(env, T, lbn_hidden_dim=64, latent_cache=True, seed=rank)
+    env.reset()
+    observe = lambda: env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9)
+    key = env.observation_key()
+    agent.latent_cache.encode(key, observe)
+    broadcast_networks(agent.networks())
+    cached = agent.latent_cache.encode(key, observe)[0]
+    with torch.no_grad():
+        fresh = agent.vae._encoder(observe())[0]
+    return agent.latent_cache.version, torch.equal(cached, fresh), checksum(agent.networks())
+
+def test_broadcast_invalidates_latent_cache(tmp_path):
+    results = _run(_broadcast_invalidates_cache, tmp_path)
+    for version, matches, _ in results:
+        assert version == 1 and matches
+    assert results[0][2] == results[1][2]
+
+def _train(rank):
+    env, agent = make_agent(T, seed=0, lbn_hidden_dim=64)
+    for _ in range(2):
+        run_episode(agent, env, T)
+    check_synchronized(agent.networks())
+    return checksum(agent.networks())
+
+def test_ranks_stay_synchronized(tmp_path):
+    first, second = _run(_train, tmp_path)
+    assert first == second
+
+def _train_gate(rank):
+    env, agent = make_agent(T, seed=0, lbn_hidden_dim=64, message_schedule={'type': 'gate'})
+    for _ in range(3):
+        run_episode(agent, env, T)
+    check_synchronized(agent.networks())
+    return checksum({'message_gate': agent.message_schedule.module})
+
+def test_message_gate_stays_synchronized(tmp_path):
+    first, second = _run(_train_gate, tmp_path)
+    assert first == second
+
+def _reduce_missing_grad(rank):
+    a, b = torch.nn.Parameter(torch.zeros(2)), torch.nn.Parameter(torch.zeros(3))
+    optimizer = torch.optim.SGD([a, b], lr=1.0)
+    a.grad = torch.full((2,), 2.0)
+    if rank == 0:
+        # rank 0だけbの勾配が計算されていない
+        b.grad = None
+    else:
+        b.grad = torch.full((3,), 4.0)
+    all_reduce_gradients(optimizer)
+    return a.grad.tolist(), b.grad.tolist()
+
+def test_all_reduce_fills_missing_gradients(tmp_path):
+    results = _run(_reduce_missing_grad, tmp_path)
+    assert results[0] == results[1] == ([2.0, 2.0], [2.0, 2.0, 2.0])
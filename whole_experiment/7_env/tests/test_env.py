@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Environmentのreset・観測の再現性"""
+
+import pytest
+import torch
+
+from LWM_expt_02 import Environment, make_envs
+
+
+def test_same_seed_gives_same_goals():
+    envs_a = make_envs(4, seed=0)
+    envs_b = make_envs(4, seed=0)
+    goals_a = [[e.reset() for e in envs_a] for _ in range(100)]
+    goals_b = [[e.reset() for e in envs_b] for _ in range(100)]
+    assert goals_a == goals_b
+
+def _all_situations(grid_type):
+    # 全ての(reward cell, 位置)に環境を置く
+    env = Environment(grid_type=grid_type)
+    for goal_index in range(len(env.grid_table)):
+        env.goal_index = goal_index
+        env.grid = env.grid_table[goal_index]
+        for state in env.states:
+            env.state = state
+            yield env, goal_index, state
+
+@pytest.mark.parametrize('grid_type', ['A', 'B'])
+def test_observation_key_determines_observation(grid_type):
+    observations = {}
+    for env, _, _ in _all_situations(grid_type):
+        key = env.observation_key(partial=True)
+        observation = env.observation(partial=True)
+        if key in observations:
+            assert torch.equal(observations[key], observation), key
+        observations[key] = observation
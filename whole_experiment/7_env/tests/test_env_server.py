@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""RemoteEnvironmentでのepisodeが、同じseedの手元のEnvironmentと同じになることを確かめる"""
+
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from LWM_expt_02 import LWMAgent, make_envs
+from env_server import EnvServer, EnvClient, RemoteEnvironment, ALLOC, RESET, STEP, FREE, OK, ERROR, NUM_ACTIONS
+from helpers import run_episode
+
+
+@pytest.fixture
+def server_path(tmp_path):
+    path = os.path.join(str(tmp_path), 'env.sock')
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    server = context.Process(target=EnvServer(path, num_envs=8, seed=0).run, args=(ready,), daemon=True)
+    server.start()
+    try:
+        assert ready.wait(10)
+        yield path
+    finally:
+        server.terminate()
+        server.join()
+
+def test_remote_matches_local(server_path):
+    remote = RemoteEnvironment(server_path)
+    local = make_envs(8, seed=0)[remote.env_id]
+    assert remote.reset() == local.reset()
+    rng = np.random.default_rng(0)
+    for _ in range(1000):
+        action = int(rng.integers(4))
+        remote_step, local_step = remote.step(action), local.step(action)
+        assert remote_step == local_step and remote.state == local.state
+        # 毎ステップStateを作らず、環境が持っているものを使う
+        assert remote.state is remote._cells[remote.state.row * remote._columns + remote.state.column]
+        if remote_step[2]:
+            assert remote.reset() == local.reset()
+    assert torch.equal(remote.observation(), local.observation())
+    remote.close()
+
+def test_agent_runs_on_remote_environment(server_path):
+    remote = RemoteEnvironment(server_path)
+    run_episode(LWMAgent(remote, 56, lbn_hidden_dim=64, seed=0), remote, 56)
+    remote.close()
+
+def _status(client, opcode, env_id, action=0):
+    # request()はERRORで例外を投げるので、statusを見るときはsend/receiveを使う
+    client.send(opcode, env_id, action)
+    return client.receive()[1]
+
+def test_only_owner_can_use_environment(server_path):
+    owner, other = EnvClient(server_path), EnvClient(server_path)
+    env_id = owner.request(ALLOC)[2]
+    for opcode in (RESET, STEP, FREE):
+        assert _status(other, opcode, env_id) == ERROR
+    assert _status(owner, STEP, env_id) != ERROR
+    # 空いている環境も、借りるまでは使えない
+    assert _status(other, STEP, (env_id + 1) % 8) == ERROR
+    assert _status(owner, FREE, env_id) == OK
+    assert _status(owner, STEP, env_id) == ERROR
+    owner.close()
+    other.close()
+
+def test_remote_environment_cannot_use_another_clients_environment(server_path):
+    remote = RemoteEnvironment(server_path)
+    other = EnvClient(server_path)
+    remote.env_id = other.request(ALLOC)[2]
+    with pytest.raises(Exception):
+        remote.step(0)
+    other.close()
+
+def test_step_rejects_invalid_action(server_path):
+    client = EnvClient(server_path)
+    env_id = client.request(ALLOC)[2]
+    assert _status(client, STEP, env_id, NUM_ACTIONS) == ERROR
+    # 接続はそのまま使える
+    assert _status(client, STEP, env_id, NUM_ACTIONS - 1) != ERROR
+    client.close()
+
+def test_remote_environment_uses_server_layout(server_path):
+    with pytest.raises(Exception):
+        RemoteEnvironment(server_path, grid_type='B')
+    remote = RemoteEnvironment(server_path)
+    assert remote.grid_type == 'A'
+    remote.close()
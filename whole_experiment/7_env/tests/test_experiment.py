@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""experiment.pyの設定の検証と、事前学習してから強化学習する流れ"""
+
+import json
+import os
+
+import pytest
+
+from experiment import load_config, run_dir, train
+from trajectory import TrajectoryReader
+
+
+def test_pretrain_section_overrides(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps({'pretrain': {'episodes': 10}, 'agent': {'lbn_hidden_dim': 64}}))
+    config = load_config(str(path), ['pretrain.vae_epochs=3', 'pretrain.vae_data=trajectories'])
+    assert config['pretrain']['episodes'] == 10 and config['pretrain']['vae_epochs'] == 3
+    assert config['pretrain']['vae_data'] == 'trajectories' and config['pretrain']['lbn_epochs'] == 20
+    assert config['agent']['lbn_hidden_dim'] == 64
+
+@pytest.mark.parametrize('override', ['pretrain.unknown=1', 'pretrain.episodes=-1', 'pretrain.vae_data=images',
+                                      'pretrain.vae_epochs=1.5'])
+def test_invalid_pretrain_settings(override):
+    with pytest.raises(Exception):
+        load_config(None, [override])
+
+def test_train_with_pretraining(tmp_path):
+    config = load_config(None, ['output_dir="%s"' % tmp_path, 'seed=0', 'num_episode=4', 'test_interval=2', 'log_interval=2',
+                                'agent.lbn_hidden_dim=64', 'pretrain.episodes=3', 'pretrain.vae_epochs=1',
+                                'pretrain.lbn_epochs=1', 'pretrain.num_workers=0'])
+    train(config)
+    directory = run_dir(config)
+    assert len(TrajectoryReader(os.path.join(directory, 'pretrain_trajectories'))) == 3
+    assert os.path.exists(os.path.join(directory, 'checkpoints', 'index.json'))
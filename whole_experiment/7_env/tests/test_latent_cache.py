@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""LatentCacheの値がVAE_Seq._encoderと一致し、重みが変わると無効になることを確かめる"""
+
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent
+from helpers import run_episode
+
+T = 56
+
+
+def test_cache_matches_encoder_and_is_invalidated_by_optimizer_step():
+    env = Environment(seed=0)
+    agent = LWMAgent(env, T, lbn_hidden_dim=64, latent_cache=True, seed=0)
+    cache = agent.latent_cache
+    env.reset()
+    observe = lambda: env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9)
+    key = env.observation_key()
+    mean, std = cache.encode(key, observe)
+    with torch.no_grad():
+        fresh = agent.vae._encoder(observe())
+    assert torch.equal(mean, fresh[0]) and torch.equal(std, fresh[1])
+
+    run_episode(agent, env, T) # lwm_optimizerのstepでキャッシュが無効になる
+    assert key not in cache._entries and cache.version == 1
+    with torch.no_grad():
+        assert torch.equal(cache.encode(key, observe)[0], agent.vae._encoder(observe())[0])
+
+def test_cache_is_invalidated_by_load_state_dict():
+    env = Environment(seed=0)
+    agent = LWMAgent(env, T, lbn_hidden_dim=64, latent_cache=True, seed=0)
+    env.reset()
+    agent.latent_cache.encode(env.observation_key(), lambda: env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9))
+    agent.vae.load_state_dict(agent.vae.state_dict())
+    assert agent.latent_cache.version == 1 and not agent.latent_cache._entries
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""LBNのlossの計算方法（episodeごと・最大長に揃えたbatch・PackedEpisodes）が一致することを確かめる"""
+
+import pytest
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent, make_envs
+from rollout import RolloutEngine
+
+T = 56
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    torch.manual_seed(0)
+    agent = LWMAgent(Environment(seed=0), T, lbn_hidden_dim=64, seed=0)
+    monkeypatch.setattr(agent.lbn, '_sample_beta', lambda mean, std: mean) # ノイズをなくして比べる
+    return agent
+
+def test_sequence_loss_matches_loss(agent):
+    env = agent.env
+    lbn = agent.lbn
+    for _ in range(4):
+        env.reset()
+        for t in range(T):
+            agent.get_action(t, env)
+        z = torch.cat(lbn.z_memory).detach()
+        m = torch.cat(lbn.m_memory)
+        mask = torch.zeros(T, dtype=torch.bool)
+        mask[lbn.t_memory] = True
+        kl, reconst = lbn.loss()
+        kl_seq, reconst_seq = lbn.sequence_loss(z.unsqueeze(0), m, mask.unsqueeze(0), torch.tensor([T]))
+        assert torch.allclose(kl, kl_seq)
+        assert torch.allclose(reconst, reconst_seq, rtol=1e-4)
+        agent.reset_memory()
+
+def test_packed_loss_matches_sequence_loss(agent):
+    batch = RolloutEngine(agent, make_envs(4, seed=0), T).collect(4)
+    lbn = agent.lbn
+    z, _ = batch.to_padded(batch.z)
+    message_mask, _ = batch.to_padded(batch.message_mask)
+    packed = lbn.packed_loss(batch.z, batch.messages, batch.message_mask, batch.offsets, reduction='none')
+    padded = lbn.sequence_loss(z, batch.messages, message_mask, batch.lengths, reduction='none')
+    assert torch.allclose(packed[0], padded[0])
+    assert torch.allclose(packed[1], padded[1], rtol=1e-5)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""コンパイルしたListenerStep(CompiledListenerStep)の出力が、同じ乱数のもとでeagerと一致することを確かめる"""
+
+import pytest
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent, ListenerStep, CompiledListenerStep
+
+
+@pytest.fixture(scope='module')
+def step():
+    torch.manual_seed(0)
+    agent = LWMAgent(Environment(seed=0), 56, lbn_hidden_dim=64)
+    return ListenerStep(agent.vae, agent.lbn, agent.controller)
+
+def _inputs(step, token_message, batch_size=5):
+    x = torch.rand(batch_size, 3, 9, 9)
+    if token_message:
+        m = torch.randint(0, step.lbn.m_tokens, (batch_size, step.lbn.m_dim // step.lbn.m_tokens))
+    else:
+        m = torch.rand(batch_size, step.lbn.m_dim)
+    beta = torch.randn(batch_size, step.lbn.beta_dim)
+    return x, m, beta
+
+@pytest.mark.parametrize('mode', ['eager', 'script', 'compile'])
+@pytest.mark.parametrize('token_message', [False, True])
+@pytest.mark.parametrize('with_message', [True, False])
+def test_compiled_matches_eager(step, mode, token_message, with_message, monkeypatch):
+    import torch._inductor.config
+    monkeypatch.setattr(torch._inductor.config, 'fallback_random', True) # eagerと同じ乱数を使う
+    compiled = CompiledListenerStep(step, mode=mode, token_message=token_message)
+    x, m, beta = _inputs(step, token_message)
+    args = (x, m, None) if with_message else (x, None, beta)
+    with torch.no_grad():
+        torch.manual_seed(1)
+        expected = step(*args)
+        torch.manual_seed(1)
+        actual = compiled(*args)
+    assert len(expected) == len(actual) == 4
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-5)
+    if not with_message:
+        # messageがない場合、betaはbeta_lastのまま
+        assert torch.equal(actual[1], beta)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""MessageScheduleの1環境の判断(decide_one)がdecide()と同じになることを確かめる"""
+
+import copy
+
+import pytest
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent
+
+SPECS = [None, {'type': 'interval', 'interval': 4}, {'type': 'uncertainty', 'threshold': 0.5}, {'type': 'gate'}]
+
+
+@pytest.mark.parametrize('spec', SPECS, ids=['probability', 'interval', 'uncertainty', 'gate'])
+def test_decide_one_matches_decide(spec):
+    agent = LWMAgent(Environment(seed=0), 56, lbn_hidden_dim=64, seed=0, message_schedule=spec)
+    schedule = agent.message_schedule
+    generator = torch.Generator().manual_seed(0)
+    inputs = [(t, torch.randn(1, agent.lbn.z_dim, generator=generator), torch.randn(1, agent.lbn.beta_dim, generator=generator),
+               torch.rand(1, agent.lbn.m_dim, generator=generator)) for t in list(range(12)) * 2]
+
+    rng_state = copy.deepcopy(agent.rng.bit_generator.state)
+    batched = [bool(schedule.decide(torch.tensor([t]), z, beta, m)[0]) for t, z, beta, m in inputs]
+    batched_stats = (schedule.num_episodes, schedule.num_steps, schedule.num_messages, schedule.num_decisions)
+
+    agent.rng.bit_generator.state = rng_state
+    schedule.reset_stats()
+    single = [schedule.decide_one(t, z, beta, m) for t, z, beta, m in inputs]
+    assert single == batched
+    assert all(single[t] for t in (0, 12))
+    assert (schedule.num_episodes, schedule.num_steps, schedule.num_messages, schedule.num_decisions) == batched_stats
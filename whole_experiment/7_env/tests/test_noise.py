@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""NoiseSourceのseedを固定したときのノイズの再現性"""
+
+import torch
+
+from LWM_expt_02 import NoiseSource
+
+
+def _draws(source, num, shape=(1, 10)):
+    mean = torch.zeros(shape)
+    return [source.sample_like(mean).clone() for _ in range(num)]
+
+def test_same_seed_gives_same_draws():
+    a, b = NoiseSource(seed=3), NoiseSource(seed=3)
+    for x, y in zip(_draws(a, 20), _draws(b, 20)):
+        assert torch.equal(x, y)
+    assert not torch.equal(_draws(NoiseSource(seed=3), 1)[0], _draws(NoiseSource(seed=4), 1)[0])
+
+def test_same_seed_across_pool_reallocation():
+    # pool_size=16に(1, 10)のノイズを切り出すので、毎回poolを作り直す
+    a, b = NoiseSource(seed=3, pool_size=16), NoiseSource(seed=3, pool_size=16)
+    pools = []
+    for _ in range(5):
+        assert torch.equal(_draws(a, 1)[0], _draws(b, 1)[0])
+        pools.append(a._pool)
+    assert all(pool is not other for pool, other in zip(pools, pools[1:]))
+
+    # poolの中身は専用のGeneratorのrandn(pool_size)を順に並べたもの
+    generator = torch.Generator().manual_seed(3)
+    source = NoiseSource(seed=3, pool_size=16)
+    for draw in _draws(source, 3):
+        assert torch.equal(draw.view(-1), torch.randn(16, generator=generator)[:10])
+
+def test_pool_block_shared_until_exhausted():
+    # 小さいノイズは同じpoolから順に切り出し、使い切ったら新しいpoolにする
+    a, b = NoiseSource(seed=5, pool_size=8), NoiseSource(seed=5, pool_size=8)
+    draws_a, draws_b = _draws(a, 9, shape=(1, 3)), _draws(b, 9, shape=(1, 3))
+    for x, y in zip(draws_a, draws_b):
+        assert torch.equal(x, y)
+
+def test_reallocation_keeps_earlier_noise():
+    # 逆伝播のために保存されたノイズは、poolを作り直しても書き換えられない
+    source = NoiseSource(seed=0, pool_size=16)
+    mean = torch.zeros(1, 10)
+    first = source.sample_like(mean)
+    saved = first.clone()
+    source.sample_like(mean)
+    assert torch.equal(first, saved)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""価値反復の最適方策で環境を動かしたときのsuccess rateが、価値反復の値と一致することを確かめる"""
+
+import numpy as np
+
+from LWM_expt_02 import Environment
+from oracle import solve
+
+
+def test_simulated_success_rate_matches_value_iteration():
+    num = 2000
+    solution = solve('A', 20, 0.8)
+    env = Environment(grid_type='A', move_prob=0.8, seed=0)
+    successes = 0
+    for _ in range(num):
+        env.reset()
+        for t in range(solution.T):
+            _, reward, done = env.step(solution.action(env, t))
+            if done or t == solution.T - 1:
+                successes += reward == 1
+                break
+    rate = successes / num
+    sigma = np.sqrt(solution.success_rate * (1 - solution.success_rate) / num)
+    assert abs(rate - solution.success_rate) < 4 * sigma + 1e-9, (rate, solution.success_rate)
+
+def test_deterministic_moves_succeed_with_long_horizon():
+    assert solve('A', 56, 1.0).success_rate == 1.0
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""RolloutEngineが記録する行動の確率と、持ち越したepisodeの重要度重み"""
+
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent, make_envs
+from rollout import RolloutEngine
+
+T = 56
+
+
+def _current_log_probs(agent, episodes):
+    with torch.no_grad():
+        action_prob, _ = agent.controller(episodes.z, episodes.beta)
+    return torch.log(action_prob.gather(1, episodes.actions[:, None]))[:, 0]
+
+def _engine(num_envs=4):
+    agent = LWMAgent(Environment(seed=0), T, lbn_hidden_dim=64, seed=0)
+    return agent, RolloutEngine(agent, make_envs(num_envs, seed=0), T)
+
+def test_log_probs_match_controller_without_update():
+    agent, engine = _engine()
+    episodes = engine.collect(4)
+    assert torch.allclose(episodes.log_probs, _current_log_probs(agent, episodes), atol=1e-5)
+
+def test_carried_over_steps_are_off_policy():
+    agent, engine = _engine()
+    agent.update(engine.collect(1))
+    # 残りの3つの環境の途中までのステップは、更新前の重みで選んだもの
+    episodes = engine.collect(3)
+    stale = ~torch.isclose(episodes.log_probs, _current_log_probs(agent, episodes), atol=1e-5)
+    assert stale.any()
+
+def test_importance_weights_are_clipped(monkeypatch):
+    agent, engine = _engine()
+    agent.update(engine.collect(1))
+    episodes = engine.collect(3)
+    captured = {}
+    controller_loss = agent.controller_loss
+    def capture(rewards, probs, action_probs, values, mask, weights=None):
+        captured['weights'], captured['mask'] = weights, mask
+        return controller_loss(rewards, probs, action_probs, values, mask, weights)
+    monkeypatch.setattr(agent, 'controller_loss', capture)
+    agent.update(episodes)
+    weights = captured['weights'][captured['mask']]
+    assert (weights <= agent.importance_clip).all() and (weights > 0).all()
+    assert (weights < 1).any()
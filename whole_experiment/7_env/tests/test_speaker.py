@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""Speakerのx_glbのリングバッファ"""
+
+import torch
+
+from LWM_expt_02 import Speaker
+
+
+def test_batch_larger_than_buffer_matches_one_by_one():
+    torch.manual_seed(0)
+    batched, one_by_one = Speaker(4, 3, buffer_size=5), Speaker(4, 3, buffer_size=5)
+    x = torch.rand(12, 3, 9, 9)
+    for speaker in (batched, one_by_one):
+        speaker(x[:3])
+    batched(x[3:])
+    for row in x[3:]:
+        one_by_one(row[None])
+    assert batched._memory_index == one_by_one._memory_index
+    assert torch.equal(batched.speaker_memory, one_by_one.speaker_memory)
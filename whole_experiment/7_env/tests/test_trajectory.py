@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""記録したepisodeから作り直した観測が、Environment.observationと一致することを確かめる"""
+
+import numpy as np
+import pytest
+import torch
+
+from LWM_expt_02 import Environment
+from trajectory import TrajectoryWriter, TrajectoryReader, render_observations
+
+
+@pytest.mark.parametrize('grid_type', ['A', 'B'])
+@pytest.mark.parametrize('partial', [True, False])
+def test_render_observations_matches_environment(grid_type, partial):
+    env = Environment(grid_type=grid_type)
+    for goal_index in range(len(env.grid_table)):
+        env.grid = env.grid_table[goal_index]
+        for state in env.states:
+            env.state = state
+            image = render_observations(env.grid_table, [goal_index], [state.row], [state.column], partial)[0]
+            assert torch.equal(image, env.observation(partial)), (goal_index, state)
+
+def test_write_and_read(tmp_path):
+    T = 56
+    env = Environment(seed=0)
+    rng = np.random.default_rng(0)
+    expected = [] # episodeごとの (観測, 行動, 報酬, トークン)
+    with TrajectoryWriter(str(tmp_path), grid_type=env.grid_type, m_length=10, chunk_episodes=3) as writer:
+        for _ in range(7):
+            goal_index = env.reset()
+            episode = []
+            for t in range(T):
+                state = env.state
+                observation = env.observation()
+                action = int(rng.integers(4))
+                _, reward, done = env.step(action)
+                tokens = rng.integers(2, size=10) if rng.random() < 0.5 else None
+                writer.add_step(state, action, reward, tokens)
+                episode.append((observation, action, reward, tokens))
+                if done or t == T - 1:
+                    writer.end_episode(goal_index, done)
+                    break
+            expected.append((goal_index, done, episode))
+
+    reader = TrajectoryReader(str(tmp_path))
+    assert len(reader) == 7 and len(reader.chunks) == 3
+    for index, (goal_index, done, episode) in enumerate(expected):
+        recorded = reader.episode(index)
+        assert recorded['goal'] == goal_index and recorded['success'] == bool(done)
+        observations = reader.observations(index)
+        assert len(observations) == len(episode)
+        for step, (observation, action, reward, tokens) in enumerate(episode):
+            assert torch.equal(observations[step], observation)
+            assert recorded['action'][step] == action and recorded['reward'][step] == reward
+            assert recorded['message_mask'][step] == (tokens is not None)
+            if tokens is not None:
+                assert np.array_equal(recorded['tokens'][step], tokens)
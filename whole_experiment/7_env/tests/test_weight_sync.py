@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""SharedWeightsで配った重みが、workerプロセスで送った側と一致することを確かめる"""
+
+import multiprocessing
+
+import torch
+
+from LWM_expt_02 import Environment, LWMAgent
+from weight_sync import SharedWeights
+from helpers import checksum
+
+T = 56
+
+
+def _networks(seed):
+    return LWMAgent(Environment(), T, lbn_hidden_dim=64, seed=seed).networks()
+
+def _perturb(networks):
+    with torch.no_grad():
+        for module in networks.values():
+            for p in module.parameters():
+                p.add_(1e-3)
+
+def _worker(conn, shared):
+    networks = _networks(1)
+    version = -1
+    while conn.recv():
+        version = shared.pull(networks, version)
+        conn.send((version, checksum(networks)))
+
+def test_pull_in_worker_matches_publisher():
+    networks = _networks(0)
+    shared = SharedWeights(networks)
+    context = multiprocessing.get_context('fork')
+    conn, worker_conn = context.Pipe()
+    worker = context.Process(target=_worker, args=(worker_conn, shared))
+    worker.start()
+    try:
+        for _ in range(3):
+            _perturb(networks)
+            version = shared.publish(networks)
+            conn.send(True)
+            assert conn.recv() == (version, checksum(networks))
+        conn.send(False)
+    finally:
+        worker.join(timeout=10)
+
+def test_pull_skips_unchanged_version():
+    networks = _networks(0)
+    shared = SharedWeights(networks)
+    other = _networks(1)
+    version = shared.pull(other)
+    assert checksum(other) == checksum(networks)
+    _perturb(other)
+    assert shared.pull(other, version) == version
+    assert checksum(other) != checksum(networks)
+
+def test_pull_invalidates_latent_cache():
+    networks = _networks(0)
+    shared = SharedWeights(networks)
+    env = Environment(seed=0)
+    agent = LWMAgent(env, T, lbn_hidden_dim=64, latent_cache=True, seed=1)
+    env.reset()
+    observe = lambda: env.observation(partial=True).permute(2, 0, 1).reshape(-1, 3, 9, 9)
+    key = env.observation_key()
+    agent.latent_cache.encode(key, observe)
+    version = shared.pull(agent.networks())
+    assert not agent.latent_cache._entries and agent.latent_cache.version == 1
+    with torch.no_grad():
+        assert torch.equal(agent.latent_cache.encode(key, observe)[0], networks['vae']._encoder(observe())[0])
+    # versionが変わらなければ読み込まないので、キャッシュも残る
+    shared.pull(agent.networks(), version)
+    assert key in agent.latent_cache._entries
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""CPUのスレッド数とaffinityの設定
+
+ネットワークが小さいので、1つの学習プロセスで多くのスレッドを使っても速くならない。
+同じマシンで複数の学習を同時に動かす（ハイパーパラメータの探索など）と、torchのデフォルトでは
+全プロセスがコア数分のスレッドを作り、コアを取り合って遅くなる。
+
+    # 8個の学習を同時に動かすうちのi番目: コアを8等分し、そのコアだけを使う
+    configure_threads(intra_op='auto', inter_op='auto', affinity='auto', concurrent_runs=8, run_index=i)
+
+'auto'はこのプロセスが使えるコア(os.sched_getaffinity)をconcurrent_runs個に分けたものを使う。
+コアよりrunが多い場合は、runを順にコアに割り当て、スレッドは1つにする。
+"""
+
+import os
+import warnings
+
+import torch
+
+
+def available_cpus():
+    '''
+    このプロセスが使えるCPUの番号のlist
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def cpu_share(concurrent_runs=1, run_index=0, cpus=None):
+    '''
+    cpusをconcurrent_runs個に分けたうちの、run_index番目が使うCPUの番号のlist
+    '''
+    cpus = available_cpus() if cpus is None else list(cpus)
+    if concurrent_runs < 1 or not 0 <= run_index < concurrent_runs:
+        raise Exception("'run_index' must be in [0, concurrent_runs)")
+    if concurrent_runs >= len(cpus):
+        return [cpus[run_index % len(cpus)]]
+    per_run = len(cpus) // concurrent_runs
+    return cpus[run_index * per_run:(run_index + 1) * per_run]
+
+def configure_threads(intra_op=None, inter_op=None, affinity=None, concurrent_runs=1, run_index=0):
+    '''
+    このプロセスのスレッド数とCPU affinityを設定し、設定後の値を {'intra_op', 'inter_op', 'affinity'} で返す
+        intra_op : 演算の中で使うスレッド数 (torch.set_num_threads). int, 'auto' またはNone（変えない）
+        inter_op : 演算の間で使うスレッド数 (torch.set_num_interop_threads). int, 'auto' またはNone
+                   inter-opの並列処理が1度でも実行された後は変えられない（警告を出して元のままにする）
+        affinity : 使うCPUの番号のlist, 'auto' またはNone（変えない）
+        concurrent_runs, run_index : 'auto'のときに、同時に動かす学習の数とこのプロセスの番号
+    '''
+    share = cpu_share(concurrent_runs, run_index)
+    if affinity == 'auto':
+        affinity = share
+    if affinity is not None:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise Exception("CPU affinity is not supported on this platform")
+        os.sched_setaffinity(0, affinity)
+    cores = len(affinity) if affinity is not None else len(share)
+
+    if intra_op == 'auto':
+        intra_op = cores
+    if intra_op is not None:
+        torch.set_num_threads(int(intra_op))
+    if inter_op == 'auto':
+        # 小さいネットワークでは演算を並行に動かす利点がほとんどないので1つにする
+        inter_op = 1
+    if inter_op is not None and inter_op != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(int(inter_op))
+        except RuntimeError as e:
+            warnings.warn("could not set inter-op threads: %s" % e)
+    return {'intra_op': torch.get_num_threads(), 'inter_op': torch.get_num_interop_threads(),
+            'affinity': available_cpus()}
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""episodeの記録と読み込み
+
+観測は (レイアウト, reward cellの位置, 聞き手の位置) から決まるので、画像ではなく状態を記録し、
+読み込むときに観測を作り直す。
+
+保存形式:
+    <directory>/meta.json             レイアウト, messageの長さなど
+    <directory>/chunk_00000/*.npy     episode chunk_episodes個分の列(column)ごとの配列
+        episode_offsets (int64, episode数+1)  各episodeのステップの開始位置
+        goal            (int8,  episode数)    reward cellの位置(gridテーブルのindex)
+        success         (bool,  episode数)    reward cellに到達したか
+        row, column     (int8,  ステップ数)    行動する前の聞き手の位置
+        action          (int8,  ステップ数)
+        reward          (float32, ステップ数)
+        message_mask    (bool,  ステップ数)    messageが送られたか
+        tokens          (uint8, ステップ数 x m_length)  messageのトークン列（送られていないステップは0）
+chunkは書き終わってから名前を付けるので、途中で止まっても既存のchunkは壊れない（追記のみ）。
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+
+FORMAT_VERSION = 1
+
+_STEP_COLUMNS = {
+    'row': np.int8,
+    'column': np.int8,
+    'action': np.int8,
+    'reward': np.float32,
+    'message_mask': np.bool_,
+    'tokens': np.uint8,
+}
+
+
+class TrajectoryWriter():
+    '''
+    episodeをchunk_episodes個ずつまとめてdirectoryに書き出す
+        grid_type : 環境のレイアウト
+        m_length : messageの長さ(トークン数)
+    '''
+    def __init__(self, directory, grid_type='A', m_length=10, chunk_episodes=1000):
+        self.directory = directory
+        self.grid_type = grid_type
+        self.m_length = m_length
+        self.chunk_episodes = chunk_episodes
+        os.makedirs(directory, exist_ok=True)
+
+        meta_path = os.path.join(directory, 'meta.json')
+        meta = {'version': FORMAT_VERSION, 'grid_type': grid_type, 'm_length': m_length}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                existing = json.load(f)
+            if existing != meta:
+                raise Exception("'%s' already contains trajectories with %s" % (directory, existing))
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+        self._num_chunks = len(_chunk_dirs(directory))
+        self._reset_chunk()
+        self._reset_episode()
+
+    def _reset_chunk(self):
+        self._steps = {name: [] for name in _STEP_COLUMNS}
+        self._episode_offsets = [0]
+        self._goals = []
+        self._successes = []
+
+    def _reset_episode(self):
+        self._episode = {name: [] for name in _STEP_COLUMNS}
+
+    def add_step(self, state, action, reward, tokens=None):
+        '''
+        state : 行動する前の聞き手の状態
+        tokens : 送られたmessageのトークン列（送られていない場合はNone）
+        '''
+        episode = self._episode
+        episode['row'].append(state.row)
+        episode['column'].append(state.column)
+        episode['action'].append(action)
+        episode['reward'].append(reward)
+        episode['message_mask'].append(tokens is not None)
+        if tokens is None:
+            episode['tokens'].append(np.zeros(self.m_length, dtype=np.uint8))
+        else:
+            if torch.is_tensor(tokens):
+                tokens = tokens.detach().cpu().numpy()
+            episode['tokens'].append(np.asarray(tokens, dtype=np.uint8).reshape(self.m_length))
+
+    def end_episode(self, goal_index, success):
+        '''
+        goal_index : Environment.reset()が返したgridテーブルのindex
+        success : reward cellに到達したか
+        '''
+        for name, values in self._episode.items():
+            self._steps[name].extend(values)
+        self._episode_offsets.append(len(self._steps['row']))
+        self._goals.append(goal_index)
+        self._successes.append(success)
+        self._reset_episode()
+        if len(self._goals) >= self.chunk_episodes:
+            self.flush()
+
+    def flush(self):
+        '''
+        書き出していないepisodeを新しいchunkとして保存する
+        '''
+        if not self._goals:
+            return
+        name = 'chunk_%05d' % self._num_chunks
+        tmp_dir = os.path.join(self.directory, '.' + name + '.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        columns = {
+            'episode_offsets': np.asarray(self._episode_offsets, dtype=np.int64),
+            'goal': np.asarray(self._goals, dtype=np.int8),
+            'success': np.asarray(self._successes, dtype=np.bool_),
+        }
+        for column, dtype in _STEP_COLUMNS.items():
+            values = self._steps[column]
+            if column == 'tokens':
+                columns[column] = np.asarray(values, dtype=dtype).reshape(-1, self.m_length)
+            else:
+                columns[column] = np.asarray(values, dtype=dtype)
+        for column, array in columns.items():
+            np.save(os.path.join(tmp_dir, column + '.npy'), array)
+        os.rename(tmp_dir, os.path.join(self.directory, name))
+        self._num_chunks += 1
+        self._reset_chunk()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _chunk_dirs(directory):
+    return sorted(os.path.join(directory, d) for d in os.listdir(directory)
+                  if d.startswith('chunk_') and os.path.isdir(os.path.join(directory, d)))
+
+
+class TrajectoryReader():
+    '''
+    TrajectoryWriterで書き出したepisodeをmemory-mapして読む
+    '''
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != FORMAT_VERSION:
+            raise Exception("unsupported trajectory format version %s" % self.meta['version'])
+        self.grid_type = self.meta['grid_type']
+        from LWM_expt_02 import grid_table # LWM_expt_02からも読み込まれるので、循環しないようにここで読み込む
+        self.grid_table = grid_table(self.grid_type)
+
+        self.chunks = []
+        for chunk_dir in _chunk_dirs(directory):
+            columns = {}
+            for file_name in os.listdir(chunk_dir):
+                if file_name.endswith('.npy'):
+                    columns[file_name[:-4]] = np.load(os.path.join(chunk_dir, file_name), mmap_mode='r')
+            self.chunks.append(columns)
+        # episode番号 -> (chunk, chunk内の番号)
+        counts = [len(chunk['goal']) for chunk in self.chunks]
+        self._chunk_starts = np.cumsum([0] + counts)
+
+    def __len__(self):
+        return int(self._chunk_starts[-1])
+
+    @property
+    def num_steps(self):
+        return sum(int(chunk['episode_offsets'][-1]) for chunk in self.chunks)
+
+    def episode(self, index):
+        '''
+        index番目のepisodeの各列を返す（ステップごとの列はmemory-mapのview）
+        '''
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        chunk_index = int(np.searchsorted(self._chunk_starts, index, side='right')) - 1
+        chunk = self.chunks[chunk_index]
+        i = index - self._chunk_starts[chunk_index]
+        start, end = chunk['episode_offsets'][i], chunk['episode_offsets'][i + 1]
+        episode = {column: chunk[column][start:end] for column in _STEP_COLUMNS}
+        episode['goal'] = int(chunk['goal'][i])
+        episode['success'] = bool(chunk['success'][i])
+        return episode
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.episode(index)
+
+    def observations(self, index, partial=True):
+        '''
+        index番目のepisodeの各ステップの観測を作り直す. (ステップ数, 9, 9, 3) で、Environment.observationと同じ値
+        '''
+        episode = self.episode(index)
+        goals = np.full(len(episode['row']), episode['goal'])
+        return render_observations(self.grid_table, goals, episode['row'], episode['column'], partial)
+
+
+def render_observations(table, goals, rows, columns, partial=True):
+    '''
+    Environment.observationをまとめて計算する
+        table : gridテーブル (reward cellの候補数, row, column)
+        goals, rows, columns : 各観測のreward cellの位置(テーブルのindex)と聞き手の位置
+    返り値は (観測数, row, column, 3) のfloat tensor
+    '''
+    goals = np.asarray(goals, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+    n = len(goals)
+    grids = table[goals] # (n, row, column)
+    index = np.arange(n)
+
+    pos_ordinary = (grids == 0)
+    pos_ordinary[index, rows, columns] = False
+    pos_reward = (grids == 1)
+    pos_block = (grids == 9)
+
+    images = np.zeros((*grids.shape, 3), dtype=np.float32)
+    images[..., 0] = pos_ordinary * 255 + pos_block * 112.5
+    images[..., 1] = pos_ordinary * 255 + pos_reward * 225 + pos_block * 112.5
+    images[..., 2] = pos_ordinary * 255 + pos_block * 112.5
+    images[index, rows, columns, 2] = 225
+
+    if partial:
+        mask = np.zeros(grids.shape, dtype=np.float32)
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                mask[index, rows + dr, columns + dc] = 1
+        images *= mask[..., None]
+
+    return torch.from_numpy(images / 255.0).float()
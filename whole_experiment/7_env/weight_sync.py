@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""学習プロセスから行動選択(rollout)用のプロセスへ重みを配る
+
+全モジュールの重みを1本の共有メモリ上のfloat配列に並べ、version番号と一緒に置く。
+workerはversionを見て新しい重みがあるときだけ、共有メモリから自分のパラメータにcopy_する（pickleしない）。
+読み込んだモジュールにLatentCacheが付いていれば無効にする。
+
+    shared = SharedWeights(agent.networks())       # 学習プロセス
+    shared.publish(agent.networks())               # 更新のたびに
+    # workerプロセス (sharedはtorch.multiprocessingで渡す)
+    version = shared.pull(networks, version)       # 新しい重みがあれば読み込む
+
+書き込み中に読まれないように、versionは書き込み中は奇数、書き終わると偶数にする（seqlock）。
+"""
+
+import time
+
+import torch
+
+from LWM_expt_02 import invalidate_latent_caches
+
+
+class SharedWeights():
+    '''
+    modules : 名前 -> nn.Module のdict. 各モジュールのstate_dict（パラメータと永続buffer）を共有する
+    '''
+    def __init__(self, modules):
+        self.spec = [] # (モジュール名, キー, 開始位置, shape)
+        offset = 0
+        for name, module in modules.items():
+            for key, tensor in module.state_dict().items():
+                self.spec.append((name, key, offset, tuple(tensor.shape)))
+                offset += tensor.numel()
+        self.buffer = torch.zeros(offset).share_memory_()
+        self.version = torch.zeros(1, dtype=torch.long).share_memory_()
+        self._views = None
+        self.publish(modules)
+
+    @property
+    def numel(self):
+        return self.buffer.numel()
+
+    def _tensor_pairs(self, modules):
+        # (モジュールのテンソル, 共有メモリのview)の組
+        if self._views is None:
+            self._views = [self.buffer[offset:offset + torch.Size(shape).numel()].view(shape)
+                           for _, _, offset, shape in self.spec]
+        state_dicts = {name: module.state_dict(keep_vars=True) for name, module in modules.items()}
+        return [(state_dicts[name][key], view) for (name, key, _, _), view in zip(self.spec, self._views)]
+
+    def __getstate__(self):
+        # viewは子プロセスで作り直す
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    def publish(self, modules):
+        '''
+        modulesの重みを共有メモリに書き込み、versionを進める
+        '''
+        pairs = self._tensor_pairs(modules)
+        self.version += 1 # 奇数: 書き込み中
+        with torch.no_grad():
+            for tensor, view in pairs:
+                view.copy_(tensor)
+        self.version += 1
+        return int(self.version)
+
+    def pull(self, modules, version=-1, timeout=1.0):
+        '''
+        共有メモリのversionがversionと違えば、modulesに重みを読み込む. 読み込んだ（または既に持っている）versionを返す
+        '''
+        current = int(self.version)
+        if current == version:
+            return version
+        pairs = self._tensor_pairs(modules)
+        deadline = time.monotonic() + timeout
+        while True:
+            if current % 2 == 0:
+                with torch.no_grad():
+                    for tensor, view in pairs:
+                        tensor.copy_(view)
+                # 読んでいる間に書き込まれていなければ完了
+                if int(self.version) == current:
+                    # copy_ではload_state_dictのフックが呼ばれないので、キャッシュした潜在変数をここで捨てる
+                    invalidate_latent_caches(modules)
+                    return current
+            if time.monotonic() > deadline:
+                raise Exception("could not read consistent weights within %.1f s" % timeout)
+            current = int(self.version)